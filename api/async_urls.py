@@ -0,0 +1,10 @@
+from apps.snippets.views import SnippetView
+from apps.users.views_internal import UserRolesAPI
+from cores.async_views import AsyncViewEndpoint
+
+# Actions served natively by cores.async_views.AsyncAPIRouter under ASGI, paths are
+# resolved with the django urlconf and everything else is served by django.
+async_endpoints = [
+    AsyncViewEndpoint(SnippetView, ["list", "create", "retrieve", "partial_update"]),
+    AsyncViewEndpoint(UserRolesAPI, ["get"]),
+]
@@ -1,9 +1,12 @@
 from django.urls import path, include
 
+from cores.database_views import DatabasePoolStatsAPI
+
 app_name = "django_everything"
 
 # Put here all apps url
 urlpatterns = [
     path(r'snippets/', include('apps.snippets.urls'), name="snippets"),
     path('users/', include('apps.users.urls')),
+    path('db_pool_stats/', DatabasePoolStatsAPI.as_view(), name="db-pool-stats"),
 ]
@@ -0,0 +1,78 @@
+"""
+Row counts for paginated listings without full table scans.
+COUNT(*) on postgres visits every visible row. Small results are counted exactly with
+a bounded count; above settings.API_EXACT_COUNT_THRESHOLD the planner estimate is used,
+pg_class.reltuples for a whole table, EXPLAIN for a filtered queryset.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+__all__ = [
+    "bounded_count", "estimate_count", "count_rows",
+]
+
+
+def bounded_count(queryset, limit):
+    """
+    :return: number of rows, counting stops after `limit` rows
+    """
+    return queryset.order_by()[:limit].count()
+
+
+def _table_estimate(queryset):
+    """
+    reltuples of the model table, None if the table was never analyzed
+    """
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table]
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+def _plan_estimate(queryset):
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def estimate_count(queryset):
+    """
+    Planner estimate of the number of rows of `queryset`
+    """
+    query = queryset.query
+    if not query.where and not query.distinct and len(query.alias_map) <= 1:
+        estimate = _table_estimate(queryset)
+        if estimate is not None:
+            return estimate
+    return _plan_estimate(queryset)
+
+
+def count_rows(queryset, threshold=None):
+    """
+    :param queryset:
+    :param threshold: largest count computed exactly, defaults to settings.API_EXACT_COUNT_THRESHOLD
+    :return: (count, is_exact)
+    """
+    if threshold is None:
+        threshold = getattr(settings, 'API_EXACT_COUNT_THRESHOLD', 10000)
+    count = bounded_count(queryset, threshold + 1)
+    if count <= threshold:
+        return count, True
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    key = 'count:estimate:%s' % hashlib.md5(("%s%r" % (sql, params)).encode()).hexdigest()
+    estimate = cache.get(key)
+    if estimate is None:
+        estimate = estimate_count(queryset)
+        cache.set(key, estimate, getattr(settings, 'API_COUNT_CACHE_TIMEOUT', 60))
+    # the estimate may lag behind, but there are more rows than the threshold for sure
+    return max(estimate, count), False
@@ -29,6 +29,11 @@ class ServiceUnavailable(CustomAPIException):
     default_message = {"message": "Service Unavailable", "error_code": "SU503"}
 
 
+class PreconditionFailed(CustomAPIException):
+    status_code = 412
+    default_message = {"message": "Precondition failed", "error_code": "PF412"}
+
+
 class UnAuthorized(CustomAPIException):
     status_code = 401
     default_message = {"message": "User Token Invalid", "error_code": "UTI401"}
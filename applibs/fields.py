@@ -0,0 +1,92 @@
+"""
+Model fields shared by the apps.
+"""
+import base64
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+__all__ = [
+    "COMPRESSED_TEXT_HEADER", "is_compressed", "should_compress", "compress_text", "decompress_text",
+    "CompressedTextField",
+]
+
+# Stored values starting with this header are zlib compressed and base64 encoded,
+# anything else is plain text. The control character never appears in source code,
+# so rows written before compression was turned on stay readable as they are.
+COMPRESSED_TEXT_HEADER = "\x1fzlib:"
+
+
+def is_compressed(value):
+    return isinstance(value, str) and value.startswith(COMPRESSED_TEXT_HEADER)
+
+
+def should_compress(value, min_length=None):
+    """
+    :param value: plain text about to be stored
+    :param min_length: defaults to settings.TEXT_COMPRESSION_MIN_LENGTH
+    :return: True when compression is enabled and the value is long enough to benefit from it
+    """
+    if not getattr(settings, 'TEXT_COMPRESSION_ENABLED', False):
+        return False
+    if min_length is None:
+        min_length = getattr(settings, 'TEXT_COMPRESSION_MIN_LENGTH', 1024)
+    return isinstance(value, str) and not is_compressed(value) and len(value) >= min_length
+
+
+def compress_text(value):
+    level = getattr(settings, 'TEXT_COMPRESSION_LEVEL', 6)
+    compressed = zlib.compress(value.encode('utf-8'), level)
+    return COMPRESSED_TEXT_HEADER + base64.b64encode(compressed).decode('ascii')
+
+
+def decompress_text(value):
+    """
+    :param value: stored value, compressed or not
+    :return: plain text
+    """
+    if not is_compressed(value):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(COMPRESSED_TEXT_HEADER):])).decode('utf-8')
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    """
+    Keeps the stored form on the instance and decompresses on first access only,
+    rows that are loaded but never read pay nothing.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if is_compressed(value):
+            value = instance.__dict__[self.field.attname] = decompress_text(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """
+    TextField compressed on write while settings.TEXT_COMPRESSION_ENABLED is on, for values
+    of at least TEXT_COMPRESSION_MIN_LENGTH characters. Reads always accept both forms.
+    Model instances decompress lazily; values()/values_list() return the stored form,
+    pass it through decompress_text().
+    """
+    descriptor_class = CompressedTextDescriptor
+
+    def pre_save(self, model_instance, add):
+        # the raw attribute, an untouched compressed value is written back as it is
+        return model_instance.__dict__.get(self.attname)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if should_compress(value):
+            compressed = compress_text(value)
+            if len(compressed) < len(value):
+                return compressed
+        return value
@@ -0,0 +1,103 @@
+"""
+Server side syntax highlighting with Pygments in a bounded process pool.
+Highlighting large code is pure Python CPU work, running it in worker processes keeps
+it from holding the GIL of the request threads. This module must stay importable
+without Django being set up: the pool workers only import render_html().
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import multiprocessing
+from threading import BoundedSemaphore, Lock
+
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.lexers.special import TextLexer
+from pygments.util import ClassNotFound
+
+__all__ = [
+    "render_html", "HighlightPoolBusy", "HighlightTimeout", "HighlightPool",
+]
+
+
+def render_html(code, language, linenos):
+    """
+    :param code: plain source code
+    :param language: pygments lexer alias, unknown languages are rendered as plain text
+    :param linenos: render a line number column
+    :return: HTML fragment, style with HtmlFormatter().get_style_defs('.highlight')
+    """
+    try:
+        lexer = get_lexer_by_name(language)
+    except ClassNotFound:
+        lexer = TextLexer()
+    return highlight(code or "", lexer, HtmlFormatter(linenos='table' if linenos else False))
+
+
+class HighlightPoolBusy(Exception):
+    """
+    Raised when every worker is busy and the pending queue is full, or a render timed out
+    """
+
+
+class HighlightTimeout(HighlightPoolBusy):
+    """
+    Raised when a render took longer than its timeout, it would time out again
+    """
+
+
+class HighlightPool(object):
+    """
+    Process pool started on first use. At most `max_pending` renders are queued or running,
+    callers beyond that are turned away instead of piling up behind the workers.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self.max_workers = max_workers
+        self._slots = BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forked children would share the parent's database sockets
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def submit(self, code, language, linenos, wait=0):
+        """
+        :param wait: seconds to wait for a free slot
+        :return: future of the rendered HTML
+        :raises HighlightPoolBusy: no slot freed up in time
+        """
+        if not self._slots.acquire(timeout=wait):
+            raise HighlightPoolBusy()
+        try:
+            future = self.executor.submit(render_html, code, language, linenos)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def render(self, code, language, linenos, timeout):
+        """
+        Render and wait for the result
+        :raises HighlightPoolBusy: no free slot within `timeout`
+        :raises HighlightTimeout: the render took longer
+        """
+        future = self.submit(code, language, linenos, wait=timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HighlightTimeout()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
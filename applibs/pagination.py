@@ -0,0 +1,299 @@
+"""
+Keyset (seek) pagination helpers.
+The cursor stores the full ordering key of the boundary row, so every page is
+fetched with an index range scan and deep pages cost the same as the first one.
+"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, namedtuple
+from functools import reduce
+from itertools import chain
+from operator import or_
+from urllib import parse
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework import pagination
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from applibs.counting import count_rows
+
+__all__ = [
+    "KeysetPagination", "PageNumberPagination", "ApproximateCountPaginator", "keyset_filter",
+]
+
+Cursor = namedtuple('Cursor', ['reverse', 'position'])
+
+
+def keyset_filter(ordering, position, reverse=False):
+    """
+    Build the filter selecting rows strictly after `position` for `ordering`.
+    For ('created', 'id') the result is equivalent to (created, id) > (%s, %s)
+    plus a `created >= %s` guard so postgres can start an index range scan
+    instead of filtering from the beginning of the index.
+    :param ordering: tuple of ordering fields, "-" prefix for descending
+    :param position: tuple of values, one per ordering field
+    :param reverse: select the rows before `position` instead
+    :return: Q object
+    """
+    conditions = []
+    for index, order in enumerate(ordering):
+        field_name = order.lstrip('-')
+        descending = order.startswith('-') != reverse
+        lookup = '__lt' if descending else '__gt'
+        equals = {ordering[i].lstrip('-'): position[i] for i in range(index)}
+        equals[field_name + lookup] = position[index]
+        conditions.append(Q(**equals))
+
+    first_field = ordering[0].lstrip('-')
+    descending = ordering[0].startswith('-') != reverse
+    guard = Q(**{first_field + ('__lte' if descending else '__gte'): position[0]})
+    return guard & reduce(or_, conditions)
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination over a composite, unique ordering such as ('created', 'id').
+    Unlike DRF's CursorPagination the cursor never carries an offset.
+    """
+    page_size = getattr(settings, 'API_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 500)
+    page_size_query_param = 'page_size'
+    ordering = ('created', 'id')
+
+    def get_ordering(self, request, queryset, view):
+        """
+        The view may declare its own `ordering`, the last field must be unique.
+        """
+        ordering = getattr(view, 'ordering', None) or self.ordering
+        if isinstance(ordering, str):
+            return (ordering,)
+        return tuple(ordering)
+
+    def get_page_queryset(self, queryset, request, view=None):
+        """
+        Return the sliced queryset of the requested page without evaluating it.
+        It holds one extra row to know whether there is a following page.
+        """
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.model = queryset.model
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is not None and self.cursor.reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if self.cursor is not None:
+            queryset = queryset.filter(keyset_filter(self.ordering, self.cursor.position, reverse=self.cursor.reverse))
+
+        return queryset[:self.page_size + 1]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self.paginate_results(list(queryset))
+
+    def paginate_querysets(self, querysets, request, view=None):
+        """
+        One page over several querysets sharing the ordering columns, e.g. a table and its
+        archive. Every queryset contributes at most one page, the rows are merged in memory.
+        The ordering fields must all sort in the same direction.
+        """
+        pages = [self.get_page_queryset(queryset, request, view) for queryset in querysets]
+        if pages[0] is None:
+            return None
+        directions = {order.startswith('-') for order in self.ordering}
+        if len(directions) != 1:
+            raise ValueError("paginate_querysets() needs an ordering in a single direction")
+        descending = directions.pop() != (self.cursor is not None and self.cursor.reverse)
+        results = sorted(
+            chain.from_iterable(pages),
+            key=lambda row: self._get_position_from_instance(row, self.ordering),
+            reverse=descending,
+        )
+        return self.paginate_results(results[:self.page_size + 1])
+
+    def paginate_results(self, results):
+        """
+        :param results: rows of get_page_queryset(), in cursor order
+        :return: the rows of the page
+        """
+        reverse = self.cursor is not None and self.cursor.reverse
+        current_position = self.cursor.position if self.cursor else None
+        has_following = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_following
+        else:
+            self.has_next = has_following
+            self.has_previous = current_position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(reverse=True, position=position))
+
+    def get_resume_link(self):
+        """
+        Link continuing after the last row of the page, or from the current cursor when the
+        page is empty: a feed consumer keeps polling it for rows added later.
+        :return: url, the request url without cursor when there is no position yet
+        """
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        elif self.cursor is not None:
+            position = self.cursor.position
+        else:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(Cursor(reverse=False, position=position))
+
+    def decode_cursor(self, request):
+        """
+        Given a request with a cursor, return a `Cursor` instance.
+        The position values are converted back with the model field `to_python`.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            values = json.loads(tokens['p'][0])
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = tuple(
+                self.model._meta.get_field(order.lstrip('-')).to_python(value)
+                for order, value in zip(self.ordering, values)
+            )
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return Cursor(reverse=reverse, position=position)
+
+    def encode_cursor(self, cursor):
+        """
+        Given a Cursor instance, return an url with encoded cursor.
+        """
+        tokens = {'p': json.dumps([str(value) for value in cursor.position])}
+        if cursor.reverse:
+            tokens['r'] = '1'
+
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = urlsafe_b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for order in ordering:
+            field_name = order.lstrip('-')
+            if isinstance(instance, dict):
+                values.append(instance[field_name])
+            else:
+                values.append(getattr(instance, field_name))
+        return tuple(values)
+
+
+class ApproximatePage(Page):
+    """
+    Page of an approximately counted result, whether more rows follow is known from
+    the one extra row fetched with the page
+    """
+
+    def __init__(self, object_list, number, paginator, has_following):
+        super().__init__(object_list, number, paginator)
+        self.has_following = has_following
+
+    def has_next(self):
+        return self.has_following
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Django paginator counting with applibs.counting.count_rows(): exact below the
+    threshold, a planner estimate above it. Past the threshold page numbers are not
+    checked against the estimate, a page past the real end is simply empty.
+    Usable as ModelAdmin.paginator.
+    """
+    count_is_exact = True
+
+    @cached_property
+    def count(self):
+        count, self.count_is_exact = count_rows(self.object_list)
+        return count
+
+    def validate_number(self, number):
+        # count_is_exact is only known once the count ran
+        self.count
+        if self.count_is_exact:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.count_is_exact:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return ApproximatePage(rows[:self.per_page], number, self, len(rows) > self.per_page)
+
+
+class PageNumberPagination(pagination.PageNumberPagination):
+    """
+    Numbered pages for result sets that have no stable keyset, e.g. ranked search results.
+    Large results get an estimated count, flagged by "count_is_exact".
+    """
+    page_size = getattr(settings, 'API_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 500)
+    page_size_query_param = 'page_size'
+    django_paginator_class = ApproximateCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('count_is_exact', self.page.paginator.count_is_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
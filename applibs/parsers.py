@@ -0,0 +1,32 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+__all__ = [
+    "NDJSONParser",
+]
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline delimited JSON into a list, one item per non blank line.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        rows = []
+        if stream is None:
+            return rows
+        for line_number, line in enumerate(stream, start=1):
+            line = line.decode(encoding).strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line %d - %s' % (line_number, exc))
+        return rows
@@ -0,0 +1,34 @@
+"""
+PostgreSQL backend taking its connections from a per process pool.
+    DATABASES = {"default": {"ENGINE": "applibs.pooled_postgresql", "POOL": {"MAX_SIZE": 20}, ..}}
+POOL keys are the upper case ConnectionPool arguments. With CONN_MAX_AGE = 0 django closes
+the connection of a thread at the end of each request, WSGI or ASGI, or database executor
+call, which hands it back to the pool instead of tearing it down. Session state set with
+SET outlives the request, use SET LOCAL.
+"""
+from django.db.backends.postgresql import base
+
+from applibs.pooled_postgresql.creation import DatabaseCreation
+from applibs.pooled_postgresql.pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    pool = None
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL', {}))
+        connection = self.pool.getconn()
+        # as in the postgresql backend, the connection may have been opened with other options
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # closed inside atomic(): django keeps its reference until the rollback
+                return self.pool.putconn(self.connection, discard=self.in_atomic_block)
@@ -0,0 +1,11 @@
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgresDatabaseCreation
+
+from applibs.pooled_postgresql.pool import close_pools
+
+
+class DatabaseCreation(PostgresDatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections, mirrors' included, would keep the test database in use
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
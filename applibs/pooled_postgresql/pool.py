@@ -0,0 +1,276 @@
+"""
+Thread safe psycopg2 connection pool, one per process and database.
+Connections are handed out newest first so the pool shrinks back to what the load needs,
+idle ones above `min_size` are closed after `max_idle` seconds, every connection after
+`max_lifetime` seconds. A connection idle longer than `check_interval` is pinged before it
+is handed out, broken ones are replaced transparently.
+"""
+from collections import deque
+import os
+from threading import Condition, Lock
+from time import monotonic
+
+import psycopg2
+from psycopg2 import extensions
+
+__all__ = [
+    "PoolTimeout", "ConnectionPool", "get_pool", "close_pools", "pool_stats",
+]
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """
+    No connection became free within the pool's timeout, surfaces as django's OperationalError
+    """
+
+
+class ConnectionPool(object):
+    """
+    :param connect: callable opening a new psycopg2 connection
+    :param min_size: connections kept open once the pool is used
+    :param max_size: open connections, idle and in use, never exceed it
+    :param timeout: seconds getconn() waits for a free connection
+    :param max_lifetime: seconds after which a connection is closed instead of reused
+    :param max_idle: seconds after which an idle connection above min_size is closed
+    :param check_interval: idle seconds after which a connection is pinged on checkout,
+                           0 pings on every checkout
+    """
+
+    def __init__(self, connect, min_size=2, max_size=20, timeout=10, max_lifetime=1800, max_idle=300,
+                 check_interval=5):
+        assert 0 <= min_size <= max_size and max_size > 0, "0 <= min_size <= max_size required"
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+
+        self._condition = Condition(Lock())
+        # (connection, returned at), most recently returned last
+        self._idle = deque()
+        self._opened_at = {}
+        self._size = 0
+        self._closed = False
+
+        self._waiting = 0
+        self._counters = dict.fromkeys(
+            ("created", "closed", "checkouts", "timeouts", "failed_checks", "wait_time_total"), 0
+        )
+        self._wait_time_max = 0
+
+    def _open(self):
+        connection = self._connect()
+        with self._condition:
+            self._opened_at[connection] = monotonic()
+            self._counters["created"] += 1
+        return connection
+
+    def _discard(self, connection):
+        """
+        Close a checked out or already removed idle connection and free its slot
+        """
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._condition:
+            self._opened_at.pop(connection, None)
+            self._size -= 1
+            self._counters["closed"] += 1
+            self._condition.notify()
+
+    def _expired(self, connection, now):
+        return now - self._opened_at.get(connection, now) >= self.max_lifetime
+
+    def _usable(self, connection):
+        """
+        :return: False when the server does not answer
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def fill(self):
+        """
+        Open connections up to min_size
+        """
+        while True:
+            with self._condition:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._open()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                raise
+            self.putconn(connection)
+
+    def getconn(self):
+        """
+        :return: psycopg2 connection, give it back with putconn()
+        :raises PoolTimeout: max_size connections stayed in use for `timeout` seconds
+        """
+        start = monotonic()
+        while True:
+            with self._condition:
+                assert not self._closed, "connection pool is closed"
+                while not self._idle and self._size >= self.max_size:
+                    remaining = start + self.timeout - monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            "no database connection free within %ss, %d in use" % (self.timeout, self._size)
+                        )
+                    self._waiting += 1
+                    try:
+                        self._condition.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    connection, returned_at = self._idle.pop()
+                else:
+                    connection, returned_at = None, None
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    connection = self._open()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            else:
+                now = monotonic()
+                if connection.closed or self._expired(connection, now):
+                    self._discard(connection)
+                    continue
+                if now - returned_at >= self.check_interval and not self._usable(connection):
+                    with self._condition:
+                        self._counters["failed_checks"] += 1
+                    self._discard(connection)
+                    continue
+
+            waited = monotonic() - start
+            with self._condition:
+                self._counters["checkouts"] += 1
+                self._counters["wait_time_total"] += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+            return connection
+
+    def putconn(self, connection, discard=False):
+        """
+        Return a connection, an open transaction is rolled back
+        :param connection: connection of getconn()
+        :param discard: close it instead, e.g. when its state is unknown
+        """
+        now = monotonic()
+        if discard or self._closed or connection.closed or self._expired(connection, now):
+            return self._discard(connection)
+        if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                return self._discard(connection)
+
+        stale = []
+        with self._condition:
+            self._idle.append((connection, now))
+            # the oldest idle connections, above min_size, idle for too long
+            while len(self._idle) > 1 and self._size - len(stale) > self.min_size \
+                    and now - self._idle[0][1] >= self.max_idle:
+                stale.append(self._idle.popleft()[0])
+            self._condition.notify()
+        for idle_connection in stale:
+            self._discard(idle_connection)
+
+    def close(self):
+        """
+        Close the idle connections, the ones in use are closed when returned
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        """
+        :return: dict of sizes and counters, wait times in milliseconds
+        """
+        with self._condition:
+            stats = dict(self._counters)
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "max_size": self.max_size,
+                "wait_time_max": self._wait_time_max,
+            })
+        checkouts = stats["checkouts"] or 1
+        stats["wait_time_avg"] = round(stats["wait_time_total"] / checkouts * 1000, 3)
+        stats["wait_time_total"] = round(stats["wait_time_total"] * 1000, 3)
+        stats["wait_time_max"] = round(stats["wait_time_max"] * 1000, 3)
+        return stats
+
+
+# (pid, alias, connection parameters) -> pool, a forked worker builds its own pools and
+# leaves the parent's connections alone
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(alias, conn_params, options):
+    """
+    :param alias: database alias
+    :param conn_params: psycopg2.connect() keyword arguments
+    :param options: settings_dict["POOL"], upper case ConnectionPool arguments
+    :return: ConnectionPool, filled to MIN_SIZE on creation
+    """
+    key = (os.getpid(), alias, tuple(sorted((name, str(value)) for name, value in conn_params.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                lambda: psycopg2.connect(**conn_params),
+                **{name.lower(): value for name, value in options.items()}
+            )
+            created = True
+        else:
+            created = False
+    if created:
+        pool.fill()
+    return pool
+
+
+def close_pools(alias=None):
+    """
+    Close the pools of this process, of one alias or all
+    """
+    with _pools_lock:
+        keys = [key for key in _pools if key[0] == os.getpid() and alias in (None, key[1])]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+def pool_stats():
+    """
+    :return: list of ConnectionPool.stats() of this process with "alias" and "database"
+    """
+    with _pools_lock:
+        pools = [(key, pool) for key, pool in _pools.items() if key[0] == os.getpid()]
+    return [
+        dict(pool.stats(), alias=alias, database=dict(params).get("database"))
+        for (_, alias, params), pool in pools
+    ]
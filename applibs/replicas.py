@@ -0,0 +1,100 @@
+"""
+Read replica routing.
+Reads go to a random replica of settings.DATABASE_REPLICAS, writes to the primary. Reads
+stay on the primary:
+    - during unsafe (POST, PATCH, ..) requests and inside `with use_primary():`
+    - inside a transaction on the primary
+    - for REPLICA_STICKY_SECONDS after the last write of a client, so that it reads its
+      own changes. Clients are told apart by their Authorization header or session cookie.
+Without replicas every query goes to the primary as before.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.deprecation import MiddlewareMixin
+
+__all__ = [
+    "PRIMARY", "use_primary", "ReplicaRouter", "ReplicaStickinessMiddleware",
+]
+
+PRIMARY = DEFAULT_DB_ALIAS
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# a context variable follows the request into sync_to_async threads and asyncio tasks
+_use_primary = ContextVar('use_primary', default=False)
+
+
+@contextmanager
+def use_primary():
+    """
+    Route the reads of the block to the primary
+    """
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class ReplicaRouter(object):
+    """
+    settings.DATABASE_ROUTERS entry. Replicas hold the same data as the primary, so any
+    relation is allowed, and only the primary is migrated.
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas or _use_primary.get() or connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class ReplicaStickinessMiddleware(MiddlewareMixin):
+    """
+    Pins the reads of unsafe requests, and of every request of a client for
+    settings.REPLICA_STICKY_SECONDS after its last successful write, to the primary.
+    The write marks are kept in the cache named by REPLICA_STICKY_CACHE_ALIAS, it must be
+    shared by all workers (e.g. redis).
+    """
+
+    @staticmethod
+    def client_key(request):
+        credentials = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not credentials:
+            return None
+        return 'replica:primary:%s' % hashlib.md5(credentials.encode()).hexdigest()
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'REPLICA_STICKY_CACHE_ALIAS', 'default')]
+
+    def process_request(self, request):
+        if not getattr(settings, 'DATABASE_REPLICAS', []):
+            return
+        key = self.client_key(request)
+        primary = request.method not in SAFE_METHODS or (key is not None and self.cache.get(key, False))
+        request._replica_token = _use_primary.set(bool(primary))
+
+    def process_response(self, request, response):
+        token = getattr(request, '_replica_token', None)
+        if token is None:
+            return response
+        _use_primary.reset(token)
+        key = self.client_key(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and key is not None:
+            self.cache.set(key, True, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        return response
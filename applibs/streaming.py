@@ -0,0 +1,270 @@
+"""
+Streaming encoders for large result sets.
+Rows are pulled lazily (e.g. from QuerySet.iterator(), which uses a postgres
+server-side cursor) and encoded chunk by chunk, so the worker never holds the
+whole result in memory. Bulk exports and imports skip python rows altogether,
+postgres formats and parses them with COPY.
+"""
+import csv
+import gzip
+import io
+import json
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+__all__ = [
+    "STREAM_FORMATS", "ndjson_stream", "json_array_stream", "streaming_json_response",
+    "copy_to", "copy_stream", "CopyStreamClosed", "NDJSONCopyReader",
+]
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def _encoded_chunks(rows, separator, chunk_size):
+    """
+    Encode rows and join them in groups of `chunk_size` to avoid one write per row
+    :param rows: iterable of serializable rows
+    :param separator: string put between two rows
+    :param chunk_size: rows per yielded chunk
+    :return: generator of encoded strings
+    """
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    buffer = []
+    for row in rows:
+        buffer.append(encoder.encode(row))
+        if len(buffer) >= chunk_size:
+            yield separator.join(buffer)
+            buffer = []
+    if buffer:
+        yield separator.join(buffer)
+
+
+def ndjson_stream(rows, chunk_size):
+    """
+    One JSON document per line
+    """
+    for chunk in _encoded_chunks(rows, "\n", chunk_size):
+        yield chunk + "\n"
+
+
+def json_array_stream(rows, chunk_size):
+    """
+    A single JSON array, emitted incrementally
+    """
+    yield "["
+    first = True
+    for chunk in _encoded_chunks(rows, ",", chunk_size):
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]"
+
+
+def streaming_json_response(rows, stream_format, chunk_size=None):
+    """
+    :param rows: lazy iterable of serializable rows
+    :param stream_format: ndjson/json
+    :param chunk_size: rows encoded per chunk, defaults to settings.API_STREAM_CHUNK_SIZE
+    :return: StreamingHttpResponse
+    """
+    chunk_size = chunk_size or getattr(settings, 'API_STREAM_CHUNK_SIZE', 2000)
+    streams = {
+        "ndjson": ndjson_stream,
+        "json": json_array_stream,
+    }
+    response = StreamingHttpResponse(
+        streams[stream_format](rows, chunk_size),
+        content_type=STREAM_FORMATS[stream_format]
+    )
+    # keep reverse proxies from buffering the whole body
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class _RowFilterWriter(object):
+    """
+    File object passing every row COPY writes through `row_filter` before `target`,
+    postgres sends, and psycopg2 writes, COPY ... TO data one row at a time
+    """
+
+    def __init__(self, target, row_filter):
+        self.target = target
+        self.row_filter = row_filter
+
+    def write(self, data):
+        self.target.write(self.row_filter(bytes(data)))
+        return len(data)
+
+
+def copy_to(copy_sql, target, using=DEFAULT_DB_ALIAS, row_filter=None):
+    """
+    Run a COPY ... TO STDOUT statement, postgres writes the data straight into `target`
+    :param copy_sql: complete statement, parameters already bound
+    :param target: binary file object
+    :param using: database alias
+    :param row_filter: callable rewriting each row, bytes to bytes, the header line included
+    """
+    if row_filter is not None:
+        target = _RowFilterWriter(target, row_filter)
+    with connections[using].cursor() as cursor:
+        cursor.copy_expert(copy_sql, target)
+
+
+class CopyStreamClosed(Exception):
+    """
+    Raised in the COPY thread when the consumer of copy_stream() went away
+    """
+
+
+class _QueueWriter(object):
+    """
+    File object handing what COPY writes over to the consumer in chunks of `chunk_size`
+    bytes, psycopg2 writes one row at a time
+    """
+
+    def __init__(self, chunks, closed, chunk_size):
+        self.chunks = chunks
+        self.closed = closed
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+
+    def put(self, item):
+        # wakes up regularly to notice a consumer that stopped reading
+        while not self.closed.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except Full:
+                continue
+        raise CopyStreamClosed()
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(b"".join(self.buffer))
+            self.buffer, self.buffered = [], 0
+
+
+def copy_stream(copy_sql, compress=False, chunk_size=65536, using=DEFAULT_DB_ALIAS, row_filter=None):
+    """
+    Generator of the output of a COPY ... TO STDOUT statement, e.g. for a StreamingHttpResponse.
+    psycopg2 pushes COPY data into a file object, so the statement runs in a thread with its
+    own connection and hands the chunks over a small bounded queue. Waiting on the queue
+    blocks, under ASGI cores.async_views.StreamingASGIHandler iterates it off the event loop.
+    :param copy_sql: complete statement, parameters already bound
+    :param compress: gzip the output
+    :param chunk_size: bytes per yielded chunk
+    :param using: database alias
+    :param row_filter: see copy_to()
+    :return: generator of bytes
+    """
+    chunks, closed = Queue(maxsize=8), Event()
+    done = object()
+
+    def produce():
+        writer = _QueueWriter(chunks, closed, chunk_size)
+        try:
+            if compress:
+                with gzip.GzipFile(fileobj=writer, mode='wb') as target:
+                    copy_to(copy_sql, target, using, row_filter)
+            else:
+                copy_to(copy_sql, writer, using, row_filter)
+            writer.flush()
+            writer.put(done)
+        except CopyStreamClosed:
+            pass
+        except Exception as exc:
+            try:
+                writer.put(exc)
+            except CopyStreamClosed:
+                pass
+        finally:
+            connections[using].close()
+
+    thread = Thread(target=produce, name='copy-stream', daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=1)
+            except Empty:
+                if not thread.is_alive() and chunks.empty():
+                    return
+                continue
+            if chunk is done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        closed.set()
+
+
+class NDJSONCopyReader(object):
+    """
+    Binary file object turning an NDJSON source into CSV rows for COPY ... FROM STDIN, read
+    line by line as COPY asks for data. Every non blank line gives one row: its line number,
+    an error (NULL when the line is fine), then the values of `columns`. Lines that are not
+    a JSON object only carry the error. Scalars are written as postgres reads them, nested
+    values as JSON.
+    """
+
+    def __init__(self, source, columns, encoding='utf-8'):
+        self.source = source
+        self.columns = columns
+        self.encoding = encoding
+        self.line_number = 0
+        self.buffer = b""
+        self.exhausted = False
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return "t" if value else "f"
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+
+    def encode_line(self, line):
+        try:
+            document = json.loads(line)
+        except ValueError:
+            document = None
+        if isinstance(document, dict):
+            row = [self.line_number, None] + [self.format_value(document.get(column)) for column in self.columns]
+        else:
+            row = [self.line_number, "invalid json"] + [None] * len(self.columns)
+        output = io.StringIO()
+        csv.writer(output).writerow(row)
+        return output.getvalue().encode(self.encoding)
+
+    def read(self, size=-1):
+        while not self.exhausted and (size is None or size < 0 or len(self.buffer) < size):
+            line = self.source.readline()
+            if not line:
+                self.exhausted = True
+                break
+            self.line_number += 1
+            line = line.decode(self.encoding) if isinstance(line, bytes) else line
+            if line.strip():
+                self.buffer += self.encode_line(line)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
@@ -1,6 +1,13 @@
 from django.contrib import admin
 
+from applibs.pagination import ApproximateCountPaginator
 from apps.snippets.models import Snippet
 
-admin.site.register(Snippet)
 
+class SnippetAdmin(admin.ModelAdmin):
+    # estimated counts on large tables, and no second unfiltered COUNT(*)
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+
+admin.site.register(Snippet, SnippetAdmin)
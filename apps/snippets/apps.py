@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SnippetsConfig(AppConfig):
     name = 'apps.snippets'
+
+    def ready(self):
+        from apps.snippets import signals  # noqa: F401
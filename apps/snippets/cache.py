@@ -0,0 +1,96 @@
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+
+__all__ = [
+    "SnippetResponseCache", "snippet_response_cache", "SnippetHighlightCache", "snippet_highlight_cache",
+]
+
+
+class SnippetResponseCache(object):
+    """
+    Pre-rendered retrieve response bodies keyed by snippet id, stored in the Django cache
+    named by settings.SNIPPET_CACHE_ALIAS. Entries are dropped by the signal receivers of
+    apps.snippets.signals whenever a snippet or its owner changes.
+    """
+    key_prefix = 'snippet:retrieve:'
+
+    def __init__(self):
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'SNIPPET_CACHE_ALIAS', 'default')]
+
+    def make_key(self, snippet_id):
+        return '%s%s' % (self.key_prefix, snippet_id)
+
+    def get(self, snippet_id):
+        """
+        :return: rendered bytes or None
+        """
+        content = self.cache.get(self.make_key(snippet_id))
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return content
+
+    def set(self, snippet_id, content):
+        self.cache.set(self.make_key(snippet_id), content, getattr(settings, 'SNIPPET_CACHE_TIMEOUT', 300))
+
+    def invalidate(self, snippet_ids):
+        keys = [self.make_key(snippet_id) for snippet_id in snippet_ids]
+        if keys:
+            self.cache.delete_many(keys)
+
+    def stats(self):
+        """
+        Per process hit and miss counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+snippet_response_cache = SnippetResponseCache()
+
+
+class SnippetHighlightCache(object):
+    """
+    Highlighted HTML of snippets. The key holds everything the rendering depends on,
+    (id, modified, language, linenos), so a changed snippet simply misses and the stale
+    entry expires on its own.
+    """
+    key_prefix = 'snippet:highlight:'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'SNIPPET_CACHE_ALIAS', 'default')]
+
+    def make_key(self, snippet_id, modified, language, linenos):
+        return '%s%s:%s:%s:%d' % (self.key_prefix, snippet_id, modified.isoformat(), language, linenos)
+
+    def get(self, snippet_id, modified, language, linenos):
+        return self.cache.get(self.make_key(snippet_id, modified, language, linenos))
+
+    def set(self, snippet_id, modified, language, linenos, html):
+        self.cache.set(
+            self.make_key(snippet_id, modified, language, linenos), html,
+            getattr(settings, 'SNIPPET_HIGHLIGHT_CACHE_TIMEOUT', 86400)
+        )
+
+
+snippet_highlight_cache = SnippetHighlightCache()
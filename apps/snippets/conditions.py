@@ -0,0 +1,96 @@
+"""
+ETag validators for conditional requests on snippet endpoints.
+They are computed with one small query before anything is serialized, so an
+unchanged resource is answered with 304 without running the serializer.
+Snippet ETags start with the snippet version, If-Match of an update is checked
+against it by the UPDATE itself.
+No Last-Modified is sent: the payload holds the owner username and users carry no
+modification time, If-Modified-Since would answer 304 after an owner rename.
+"""
+import hashlib
+import re
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import Count, Max, Sum
+from django.utils.http import parse_etags
+
+from applibs import exceptions
+from applibs.pagination import KeysetPagination
+from apps.snippets.models import Snippet
+from apps.snippets.utils import get_list_queryset, include_archived
+
+
+# v<version>-<digest> as sent by snippet_etag(), or a bare version, e.g. from a list payload
+SNIPPET_ETAG_VERSION = re.compile(r'^"v?(\d+)(?:-[0-9a-f]*)?"$')
+
+
+def snippet_etag_value(pk, version, modified, username, fields=""):
+    """
+    :return: unquoted ETag of a snippet representation
+    """
+    # the owner username is part of the payload but does not touch snippet.modified,
+    # every sparse fieldset is a representation of its own
+    digest = hashlib.md5(("%s:%s:%s:%s" % (pk, modified.isoformat(), username, fields)).encode()).hexdigest()
+    return "v%d-%s" % (version, digest)
+
+
+def if_match_versions(request):
+    """
+    Snippet versions named by the If-Match header of an update
+    :param request:
+    :return: list of versions, None without If-Match or for "*"
+    :raises:
+        - PreconditionFailed: an entity tag that is no snippet version, weak ones included,
+                              can never match
+    """
+    header = request.META.get("HTTP_IF_MATCH")
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if etags == ["*"]:
+        return None
+    versions = []
+    for etag in etags:
+        match = SNIPPET_ETAG_VERSION.match(etag)
+        if match is None:
+            raise exceptions.PreconditionFailed()
+        versions.append(int(match.group(1)))
+    if not versions:
+        raise exceptions.PreconditionFailed()
+    return versions
+
+
+def snippet_etag(request, *args, **kwargs):
+    pk = kwargs["pk"]
+    if not str(pk).isdigit():
+        return None
+    row = Snippet.objects.live().filter(id=pk).values_list('modified', 'owner__username', 'version').first()
+    if row is None:
+        return None
+    modified, username, version = row
+    return snippet_etag_value(pk, version, modified, username, request.query_params.get("fields", ""))
+
+
+def list_etag(request, *args, **kwargs):
+    """
+    Aggregate max(modified), count, sum(id) and the owner usernames over exactly the rows
+    of the requested keyset page; the full path, with type/cursor/page_size, is part of
+    the ETag. A rename does not touch snippet.modified, the usernames cover it.
+    """
+    # archived rows are not covered by the page aggregate
+    if request.query_params.get("stream") or include_archived(request.query_params):
+        return None
+    queryset = get_list_queryset(request.query_params.get("type", "active"))
+    page = KeysetPagination().get_page_queryset(queryset.values('id', 'modified', 'owner__username'), request)
+    if page is None:
+        return None
+    summary = page.aggregate(
+        last_modified=Max('modified'), total=Count('id'), id_sum=Sum('id'),
+        owners=StringAgg('owner__username', ',', distinct=True, ordering='owner__username'),
+    )
+    if summary["last_modified"] is None:
+        return None
+    return hashlib.md5(("%s:%s:%s:%s:%s" % (
+        request.get_full_path(), summary["last_modified"].isoformat(), summary["total"], summary["id_sum"],
+        summary["owners"],
+    )).encode()).hexdigest()
@@ -0,0 +1,75 @@
+import logging
+
+from django.conf import settings
+
+from applibs.fields import decompress_text
+from applibs.highlighting import HighlightPool, HighlightPoolBusy, HighlightTimeout, render_html
+from apps.snippets.cache import snippet_highlight_cache
+from apps.snippets.models import Snippet
+
+# the logger behind applibs.loggers.log_info(), without its basicConfig() side effect
+logger = logging.getLogger('general')
+
+__all__ = [
+    "highlight_pool", "highlighted_snippet", "prerender_snippet",
+]
+
+highlight_pool = HighlightPool(settings.SNIPPET_HIGHLIGHT_WORKERS, settings.SNIPPET_HIGHLIGHT_MAX_PENDING)
+
+
+def highlighted_snippet(snippet_id):
+    """
+    Highlighted HTML of an active snippet, rendered in the pool on a cache miss.
+    The possibly large code is only fetched when the cache misses. Code that takes longer
+    than SNIPPET_HIGHLIGHT_TIMEOUT is served, and cached, as plain text.
+    :param snippet_id:
+    :return: html, None if there is no such active snippet
+    :raises HighlightPoolBusy: no free slot in the pool
+    """
+    row = Snippet.objects.live().filter(id=snippet_id).values_list('modified', 'language', 'linenos').first()
+    if row is None:
+        return None
+    modified, language, linenos = row
+    html = snippet_highlight_cache.get(snippet_id, modified, language, linenos)
+    if html is None:
+        code = decompress_text(Snippet.objects.filter(id=snippet_id).values_list('code', flat=True).first())
+        try:
+            html = highlight_pool.render(code, language, linenos, settings.SNIPPET_HIGHLIGHT_TIMEOUT)
+        except HighlightTimeout:
+            logger.info("highlighting snippet {} timed out, it is served as plain text".format(snippet_id))
+            # the text lexer is a single pass over the code, fast enough for the request thread
+            html = render_html(code, 'text', linenos)
+        snippet_highlight_cache.set(snippet_id, modified, language, linenos, html)
+    return html
+
+
+def prerender_snippet(snippet):
+    """
+    Queue the rendering of a saved snippet without waiting for it. Skipped when the
+    pool is saturated, the first request renders it then.
+    :param snippet: Snippet instance
+    :return: future of the html, None if skipped
+    """
+    if snippet.get_deferred_fields() & {'code', 'language', 'linenos', 'modified'}:
+        # one query, instead of one per deferred attribute read below; defer(None) drops
+        # the manager's defer('code')
+        snippet = (
+            Snippet.objects.defer(None).only('id', 'code', 'language', 'linenos', 'modified')
+            .filter(pk=snippet.pk).first()
+        )
+        if snippet is None:
+            return None
+    snippet_id, modified, language, linenos = snippet.pk, snippet.modified, snippet.language, snippet.linenos
+    try:
+        future = highlight_pool.submit(snippet.code, language, linenos)
+    except HighlightPoolBusy:
+        logger.info("highlight pool busy, snippet {} is rendered on demand".format(snippet_id))
+        return None
+
+    def store(done):
+        if done.cancelled() or done.exception() is not None:
+            return
+        snippet_highlight_cache.set(snippet_id, modified, language, linenos, done.result())
+
+    future.add_done_callback(store)
+    return future
@@ -0,0 +1,48 @@
+from datetime import timedelta
+from time import sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.snippets.utils import archive_snippet_batch
+
+
+class Command(BaseCommand):
+    help = "Move inactive snippets older than N days to snippets_archive, in short, checkpointed batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Archive rows last modified more than this many days ago, "
+                                 "defaults to settings.SNIPPET_ARCHIVE_AFTER_DAYS")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Rows per transaction, defaults to settings.SNIPPET_ARCHIVE_BATCH_SIZE")
+        parser.add_argument('--pause', type=float, default=0,
+                            help="Seconds to sleep between batches, to leave room for the live traffic")
+        parser.add_argument('--max-batches', type=int, default=None, help="Stop after this many batches")
+        parser.add_argument('--every', type=int, default=None,
+                            help="Scheduled mode: start a new run every this many seconds, forever")
+        parser.add_argument('--checkpoint', default='default', help="Checkpoint name, one per concurrent job")
+
+    def run(self, options):
+        days = options['days'] if options['days'] is not None else settings.SNIPPET_ARCHIVE_AFTER_DAYS
+        batch_size = options['batch_size'] or settings.SNIPPET_ARCHIVE_BATCH_SIZE
+        cutoff = timezone.now() - timedelta(days=days)
+        batches, moved = 0, 0
+        while options['max_batches'] is None or batches < options['max_batches']:
+            archived = archive_snippet_batch(options['checkpoint'], cutoff, batch_size)
+            if archived is None:
+                break
+            batches += 1
+            moved += len(archived)
+            self.stdout.write("batch %d: %d snippets archived" % (batches, len(archived)))
+            if options['pause']:
+                sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS("Done: %d snippets archived in %d batches" % (moved, batches)))
+
+    def handle(self, *args, **options):
+        if options['every'] is None:
+            return self.run(options)
+        while True:
+            self.run(options)
+            sleep(options['every'])
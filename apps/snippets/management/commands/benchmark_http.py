@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Load a running server with concurrent requests and report throughput and latency "
+        "percentiles, e.g. to compare the same endpoint under gunicorn (WSGI) and uvicorn (ASGI):\n"
+        "  gunicorn django_everything.wsgi -w 4\n"
+        "  uvicorn django_everything.asgi:application --workers 4"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help="e.g. http://127.0.0.1:8000/api/v1/snippets/")
+        parser.add_argument('--requests', type=int, default=2000, help="Total number of requests")
+        parser.add_argument('--concurrency', type=int, default=32, help="Requests in flight")
+        parser.add_argument('--method', default='GET')
+        parser.add_argument('--data', default=None, help="JSON request body")
+        parser.add_argument('--token', default=None, help="JWT sent as 'Authorization: JWT <token>'")
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def request(self, url, method, data, headers, timeout):
+        """
+        :return: (status code or None on connection error, seconds)
+        """
+        start = perf_counter()
+        try:
+            with urlopen(Request(url, data=data, headers=headers, method=method), timeout=timeout) as response:
+                response.read()
+                code = response.status
+        except HTTPError as exc:
+            code = exc.code
+        except (URLError, OSError):
+            code = None
+        return code, perf_counter() - start
+
+    @staticmethod
+    def percentile(timings, percent):
+        return timings[min(len(timings) - 1, int(len(timings) * percent / 100))]
+
+    def handle(self, *args, **options):
+        headers = {"Content-Type": "application/json"}
+        if options['token']:
+            headers["Authorization"] = "JWT %s" % options['token']
+        data = options['data'].encode() if options['data'] else None
+        arguments = (options['url'], options['method'].upper(), data, headers, options['timeout'])
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(lambda _: self.request(*arguments), range(options['requests'])))
+        elapsed = perf_counter() - start
+
+        timings = sorted(seconds for _, seconds in results)
+        codes = {}
+        for code, _ in results:
+            codes[code] = codes.get(code, 0) + 1
+        self.stdout.write("%d requests, concurrency %d, %.2fs" % (len(results), options['concurrency'], elapsed))
+        self.stdout.write("throughput: %.1f req/sec" % (len(results) / elapsed))
+        for percent in (50, 95, 99):
+            self.stdout.write("p%d: %.1f ms" % (percent, self.percentile(timings, percent) * 1000))
+        self.stdout.write("status codes: %s" % ", ".join(
+            "%s=%d" % (code or "error", count) for code, count in sorted(codes.items(), key=lambda item: str(item[0]))
+        ))
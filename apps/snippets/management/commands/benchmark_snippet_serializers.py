@@ -0,0 +1,48 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from apps.snippets.models import Snippet
+from apps.snippets.serializers import FAST_SNIPPET_SERIALIZER, SnippetSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare SnippetSerializer with its compiled read path, in rows/sec"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Number of snippets to serialize")
+        parser.add_argument('--repeat', type=int, default=5, help="Best of N runs is reported")
+
+    def best_of(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            func()
+            timings.append(perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        queryset = Snippet.objects.order_by('id')[:rows]
+        instances = list(queryset.select_related('owner'))
+        tuples = list(FAST_SNIPPET_SERIALIZER.values_list(queryset))
+        if not instances:
+            self.stderr.write("No snippets to serialize, create some first.")
+            return
+        if FAST_SNIPPET_SERIALIZER.serialize(tuples) != SnippetSerializer(instances, many=True).data:
+            self.stderr.write("Compiled serializer output differs from SnippetSerializer!")
+            return
+
+        results = [
+            ("SnippetSerializer (select_related instances)",
+             self.best_of(repeat, lambda: SnippetSerializer(instances, many=True).data)),
+            ("compiled (values_list tuples)",
+             self.best_of(repeat, lambda: FAST_SNIPPET_SERIALIZER.serialize(tuples))),
+            ("SnippetSerializer incl. query",
+             self.best_of(repeat, lambda: SnippetSerializer(queryset.select_related('owner'), many=True).data)),
+            ("compiled incl. query",
+             self.best_of(repeat, lambda: FAST_SNIPPET_SERIALIZER.serialize(FAST_SNIPPET_SERIALIZER.values_list(queryset)))),
+        ]
+        for name, elapsed in results:
+            self.stdout.write("%-48s %12.0f rows/sec" % (name, len(instances) / elapsed))
+        self.stdout.write("speedup (serialization only): %.1fx" % (results[0][1] / results[1][1]))
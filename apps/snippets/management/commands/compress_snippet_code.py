@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import TextField, Value
+
+from applibs.fields import compress_text, decompress_text, is_compressed
+from apps.snippets.models import Snippet
+
+
+class Command(BaseCommand):
+    help = "Rewrite stored Snippet.code in (or out of) the compressed format, walking the table by id in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows read and updated per round trip")
+        parser.add_argument('--min-length', type=int, default=None,
+                            help="Only compress code of at least this many characters, "
+                                 "defaults to settings.TEXT_COMPRESSION_MIN_LENGTH")
+        parser.add_argument('--decompress', action='store_true', help="Store every row as plain text again")
+
+    def convert(self, code, decompress, min_length):
+        """
+        :return: new stored value, None when the row is left alone
+        """
+        if code is None:
+            return None
+        if decompress:
+            return decompress_text(code) if is_compressed(code) else None
+        if is_compressed(code) or len(code) < min_length:
+            return None
+        compressed = compress_text(code)
+        return compressed if len(compressed) < len(code) else None
+
+    def handle(self, *args, **options):
+        batch_size, decompress = options['batch_size'], options['decompress']
+        min_length = options['min_length']
+        if min_length is None:
+            min_length = settings.TEXT_COMPRESSION_MIN_LENGTH
+
+        last_id, scanned, rewritten, saved_chars = 0, 0, 0, 0
+        while True:
+            rows = list(
+                Snippet.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'code')[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            scanned += len(rows)
+            changed = []
+            for snippet_id, code in rows:
+                stored = self.convert(code, decompress, min_length)
+                if stored is not None:
+                    # written verbatim, whatever TEXT_COMPRESSION_ENABLED says
+                    changed.append(Snippet(id=snippet_id, code=Value(stored, output_field=TextField())))
+                    saved_chars += len(code) - len(stored)
+            # only code is written: the search trigger keeps the code lexemes of compressed rows,
+            # `modified` is untouched as the content does not change
+            if changed:
+                Snippet.objects.bulk_update(changed, ['code'])
+                rewritten += len(changed)
+            self.stdout.write("scanned %d, rewritten %d (last id %d)" % (scanned, rewritten, last_id))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Done: %d of %d rows rewritten, %d characters %s" % (
+                rewritten, scanned, abs(saved_chars), "added" if saved_chars < 0 else "saved"
+            )
+        ))
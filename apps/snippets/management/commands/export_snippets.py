@@ -0,0 +1,54 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from applibs.exceptions import ValidationError
+from applibs.streaming import copy_to
+from apps.snippets.models import Snippet
+from apps.snippets.utils import ExportCodeDecompressor, parse_export_moment, snippet_export_sql
+
+
+class Command(BaseCommand):
+    help = "Export snippets as CSV with postgres COPY, to a file or stdout, optionally gzipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help="File path, '-' for stdout")
+        parser.add_argument('--gzip', action='store_true', help="Compress the output")
+        parser.add_argument('--status', choices=('active', 'inactive'), default=None)
+        parser.add_argument('--created-from', default=None, help="ISO date or datetime, inclusive")
+        parser.add_argument('--created-to', default=None, help="ISO date or datetime, exclusive")
+        parser.add_argument('--with-owner', action='store_true', help="Add the owner_username column")
+        parser.add_argument('--include-code', action='store_true',
+                            help="Add the code column, in plain text")
+
+    def handle(self, *args, **options):
+        try:
+            copy_sql = snippet_export_sql(
+                status={None: None, 'active': True, 'inactive': False}[options['status']],
+                created_from=parse_export_moment(options['created_from']),
+                created_to=parse_export_moment(options['created_to']),
+                with_owner=options['with_owner'],
+                include_code=options['include_code'],
+            )
+        except ValidationError:
+            raise CommandError("--created-from and --created-to take ISO dates or datetimes")
+
+        using = router.db_for_read(Snippet)
+        row_filter = ExportCodeDecompressor() if options['include_code'] else None
+        to_stdout = options['output'] == '-'
+        target = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        try:
+            if options['gzip']:
+                with gzip.GzipFile(fileobj=target, mode='wb') as compressed:
+                    copy_to(copy_sql, compressed, using, row_filter)
+            else:
+                copy_to(copy_sql, target, using, row_filter)
+        finally:
+            if to_stdout:
+                target.flush()
+            else:
+                target.close()
+        if not to_stdout:
+            self.stderr.write(self.style.SUCCESS("Snippets exported to %s" % options['output']))
@@ -0,0 +1,36 @@
+import gzip
+
+from django.core.management.base import BaseCommand, CommandError
+
+from applibs.exceptions import ValidationError
+from apps.snippets.utils import import_snippets
+
+
+class Command(BaseCommand):
+    help = "Import snippets from a CSV (with header) or NDJSON file with postgres COPY, in one transaction"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or NDJSON file, optionally gzipped (.gz)")
+        parser.add_argument('--format', choices=('csv', 'ndjson'), default=None,
+                            help="Defaults to the file extension")
+        parser.add_argument('--rejects', default=None,
+                            help="CSV file receiving the rejected rows with their line and error")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        name = path[:-3] if path.endswith('.gz') else path
+        source_format = options['format'] or name.rsplit('.', 1)[-1].lower()
+        if source_format not in ('csv', 'ndjson', 'jsonl'):
+            raise CommandError("Unknown format, use --format csv/ndjson")
+        source_format = 'ndjson' if source_format == 'jsonl' else source_format
+
+        rejects = open(options['rejects'], 'wb') if options['rejects'] else None
+        try:
+            with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as source:
+                imported, rejected = import_snippets(source, source_format, rejects)
+        except ValidationError:
+            raise CommandError("%s is not a valid %s snippet file" % (path, source_format))
+        finally:
+            if rejects is not None:
+                rejects.close()
+        self.stdout.write(self.style.SUCCESS("%d snippets imported, %d rows rejected" % (imported, rejected)))
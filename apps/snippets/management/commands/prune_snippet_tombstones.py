@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.snippets.models import SnippetTombstone
+
+
+class Command(BaseCommand):
+    help = "Delete snippet tombstones older than the changes feed retention, in short batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Delete tombstones older than this many days, "
+                                 "defaults to settings.SNIPPET_TOMBSTONE_RETENTION_DAYS")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Tombstones deleted per transaction")
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.SNIPPET_TOMBSTONE_RETENTION_DAYS
+        cutoff = timezone.now() - timedelta(days=days)
+        expired = SnippetTombstone.objects.filter(modified__lt=cutoff).order_by('modified', 'id')
+        pruned = 0
+        while True:
+            # oldest first on the (modified, id) index, every batch is its own transaction
+            deleted, _ = SnippetTombstone.objects.filter(id__in=expired.values('id')[:options['batch_size']]).delete()
+            if not deleted:
+                break
+            pruned += deleted
+        self.stdout.write(self.style.SUCCESS("Done: %d tombstones older than %d days pruned" % (pruned, days)))
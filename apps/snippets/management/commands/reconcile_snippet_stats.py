@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from apps.snippets.models import Snippet, SnippetStat
+
+UPSERT_CORRECTION = """
+    INSERT INTO snippet_stats (dimension, value, total, active) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (dimension, value) DO UPDATE SET
+        total = snippet_stats.total + EXCLUDED.total,
+        active = snippet_stats.active + EXCLUDED.active
+"""
+
+
+class Command(BaseCommand):
+    help = "Recount snippet_stats from the snippets table and repair any drift"
+
+    def count(self):
+        """
+        Count every group and read the summary table under one snapshot. It is a single
+        grouped scan of snippets, the transaction lasts as long as that scan: counting in
+        chunks would need a snapshot across all of them, or would miss the rows that change
+        between chunks.
+        :return: (counted, stored), both {(dimension, value): (total, active)}
+        """
+        counted = {}
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            groups = (
+                Snippet.objects.order_by().values_list('language', 'owner_id')
+                .annotate(total=Count('id'), active=Count('id', filter=Q(status=True)))
+            )
+            for language, owner_id, total, active in groups:
+                for key in ((SnippetStat.LANGUAGE, language), (SnippetStat.OWNER, str(owner_id))):
+                    old_total, old_active = counted.get(key, (0, 0))
+                    counted[key] = (old_total + total, old_active + active)
+            stored = {
+                (dimension, value): (total, active)
+                for dimension, value, total, active in
+                SnippetStat.objects.values_list('dimension', 'value', 'total', 'active')
+            }
+        return counted, stored
+
+    def handle(self, *args, **options):
+        if connection.in_atomic_block:
+            raise CommandError("reconcile_snippet_stats needs its own transaction")
+
+        counted, stored = self.count()
+        # Both sides come from the same snapshot, their difference is the drift at that moment.
+        # It is applied as a delta, so changes committed since then by the triggers are kept.
+        corrections = []
+        for key in sorted(set(counted) | set(stored)):
+            total, active = counted.get(key, (0, 0))
+            stored_total, stored_active = stored.get(key, (0, 0))
+            if (total, active) != (stored_total, stored_active):
+                corrections.append(key + (total - stored_total, active - stored_active))
+
+        if corrections:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(UPSERT_CORRECTION, corrections)
+        for dimension, value, total, active in corrections:
+            self.stdout.write("%s %s: total %+d, active %+d" % (dimension, value, total, active))
+        self.stdout.write(self.style.SUCCESS("Done: %d of %d groups corrected" % (len(corrections), len(counted))))
@@ -0,0 +1,25 @@
+# Generated by Django 3.0 on 2026-10-18 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0005_auto_20200304_1635'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='snippet',
+            options={'ordering': ['created', 'id'], 'verbose_name': 'Snippet', 'verbose_name_plural': 'Snippets'},
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['status', 'created', 'id'], name='snippets_status_77d94e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['created', 'id'], name='snippets_created_d9c2b6_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0 on 2026-10-18 19:30
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# title is weighted A, code B and the language name C. The 'simple' configuration
+# is used because snippets are source code, natural language stemming does not apply.
+SEARCH_VECTOR_TRIGGER = """
+CREATE OR REPLACE FUNCTION snippets_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.code, '')), 'B') ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.language, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER snippets_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, code, language, search_vector ON snippets
+    FOR EACH ROW EXECUTE PROCEDURE snippets_search_vector_update();
+
+UPDATE snippets SET search_vector =
+    setweight(to_tsvector('pg_catalog.simple', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('pg_catalog.simple', coalesce(code, '')), 'B') ||
+    setweight(to_tsvector('pg_catalog.simple', coalesce(language, '')), 'C');
+"""
+
+DROP_SEARCH_VECTOR_TRIGGER = """
+DROP TRIGGER IF EXISTS snippets_search_vector_trigger ON snippets;
+DROP FUNCTION IF EXISTS snippets_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0006_auto_20261019_0128'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_TRIGGER, DROP_SEARCH_VECTOR_TRIGGER),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='snippets_search__6cc296_gin'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0 on 2026-10-18 19:32
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0007_snippet_search_vector'),
+    ]
+
+    operations = [
+        # Expression index for title autocomplete, see apps.snippets.utils.TITLE_PREFIX_KEY.
+        # The "C" collation lets LIKE 'ABC%' use a btree range scan without pg_trgm.
+        migrations.RunSQL(
+            'CREATE INDEX snippets_title_prefix_idx ON snippets ((UPPER(title::text) COLLATE "C")) WHERE status;',
+            'DROP INDEX IF EXISTS snippets_title_prefix_idx;',
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.0 on 2026-10-18 19:41
+
+import applibs.fields
+from django.db import migrations
+
+# Compressed code (applibs.fields.COMPRESSED_TEXT_HEADER) cannot be tokenized here, for such
+# rows the B weighted lexemes are taken from NEW.search_vector: computed by the application
+# when the code is written, carried over from the old row when another column changes.
+SEARCH_VECTOR_TRIGGER = """
+CREATE OR REPLACE FUNCTION snippets_search_vector_update() RETURNS trigger AS $$
+DECLARE
+    code_vector tsvector;
+BEGIN
+    IF left(NEW.code, 6) = E'\\x1fzlib:' THEN
+        code_vector := ts_filter(coalesce(NEW.search_vector, ''::tsvector), '{b}');
+    ELSE
+        code_vector := setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.code, '')), 'B');
+    END IF;
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.title, '')), 'A') ||
+        code_vector ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.language, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+PLAIN_SEARCH_VECTOR_TRIGGER = """
+CREATE OR REPLACE FUNCTION snippets_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.code, '')), 'B') ||
+        setweight(to_tsvector('pg_catalog.simple', coalesce(NEW.language, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0008_snippet_title_prefix_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='snippet',
+            name='code',
+            field=applibs.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_TRIGGER, PLAIN_SEARCH_VECTOR_TRIGGER),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0009_snippet_code_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetTitleSequence',
+            fields=[
+                ('base_title', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('last_value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Snippet title sequence',
+                'verbose_name_plural': 'Snippet title sequences',
+                'db_table': 'snippet_title_sequences',
+            },
+        ),
+    ]
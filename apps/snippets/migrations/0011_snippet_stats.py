@@ -0,0 +1,106 @@
+# Generated by Django 3.0 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+# Statement level triggers with transition tables: one upsert per touched language/owner
+# per statement, whatever the number of rows, so bulk writes stay cheap. Group rows are
+# upserted in (dimension, value) order, two statements cannot deadlock on them.
+# Trade-off: the upserted row stays locked until the writing transaction commits, so writers
+# of the same language or owner queue behind each other, behind a long import too. Snippet
+# writes are short and spread over many groups, a hot group would need delta rows inserted
+# per statement and folded in later instead of the upsert.
+SUMMARIZE_CHANGES = """
+    INSERT INTO snippet_stats (dimension, value, total, active)
+    SELECT dims.dimension, dims.value, sum(changes.total), sum(changes.active)
+    FROM ({changes}) AS changes
+    CROSS JOIN LATERAL (
+        VALUES ('language', changes.language::text), ('owner', changes.owner_id::text)
+    ) AS dims(dimension, value)
+    GROUP BY dims.dimension, dims.value
+    HAVING sum(changes.total) <> 0 OR sum(changes.active) <> 0
+    ORDER BY dims.dimension, dims.value
+"""
+APPLY_CHANGES = SUMMARIZE_CHANGES + """
+    ON CONFLICT (dimension, value) DO UPDATE SET
+        total = snippet_stats.total + EXCLUDED.total,
+        active = snippet_stats.active + EXCLUDED.active;
+"""
+INSERTED = "SELECT language, owner_id, 1 AS total, status::int AS active FROM new_rows"
+DELETED = "SELECT language, owner_id, -1 AS total, -status::int AS active FROM old_rows"
+
+STATS_TRIGGERS = """
+CREATE OR REPLACE FUNCTION snippet_stats_insert() RETURNS trigger AS $$
+BEGIN
+    {insert}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION snippet_stats_update() RETURNS trigger AS $$
+BEGIN
+    {update}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION snippet_stats_delete() RETURNS trigger AS $$
+BEGIN
+    {delete}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER snippet_stats_insert_trigger AFTER INSERT ON snippets
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE snippet_stats_insert();
+CREATE TRIGGER snippet_stats_update_trigger AFTER UPDATE ON snippets
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE snippet_stats_update();
+CREATE TRIGGER snippet_stats_delete_trigger AFTER DELETE ON snippets
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE snippet_stats_delete();
+
+{backfill}
+""".format(
+    insert=APPLY_CHANGES.format(changes=INSERTED),
+    update=APPLY_CHANGES.format(changes=INSERTED + " UNION ALL " + DELETED),
+    delete=APPLY_CHANGES.format(changes=DELETED),
+    # the unique constraint is only created at the end of the migration, the table is empty anyway
+    backfill=SUMMARIZE_CHANGES.format(changes=INSERTED.replace("new_rows", "snippets")) + ";",
+)
+
+DROP_STATS_TRIGGERS = """
+DROP TRIGGER IF EXISTS snippet_stats_insert_trigger ON snippets;
+DROP TRIGGER IF EXISTS snippet_stats_update_trigger ON snippets;
+DROP TRIGGER IF EXISTS snippet_stats_delete_trigger ON snippets;
+DROP FUNCTION IF EXISTS snippet_stats_insert();
+DROP FUNCTION IF EXISTS snippet_stats_update();
+DROP FUNCTION IF EXISTS snippet_stats_delete();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0010_snippet_title_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('language', 'Language'), ('owner', 'Owner')], max_length=16)),
+                ('value', models.CharField(max_length=100)),
+                ('total', models.BigIntegerField(default=0)),
+                ('active', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Snippet stat',
+                'verbose_name_plural': 'Snippet stats',
+                'db_table': 'snippet_stats',
+                'unique_together': {('dimension', 'value')},
+            },
+        ),
+        migrations.RunSQL(STATS_TRIGGERS, DROP_STATS_TRIGGERS),
+    ]
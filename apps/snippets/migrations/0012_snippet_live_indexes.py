@@ -0,0 +1,33 @@
+# Generated by Django 3.0 on 2026-10-18 19:50
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without blocking writes to snippets
+    atomic = False
+
+    dependencies = [
+        ('snippets', '0011_snippet_stats'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(status=True), fields=['id'], name='snippets_live_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(status=True), fields=['owner'], name='snippets_live_owner_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(status=True), fields=['created', 'id'], name='snippets_live_created_idx'),
+        ),
+        # superseded by snippets_live_created_idx
+        RemoveIndexConcurrently(
+            model_name='snippet',
+            name='snippets_status_77d94e_idx',
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.0 on 2026-10-18 19:53
+
+import applibs.fields
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # the snippets index is built without blocking writes to snippets
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('snippets', '0012_snippet_live_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSnippet',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=100)),
+                ('code', applibs.fields.CompressedTextField(blank=True, null=True)),
+                ('linenos', models.BooleanField(default=False)),
+                ('language', models.CharField(choices=[('python', 'Python'), ('c#', 'C#'), ('java', 'Java')], default='python', max_length=100)),
+                ('created', models.DateTimeField()),
+                ('modified', models.DateTimeField()),
+                ('status', models.BooleanField(default=False)),
+                ('archived', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Archived snippet',
+                'verbose_name_plural': 'Archived snippets',
+                'db_table': 'snippets_archive',
+                'ordering': ['created', 'id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SnippetArchiveCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_id', models.IntegerField(default=0)),
+                ('moved', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Snippet archive checkpoint',
+                'verbose_name_plural': 'Snippet archive checkpoints',
+                'db_table': 'snippet_archive_checkpoints',
+            },
+        ),
+        migrations.AddField(
+            model_name='archivedsnippet',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_snippets', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='archivedsnippet',
+            index=models.Index(fields=['created', 'id'], name='snippets_ar_created_72971a_idx'),
+        ),
+        # last, a failure leaves the new tables complete
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(status=False), fields=['id'], name='snippets_inactive_id_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+# Statement level, like the stats triggers: one insert per DELETE statement. clock_timestamp()
+# rather than now(), a long archive transaction must not date its tombstones at its start.
+TOMBSTONE_TRIGGER = """
+CREATE OR REPLACE FUNCTION snippet_tombstones_delete() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO snippet_tombstones (id, modified)
+    SELECT id, clock_timestamp() FROM old_rows ORDER BY id
+    ON CONFLICT (id) DO UPDATE SET modified = EXCLUDED.modified;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER snippet_tombstones_trigger AFTER DELETE ON snippets
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE snippet_tombstones_delete();
+"""
+
+DROP_TOMBSTONE_TRIGGER = """
+DROP TRIGGER IF EXISTS snippet_tombstones_trigger ON snippets;
+DROP FUNCTION IF EXISTS snippet_tombstones_delete();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0013_snippet_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetTombstone',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('modified', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Snippet tombstone',
+                'verbose_name_plural': 'Snippet tombstones',
+                'db_table': 'snippet_tombstones',
+                'ordering': ['modified', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='snippettombstone',
+            index=models.Index(fields=['modified', 'id'], name='snippet_tom_modifie_ecdbe8_idx'),
+        ),
+        migrations.RunSQL(TOMBSTONE_TRIGGER, DROP_TOMBSTONE_TRIGGER),
+    ]
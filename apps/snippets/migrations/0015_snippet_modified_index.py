@@ -0,0 +1,20 @@
+# Generated by Django 3.0 on 2026-10-18 20:24
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the index is built without blocking writes to snippets
+    atomic = False
+
+    dependencies = [
+        ('snippets', '0014_snippet_tombstones'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='snippet',
+            index=models.Index(fields=['modified', 'id'], name='snippets_modified_id_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0 on 2026-10-18 20:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0015_snippet_modified_index'),
+    ]
+
+    operations = [
+        # a constant default is stored in the catalog, existing rows are not rewritten
+        migrations.AddField(
+            model_name='snippet',
+            name='version',
+            field=models.IntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='archivedsnippet',
+            name='version',
+            field=models.IntegerField(default=1, editable=False),
+        ),
+        # django drops the column default again, the raw INSERTs of the bulk import need it
+        migrations.RunSQL(
+            "ALTER TABLE snippets ALTER COLUMN version SET DEFAULT 1",
+            "ALTER TABLE snippets ALTER COLUMN version DROP DEFAULT",
+        ),
+    ]
@@ -1,38 +1,74 @@
 from django.contrib.postgres.indexes import BrinIndex, GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.utils.encoding import smart_text as smart_unicode
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F, Q, Value
 from django.db.models.query import QuerySet
-from random import uniform
 
+from applibs.fields import CompressedTextField, should_compress
 from apps.users.models import User
 
 
+# postgres' name for the inline UNIQUE constraint of snippets.title
+TITLE_UNIQUE_CONSTRAINT = 'snippets_title_key'
+# a numbered title can still be taken by a legacy random suffix or by another base title,
+# e.g. "Hulk2" + "87" and "Hulk" + "287", the next number is tried then
+TITLE_ALLOCATION_ATTEMPTS = 10
+# snippets.title, the number appended to a new title included
+TITLE_MAX_LENGTH = 100
+NUMBERED_TITLE_TOO_LONG = "Ensure this field has no more than %d characters, its number included." % TITLE_MAX_LENGTH
+
+
+class TitleTooLong(ValueError):
+    """
+    A new title with its number does not fit snippets.title, the number grows with the base
+    title's sequence so the same base title can fit one day and not the next
+    """
+
+
+def is_title_conflict(exc):
+    """
+    :param exc: IntegrityError
+    :return: True if `exc` is a duplicate snippet title
+    """
+    diag = getattr(exc.__cause__, 'diag', None)
+    return diag is not None and diag.constraint_name == TITLE_UNIQUE_CONSTRAINT
+
+
+def code_search_vector(code):
+    """
+    The database trigger cannot read compressed code, the B weighted part of the search
+    vector is computed from the plain text and handed over with the row instead.
+    :param code: plain code about to be stored
+    :return: search vector expression, None when the code is stored uncompressed
+    """
+    if not should_compress(code):
+        return None
+    return SearchVector(Value(code, output_field=models.TextField()), config='simple', weight='B')
+
+
 class SnippetQuerySet(QuerySet):
 
     def live(self):
+        """
+        Active snippets, served by the partial `WHERE status` indexes
+        """
         return self.filter(status=True)
 
     def get_target_hulk(self):
         return self.filter(title="Hulk287")
 
 
-class SnippetManager(models.Manager):
+class SnippetManager(models.Manager.from_queryset(SnippetQuerySet)):
 
-    def get_query_set(self):
-        return SnippetQuerySet(self.model)
-
-    def __getattr__(self, attr, *args):
-        if attr.startswith("_"):
-            raise AttributeError
-        return getattr(self.get_query_set(), attr, *args)
+    def get_queryset(self):
+        # code can be hundreds of KB and is not part of the API representation
+        return super().get_queryset().defer('code')
 
     def create_snippet(self, *args, **kwargs):
-        snippet = Snippet()
-        snippet.title = kwargs.get("title")
-        snippet.owner_id = kwargs.get("owner_id")
-        Snippet.objects.create(snippet)
+        return self.create(title=kwargs.get("title"), owner_id=kwargs.get("owner_id"))
 
     def update_snippet(self, *args, **kwargs):
         print(kwargs)
@@ -42,6 +78,54 @@ class SnippetManager(models.Manager):
         # snippet.save()
 
 
+class TitleSequenceManager(models.Manager):
+
+    def allocate(self, counts):
+        """
+        Reserve title suffixes for many base titles with a single upsert. Concurrent
+        callers of the same base title queue on its row lock and get distinct numbers.
+        :param counts: {base title: number of suffixes}
+        :return: {base title: list of suffixes}
+        """
+        if not counts:
+            return {}
+        # rows are locked in one order, two batches cannot deadlock each other
+        base_titles = sorted(counts)
+        table = connections[router.db_for_write(self.model)].ops.quote_name(self.model._meta.db_table)
+        sql = (
+            "INSERT INTO {table} (base_title, last_value) VALUES {values} "
+            "ON CONFLICT (base_title) DO UPDATE SET last_value = {table}.last_value + EXCLUDED.last_value "
+            "RETURNING base_title, last_value"
+        ).format(table=table, values=", ".join(["(%s, %s)"] * len(base_titles)))
+        params = [value for base_title in base_titles for value in (base_title, counts[base_title])]
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        return {
+            base_title: [str(value) for value in range(last_value - counts[base_title] + 1, last_value + 1)]
+            for base_title, last_value in rows
+        }
+
+
+class SnippetTitleSequence(models.Model):
+    """
+    Last number appended to a base title, see Snippet.save()
+    """
+    base_title = models.CharField(max_length=TITLE_MAX_LENGTH, primary_key=True)
+    last_value = models.BigIntegerField(default=0)
+
+    objects = TitleSequenceManager()
+
+    class Meta:
+        db_table = 'snippet_title_sequences'
+        app_label = 'snippets'
+        verbose_name = _("Snippet title sequence")
+        verbose_name_plural = _("Snippet title sequences")
+
+    def __str__(self):
+        return "%s%s" % (self.base_title, self.last_value)
+
+
 class Snippet(models.Model):
     LANGUAGE_CHOICES = (
         ('python', 'Python'),
@@ -49,22 +133,37 @@ class Snippet(models.Model):
         ('java', 'Java'),
     )
 
-    title = models.CharField(max_length=100, unique=True)
+    title = models.CharField(max_length=TITLE_MAX_LENGTH, unique=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='snippet_owner')
-    code = models.TextField(blank=True, null=True)
+    code = CompressedTextField(blank=True, null=True)
     linenos = models.BooleanField(default=False)
     language = models.CharField(choices=LANGUAGE_CHOICES, default='python', max_length=100)
     created = models.DateTimeField(editable=False)
     modified = models.DateTimeField()
     status = models.BooleanField(default=True)
+    # maintained by the snippets_search_vector_trigger database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
+    # bumped by every write, optimistic concurrency control of partial updates (If-Match)
+    version = models.IntegerField(default=1, editable=False)
 
     objects = SnippetManager()
 
     class Meta:
-        ordering = ['created']
+        ordering = ['created', 'id']
         indexes = [
             BrinIndex(fields=['id']),
             GinIndex(fields=['title']),
+            # keyset pagination: (created, id) is the cursor of ?type=all
+            models.Index(fields=['created', 'id']),
+            GinIndex(fields=['search_vector']),
+            # SnippetQuerySet.live(): only active rows are indexed, the indexes stay small
+            models.Index(fields=['id'], name='snippets_live_id_idx', condition=Q(status=True)),
+            models.Index(fields=['owner'], name='snippets_live_owner_idx', condition=Q(status=True)),
+            models.Index(fields=['created', 'id'], name='snippets_live_created_idx', condition=Q(status=True)),
+            # archive_snippets walks the inactive rows by id
+            models.Index(fields=['id'], name='snippets_inactive_id_idx', condition=Q(status=False)),
+            # changes feed: (modified, id) is its cursor
+            models.Index(fields=['modified', 'id'], name='snippets_modified_id_idx'),
         ]
         db_table = 'snippets'
         app_label = 'snippets'
@@ -79,7 +178,144 @@ class Snippet(models.Model):
 
     def save(self, *args, **kwargs):
         if self.pk is None:
-            self.title = self.title + str(int(uniform(1, 10000)))
             self.created = timezone.now()
         self.modified = timezone.now()
-        super(Snippet, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        search_vector = code_search_vector(self.__dict__.get('code'))
+        if search_vector is not None and (update_fields is None or 'code' in update_fields):
+            self.search_vector = search_vector
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'search_vector'}
+        if self.pk is not None and self._state.adding:
+            return super(Snippet, self).save(*args, **kwargs)
+        if self.pk is not None:
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'version'}
+            super(Snippet, self).save(*args, **kwargs)
+            # deferred, the new value is read back on access
+            del self.version
+            return
+
+        # new snippet: the title gets the next number of its base title
+        base_title = self.title
+        for attempt in range(1, TITLE_ALLOCATION_ATTEMPTS + 1):
+            self.title = base_title + SnippetTitleSequence.objects.allocate({base_title: 1})[base_title][0]
+            if len(self.title) > TITLE_MAX_LENGTH:
+                self.title = base_title
+                raise TitleTooLong(NUMBERED_TITLE_TOO_LONG)
+            try:
+                # the savepoint keeps an outer transaction usable after a conflict
+                with transaction.atomic(using=kwargs.get('using')):
+                    return super(Snippet, self).save(*args, **kwargs)
+            except IntegrityError as exc:
+                if not is_title_conflict(exc) or attempt == TITLE_ALLOCATION_ATTEMPTS:
+                    self.title = base_title
+                    raise
+
+
+class SnippetStat(models.Model):
+    """
+    Snippet counts per language and per owner, maintained by the snippet_stats_* statement
+    triggers (migration 0011) and repaired by the reconcile_snippet_stats command.
+    A group's row is locked by every write to it until that transaction commits: concurrent
+    writers of the same language or owner are serialized on it.
+    """
+    LANGUAGE = 'language'
+    OWNER = 'owner'
+    DIMENSION_CHOICES = (
+        (LANGUAGE, 'Language'),
+        (OWNER, 'Owner'),
+    )
+
+    dimension = models.CharField(choices=DIMENSION_CHOICES, max_length=16)
+    # the language code or the owner id
+    value = models.CharField(max_length=100)
+    total = models.BigIntegerField(default=0)
+    active = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'snippet_stats'
+        app_label = 'snippets'
+        unique_together = (('dimension', 'value'),)
+        verbose_name = _("Snippet stat")
+        verbose_name_plural = _("Snippet stats")
+
+    def __str__(self):
+        return "%s %s: %d" % (self.dimension, self.value, self.total)
+
+
+class ArchivedSnippet(models.Model):
+    """
+    Inactive snippets moved out of the hot table by the archive_snippets command.
+    Same columns as Snippet minus the search vector, the id is kept.
+    """
+    id = models.IntegerField(primary_key=True)
+    title = models.CharField(max_length=TITLE_MAX_LENGTH)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_snippets')
+    code = CompressedTextField(blank=True, null=True)
+    linenos = models.BooleanField(default=False)
+    language = models.CharField(choices=Snippet.LANGUAGE_CHOICES, default='python', max_length=100)
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+    status = models.BooleanField(default=False)
+    version = models.IntegerField(default=1, editable=False)
+    archived = models.DateTimeField()
+
+    class Meta:
+        ordering = ['created', 'id']
+        indexes = [
+            models.Index(fields=['created', 'id']),
+        ]
+        db_table = 'snippets_archive'
+        app_label = 'snippets'
+        verbose_name = _("Archived snippet")
+        verbose_name_plural = _("Archived snippets")
+
+    def __str__(self):
+        return self.title
+
+
+class SnippetArchiveCheckpoint(models.Model):
+    """
+    Progress of an archive_snippets run, the last moved id is committed with every batch
+    so an interrupted run resumes where it stopped
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.IntegerField(default=0)
+    moved = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'snippet_archive_checkpoints'
+        app_label = 'snippets'
+        verbose_name = _("Snippet archive checkpoint")
+        verbose_name_plural = _("Snippet archive checkpoints")
+
+    def __str__(self):
+        return "%s: %d" % (self.name, self.last_id)
+
+
+class SnippetTombstone(models.Model):
+    """
+    Ids of deleted snippets, archived ones included, for the changes feed. Written by the
+    snippet_tombstones_trigger database trigger (migration 0014), whatever deletes the row.
+    Kept SNIPPET_TOMBSTONE_RETENTION_DAYS, then removed by the prune_snippet_tombstones command.
+    """
+    id = models.IntegerField(primary_key=True)
+    # deletion time on the database clock, Snippet.modified is set on the application's:
+    # SNIPPET_CHANGES_SETTLE_SECONDS has to cover the skew between the two
+    modified = models.DateTimeField()
+
+    class Meta:
+        ordering = ['modified', 'id']
+        indexes = [
+            models.Index(fields=['modified', 'id']),
+        ]
+        db_table = 'snippet_tombstones'
+        app_label = 'snippets'
+        verbose_name = _("Snippet tombstone")
+        verbose_name_plural = _("Snippet tombstones")
+
+    def __str__(self):
+        return str(self.id)
@@ -1,5 +1,17 @@
+from threading import Lock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
 from rest_framework import serializers
-from .models import Snippet, User
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from .models import TITLE_MAX_LENGTH, Snippet, TitleTooLong, User
+
+# Fields whose to_representation() returns the database value unchanged
+IDENTITY_FIELDS = (
+    serializers.IntegerField, serializers.CharField, serializers.BooleanField,
+    serializers.ChoiceField, PrimaryKeyRelatedField,
+)
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -15,5 +27,166 @@ class SnippetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Snippet
-        fields = ('id', 'title', 'owner', 'owner_id', 'status',)
+        fields = ('id', 'title', 'owner', 'owner_id', 'status', 'version',)
         # extra_fields = ["owner_id"]
+        # room for at least one digit of the number appended to new titles
+        extra_kwargs = {'title': {'max_length': TITLE_MAX_LENGTH - 1}}
+
+    def create(self, validated_data):
+        try:
+            return super().create(validated_data)
+        except TitleTooLong as exc:
+            raise serializers.ValidationError({"title": [str(exc)]})
+
+
+def _compile_fields(serializer, prefix, columns, converters, fields=None):
+    """
+    Collect the values_list() columns of every readable field of `serializer`, or of the
+    readable `fields` only, and return the source of a dict literal building its
+    representation from a row tuple.
+    """
+    model = serializer.Meta.model
+    items = []
+    for field_name, field in serializer.fields.items():
+        if field.write_only or (fields is not None and field_name not in fields):
+            continue
+        if field.source == '*' or len(field.source_attrs) != 1:
+            raise ImproperlyConfigured(
+                "%s.%s: only plain model attributes can be compiled" % (serializer.__class__.__name__, field_name)
+            )
+
+        if isinstance(field, serializers.ModelSerializer):
+            model_field = model._meta.get_field(field.source)
+            nested = _compile_fields(field, prefix + field.source + '__', columns, converters)
+            if model_field.null:
+                # the foreign key itself tells whether the nested object exists
+                columns.append(prefix + field.source)
+                nested = '(%s if row[%d] is not None else None)' % (nested, len(columns) - 1)
+            items.append('%r: %s' % (field_name, nested))
+            continue
+        if isinstance(field, serializers.BaseSerializer):
+            raise ImproperlyConfigured(
+                "%s.%s: only nested ModelSerializer fields can be compiled" % (serializer.__class__.__name__, field_name)
+            )
+
+        columns.append(prefix + field.source)
+        index = len(columns) - 1
+        if isinstance(field, IDENTITY_FIELDS):
+            items.append('%r: row[%d]' % (field_name, index))
+        else:
+            converters['convert_%d' % index] = field.to_representation
+            items.append('%r: (convert_%d(row[%d]) if row[%d] is not None else None)' % (field_name, index, index, index))
+    return '{%s}' % ', '.join(items)
+
+
+def compile_read_serializer(serializer_class, fields=None):
+    """
+    Generate a flat function turning one values_list() row into the same representation
+    `serializer_class(instance).data` gives, nested serializers included.
+    :param serializer_class: ModelSerializer subclass
+    :param fields: top level field names to keep, None for all
+    :return: (columns for values_list(), row -> dict function)
+    """
+    columns, converters = [], {}
+    source = 'def to_representation(row):\n    return %s\n' % _compile_fields(
+        serializer_class(), '', columns, converters, fields
+    )
+    namespace = dict(converters)
+    exec(compile(source, '<%s.to_representation>' % serializer_class.__name__, 'exec'), namespace)
+    return tuple(columns), namespace['to_representation']
+
+
+class CompiledReadSerializer(object):
+    """
+    Read only fast path of a ModelSerializer, working on values_list() tuples instead of
+    model instances. Rows may carry extra trailing columns, e.g. the pagination keys.
+    subset() compiles sparse fieldsets, which only select their own columns and joins.
+    """
+
+    def __init__(self, serializer_class, fields=None):
+        self.serializer_class = serializer_class
+        self.fields = fields
+        self.columns, self.to_representation = compile_read_serializer(serializer_class, fields)
+        # relations traversed by the nested serializers, e.g. ('owner',)
+        self.related = tuple(sorted({column.rsplit('__', 1)[0] for column in self.columns if '__' in column}))
+        self._subsets = {}
+        self._lock = Lock()
+
+    @cached_property
+    def readable_fields(self):
+        return tuple(name for name, field in self.serializer_class().fields.items() if not field.write_only)
+
+    def subset(self, fields):
+        """
+        Compiled serializer of some of the top level fields, compiled once per subset
+        :param fields: iterable of field names
+        :return: CompiledReadSerializer, self when every readable field is asked for
+        :raises ValueError: unknown or write only field
+        """
+        fields = frozenset(fields)
+        unknown = fields.difference(self.readable_fields)
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+        if fields == frozenset(self.readable_fields):
+            return self
+        with self._lock:
+            if fields not in self._subsets:
+                self._subsets[fields] = CompiledReadSerializer(self.serializer_class, fields)
+            return self._subsets[fields]
+
+    def prepare_queryset(self, queryset):
+        """
+        Join the nested relations and load only the columns the serializer reads, for paths
+        that still need model instances (object permissions, updates)
+        """
+        return queryset.select_related(*self.related).only(*self.columns)
+
+    def values_list(self, queryset, *extra_columns, **kwargs):
+        """
+        :return: queryset of rows, the compiled columns first then `extra_columns`
+        """
+        extra_columns = [column for column in extra_columns if column not in self.columns]
+        return queryset.values_list(*self.columns, *extra_columns, **kwargs)
+
+    def serialize(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+
+class SnippetBulkCreateSerializer(serializers.Serializer):
+    """
+    Validates one row of a bulk create request without touching the database,
+    owners are resolved for the whole batch at once.
+    """
+    # room for at least one digit, the numbered title is checked once its number is known
+    title = serializers.CharField(max_length=TITLE_MAX_LENGTH - 1)
+    owner_id = serializers.IntegerField(min_value=1)
+    code = serializers.CharField(required=False, allow_blank=True, allow_null=True, trim_whitespace=False)
+    linenos = serializers.BooleanField(required=False, default=False)
+    language = serializers.ChoiceField(choices=Snippet.LANGUAGE_CHOICES, required=False, default='python')
+    status = serializers.BooleanField(required=False, default=True)
+
+
+class SnippetBulkUpdateSerializer(serializers.Serializer):
+    """
+    Validates one row of a bulk partial update, only the given fields are changed.
+    """
+    id = serializers.IntegerField(min_value=1)
+    title = serializers.CharField(max_length=TITLE_MAX_LENGTH, required=False)
+    code = serializers.CharField(required=False, allow_blank=True, allow_null=True, trim_whitespace=False)
+    linenos = serializers.BooleanField(required=False)
+    language = serializers.ChoiceField(choices=Snippet.LANGUAGE_CHOICES, required=False)
+    status = serializers.BooleanField(required=False)
+
+
+class SnippetUpdateSerializer(serializers.Serializer):
+    """
+    Validates a partial update without touching the database, title uniqueness and the
+    owner are enforced by the constraints hit by the conditional UPDATE.
+    """
+    title = serializers.CharField(max_length=TITLE_MAX_LENGTH, required=False)
+    owner_id = serializers.IntegerField(min_value=1, required=False)
+    status = serializers.BooleanField(required=False)
+
+
+FAST_SNIPPET_SERIALIZER = CompiledReadSerializer(SnippetSerializer)
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from apps.snippets.cache import snippet_response_cache
+from apps.snippets.highlight import prerender_snippet
+from apps.snippets.models import Snippet, User
+
+# Sent by the bulk write paths, which bypass the model save/delete signals.
+snippets_bulk_changed = Signal(providing_args=["ids"])
+
+
+def invalidate_snippets(snippet_ids):
+    """
+    Drop cached responses now and once more after commit, so that a concurrent request
+    cannot re-cache the pre-commit row for the whole cache timeout.
+    """
+    snippet_ids = list(snippet_ids)
+    snippet_response_cache.invalidate(snippet_ids)
+    transaction.on_commit(lambda: snippet_response_cache.invalidate(snippet_ids))
+
+
+@receiver(post_save, sender=Snippet)
+@receiver(post_delete, sender=Snippet)
+def invalidate_snippet(sender, instance, **kwargs):
+    invalidate_snippets([instance.pk])
+
+
+@receiver(post_save, sender=Snippet)
+def prerender_snippet_highlight(sender, instance, **kwargs):
+    """
+    Highlight in the background once the row is committed, see SNIPPET_HIGHLIGHT_ON_SAVE
+    """
+    if getattr(settings, 'SNIPPET_HIGHLIGHT_ON_SAVE', False) and instance.status:
+        transaction.on_commit(lambda: prerender_snippet(instance))
+
+
+@receiver(snippets_bulk_changed)
+def invalidate_bulk_snippets(sender, ids, **kwargs):
+    invalidate_snippets(ids)
+
+
+@receiver(post_save, sender=User)
+def invalidate_owner_snippets(sender, instance, created, update_fields=None, **kwargs):
+    """
+    The owner username is part of every snippet payload
+    """
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    invalidate_snippets(Snippet.objects.filter(owner_id=instance.pk).order_by().values_list('id', flat=True))
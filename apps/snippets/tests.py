@@ -1,11 +1,52 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from threading import Barrier, BoundedSemaphore, Thread, Timer
+from unittest import mock, skipUnless
+
+import psycopg2
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.core.management import call_command
 from django.urls import reverse
-from django.test import TestCase
-from rest_framework import status
+from django.conf import settings
+from django.db import connection, connections, router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers, status
 from rest_framework.test import APIClient
-from .models import Snippet, User
-from .serializers import SnippetSerializer
+from rest_framework_jwt.settings import api_settings
+from applibs.counting import count_rows
+from applibs.fields import is_compressed
+from applibs.highlighting import HighlightPoolBusy, HighlightTimeout, render_html
+from applibs.pagination import ApproximateCountPaginator, keyset_filter
+from applibs.pooled_postgresql.pool import ConnectionPool, PoolTimeout
+from applibs.replicas import ReplicaStickinessMiddleware, use_primary
+from applibs.streaming import copy_stream
+from .models import (
+    ArchivedSnippet, Snippet, SnippetArchiveCheckpoint, SnippetStat, SnippetTitleSequence, SnippetTombstone, User,
+)
+from api.async_urls import async_endpoints
+from cores.async_views import AsyncAPIRouter, StreamingASGIHandler, database_executor, stream_executor
+from cores.query_budget import QueryBudgetExceeded
+from .cache import snippet_response_cache
+from .highlight import highlight_pool, prerender_snippet
+from .serializers import CompiledReadSerializer, FAST_SNIPPET_SERIALIZER, SnippetSerializer, UserSerializer
+from .views import SnippetView
+from .utils import (
+    autocomplete_titles, bulk_update_snippets, clear_autocomplete_cache, get_list_queryset, import_snippets,
+    snippet_export_sql,
+)
 
-SNIPPETS_URL = reverse('django_everything:snippets')
+SNIPPETS_URL = reverse('django_everything:snippet-list')
 
 
 class SnippetViewApiTestCase(TestCase):
@@ -20,13 +61,1522 @@ class SnippetViewApiTestCase(TestCase):
     def test_retrieve_snippet_list(self):
         Snippet.objects.create(title='Motu', owner_id=self.user.id)
         Snippet.objects.create(title='Patlu', owner_id=self.user.id)
-        snippet_motu = Snippet.objects.get(title='Motu')
-        snippet_patlu = Snippet.objects.get(title='Patlu')
-        self.assertEqual(snippet_motu.get_snippet_detail(), "Motu belongs to python.")
-        self.assertEqual(snippet_patlu.get_snippet_detail(), "Patlu belongs to python.")
+        self.assertTrue(Snippet.objects.get(title__startswith='Motu').title.startswith("Motu"))
+        self.assertTrue(Snippet.objects.get(title__startswith='Patlu').title.startswith("Patlu"))
 
         res = self.client.get(SNIPPETS_URL)
-        snippets = Snippet.objects.all().order_by('-title')
+        snippets = Snippet.objects.all().order_by('created', 'id')
         serializer = SnippetSerializer(snippets, many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data["results"], serializer.data)
+        self.assertIsNone(res.data["next"])
+        self.assertIsNone(res.data["previous"])
+
+
+class SnippetKeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("pager", "pager")
+        self.client.force_authenticate(self.user)
+        for index in range(7):
+            Snippet.objects.create(title='Page', owner_id=self.user.id, status=index != 3)
+
+    def collect(self, url):
+        ids = []
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            ids += [row["id"] for row in res.data["results"]]
+            url = res.data["next"]
+        return ids
+
+    def test_walks_active_snippets_in_created_id_order(self):
+        ids = self.collect(SNIPPETS_URL + "?page_size=2")
+        expected = list(Snippet.objects.filter(status=True).order_by('created', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_type_all_includes_inactive(self):
+        ids = self.collect(SNIPPETS_URL + "?type=all&page_size=3")
+        self.assertEqual(ids, list(Snippet.objects.order_by('created', 'id').values_list('id', flat=True)))
+
+    def test_previous_link_returns_previous_page(self):
+        first = self.client.get(SNIPPETS_URL + "?page_size=2")
+        second = self.client.get(first.data["next"])
+        previous = self.client.get(second.data["previous"])
+        self.assertEqual(previous.data["results"], first.data["results"])
+
+    def test_invalid_cursor_and_type(self):
+        self.assertEqual(self.client.get(SNIPPETS_URL + "?cursor=bogus").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(SNIPPETS_URL + "?type=unknown").status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnippetStreamTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("streamer", "streamer")
+        self.client.force_authenticate(self.user)
+        for index in range(5):
+            Snippet.objects.create(title='Stream', owner_id=self.user.id, status=index != 0)
+        self.expected = SnippetSerializer(Snippet.objects.order_by('created', 'id'), many=True).data
+
+    def test_ndjson_stream(self):
+        res = self.client.get(SNIPPETS_URL + "?type=all&stream=ndjson")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["Content-Type"], "application/x-ndjson")
+        body = b"".join(res.streaming_content).decode()
+        self.assertEqual([json.loads(line) for line in body.splitlines()], self.expected)
+
+    def test_json_array_stream(self):
+        res = self.client.get(SNIPPETS_URL + "?stream=json")
+        body = b"".join(res.streaming_content).decode()
+        self.assertEqual(json.loads(body), self.expected[1:])
+
+    def test_unknown_stream_format(self):
+        res = self.client.get(SNIPPETS_URL + "?stream=xml")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnippetSearchTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("searcher", "searcher")
+        self.client.force_authenticate(self.user)
+        self.in_title = Snippet.objects.create(title='Quicksort', code="def sort(items): pass", owner_id=self.user.id)
+        self.in_code = Snippet.objects.create(title='Helpers', code="quicksort(items)", owner_id=self.user.id)
+        Snippet.objects.create(title='Hidden', code="quicksort", owner_id=self.user.id, status=False)
+
+    def test_search_vector_is_maintained(self):
+        self.in_code.code = "bubble(items)"
+        self.in_code.save()
+        snippets = Snippet.objects.filter(id=self.in_code.id)
+        self.assertFalse(snippets.filter(search_vector=SearchQuery("quicksort", config='simple')).exists())
+        self.assertTrue(snippets.filter(search_vector=SearchQuery("bubble", config='simple')).exists())
+
+    def test_search_ranks_title_above_code(self):
+        self.in_title.title = "quicksort"
+        self.in_title.save()
+        res = self.client.get(reverse('django_everything:snippet-search'), {"q": "quicksort"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["count"], 2)
+        self.assertEqual([row["id"] for row in res.data["results"]], [self.in_title.id, self.in_code.id])
+        self.assertGreater(res.data["results"][0]["rank"], res.data["results"][1]["rank"])
+
+    def test_search_requires_query(self):
+        res = self.client.get(reverse('django_everything:snippet-search'))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnippetAutocompleteTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("typist", "typist")
+        self.client.force_authenticate(self.user)
+        for title in ("Motu", "motor", "Mouse", "Patlu"):
+            Snippet.objects.create(title=title, owner_id=self.user.id)
+        Snippet.objects.create(title="Motion", owner_id=self.user.id, status=False)
+        clear_autocomplete_cache()
+        self.url = reverse('django_everything:snippet-autocomplete')
+
+    def test_case_insensitive_prefix(self):
+        res = self.client.get(self.url, {"q": "MOT"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([title.rstrip("0123456789") for title in res.data["results"]], ["motor", "Motu"])
+
+    def test_limit_and_cache(self):
+        res = self.client.get(self.url, {"q": "mo", "limit": 1})
+        self.assertEqual(len(res.data["results"]), 1)
+        Snippet.objects.filter(title__istartswith="mo").update(status=False)
+        with self.assertNumQueries(0):
+            cached = autocomplete_titles("MO", 1)
+        self.assertEqual(cached, res.data["results"])
+
+    def test_empty_prefix(self):
+        self.assertEqual(self.client.get(self.url).data["results"], [])
+
+
+class SnippetBulkCreateTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("importer", "importer")
+        self.client.force_authenticate(self.user)
+        self.url = reverse('django_everything:snippet-bulk-create')
+
+    def test_bulk_create_json_array(self):
+        rows = [{"title": "Bulk", "owner_id": self.user.id, "code": "x = %d" % index} for index in range(5)]
+        rows.append({"title": "Broken", "owner_id": self.user.id, "language": "cobol"})
+        rows.append({"title": "Orphan", "owner_id": self.user.id + 1000})
+        # owner lookup, title sequence upsert, title collision check, insert
+        with self.assertNumQueries(4):
+            res = self.client.post(self.url, rows, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data["created"]), 5)
+        self.assertEqual([error["index"] for error in res.data["errors"]], [5, 6])
+        self.assertIn("language", res.data["errors"][0]["errors"])
+        self.assertIn("owner_id", res.data["errors"][1]["errors"])
+
+        snippets = Snippet.objects.filter(id__in=res.data["created"])
+        self.assertEqual(len({snippet.title for snippet in snippets}), 5)
+        for snippet in snippets:
+            self.assertTrue(snippet.title.startswith("Bulk"))
+            self.assertIsNotNone(snippet.created)
+            self.assertEqual(snippet.created, snippet.modified)
+
+    def test_bulk_create_ndjson(self):
+        body = "\n".join(json.dumps({"title": "Line", "owner_id": self.user.id}) for _ in range(3))
+        res = self.client.post(self.url, body, content_type="application/x-ndjson")
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Snippet.objects.filter(title__startswith="Line").count(), 3)
+
+    def test_bulk_create_rejects_non_list(self):
+        res = self.client.post(self.url, {"title": "One"}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnippetNumberedTitleLengthTestCase(TransactionTestCase):
+    """
+    A base title that fits with a 4 digit number overflows once its sequence passes 9999.
+    Creates run in autocommit, without the savepoint a TestCase adds to the create budget.
+    """
+    databases = '__all__'
+    LONG = "L" * 96
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("numbered", "numbered")
+        self.client.force_authenticate(self.user)
+        SnippetTitleSequence.objects.create(base_title=self.LONG, last_value=9999)
+        SnippetTitleSequence.objects.create(base_title=self.LONG[:-1], last_value=9999)
+
+    def test_create(self):
+        res = self.client.post(SNIPPETS_URL, {"title": self.LONG, "owner_id": self.user.id}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("title", res.data)
+        res = self.client.post(SNIPPETS_URL, {"title": self.LONG[:-1], "owner_id": self.user.id}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data["title"], self.LONG[:-1] + "10000")
+        # a single digit number still fits
+        res = self.client.post(SNIPPETS_URL, {"title": "N" * 99, "owner_id": self.user.id}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    def test_bulk_create(self):
+        rows = [{"title": self.LONG, "owner_id": self.user.id}, {"title": self.LONG[:-1], "owner_id": self.user.id}]
+        res = self.client.post(reverse('django_everything:snippet-bulk-create'), rows, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data["created"]), 1)
+        self.assertEqual([(error["index"], list(error["errors"])) for error in res.data["errors"]], [(0, ["title"])])
+
+    def test_import(self):
+        rejects = io.BytesIO()
+        source = io.BytesIO(("title,owner_id\n%s,%d\n%s,%d\n" % (
+            self.LONG, self.user.id, self.LONG[:-1], self.user.id)).encode())
+        self.assertEqual(import_snippets(source, "csv", rejects), (1, 1))
+        self.assertEqual(next(csv.DictReader(io.StringIO(rejects.getvalue().decode())))["error"], "title too long")
+
+
+class SnippetBulkUpdateTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("editor", "editor")
+        self.other = User.objects.create_user("other", "other")
+        self.client.force_authenticate(self.user)
+        self.snippets = [Snippet.objects.create(title='Mine', owner_id=self.user.id) for _ in range(3)]
+        self.foreign = Snippet.objects.create(title='Theirs', owner_id=self.other.id)
+        self.url = reverse('django_everything:snippet-bulk-create')
+
+    def test_bulk_partial_update(self):
+        first, second, third = self.snippets
+        rows = [
+            {"id": first.id, "status": False},
+            {"id": second.id, "status": False},
+            {"id": third.id, "title": "Renamed"},
+            {"id": third.id + 1000, "status": False},
+            {"id": first.id, "language": "java"},
+        ]
+        # ownership lookup, one UPDATE per changed field set (+ savepoint)
+        with self.assertNumQueries(5):
+            res = self.client.patch(self.url, rows, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["updated"], [first.id, second.id, third.id])
+        self.assertEqual([error["index"] for error in res.data["errors"]], [3, 4])
+
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertFalse(first.status)
+        self.assertEqual(first.language, "python")
+        self.assertGreater(first.modified, self.snippets[0].created)
+        self.assertEqual(third.title, "Renamed")
+        self.assertTrue(third.status)
+
+    def test_bulk_partial_update_checks_ownership(self):
+        rows = [{"id": self.snippets[0].id, "status": False}, {"id": self.foreign.id, "status": False}]
+        res = self.client.patch(self.url, rows, format='json')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertTrue(Snippet.objects.get(id=self.snippets[0].id).status)
+
+    def test_bulk_partial_update_title_conflict(self):
+        rows = [{"id": self.snippets[0].id, "title": self.foreign.title}]
+        res = self.client.patch(self.url, rows, format='json')
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+
+class TimestampedSnippetSerializer(serializers.ModelSerializer):
+    owner = UserSerializer(read_only=True)
+
+    class Meta:
+        model = Snippet
+        fields = ('id', 'title', 'owner', 'language', 'linenos', 'created', 'modified', 'status',)
+
+
+class CompiledReadSerializerTestCase(TestCase):
+
+    def setUp(self):
+        users = [User.objects.create_user(name, name) for name in ("ada", "grace", "আমি")]
+        for index in range(12):
+            Snippet.objects.create(
+                title='Fast éè %d' % index, owner_id=users[index % 3].id, code="" if index % 4 else None,
+                language=Snippet.LANGUAGE_CHOICES[index % 3][0], linenos=bool(index % 2), status=index % 5 != 0,
+            )
+        self.queryset = Snippet.objects.order_by('created', 'id')
+
+    def test_columns_follow_declared_fields(self):
+        self.assertEqual(
+            FAST_SNIPPET_SERIALIZER.columns, ('id', 'title', 'owner__id', 'owner__username', 'status', 'version')
+        )
+
+    def test_matches_snippet_serializer(self):
+        rows = FAST_SNIPPET_SERIALIZER.values_list(self.queryset)
+        self.assertEqual(FAST_SNIPPET_SERIALIZER.serialize(rows), SnippetSerializer(self.queryset, many=True).data)
+        for snippet in self.queryset:
+            row = FAST_SNIPPET_SERIALIZER.values_list(Snippet.objects.filter(id=snippet.id)).get()
+            self.assertEqual(FAST_SNIPPET_SERIALIZER.to_representation(row), SnippetSerializer(snippet).data)
+
+    def test_converts_non_identity_fields(self):
+        fast = CompiledReadSerializer(TimestampedSnippetSerializer)
+        rows = fast.values_list(self.queryset, 'code', named=True)
+        self.assertEqual(fast.serialize(rows), TimestampedSnippetSerializer(self.queryset, many=True).data)
+
+    def test_matches_nested_user_serializer(self):
+        users = User.objects.order_by('id')
+        fast = CompiledReadSerializer(UserSerializer)
+        self.assertEqual(fast.serialize(fast.values_list(users)), UserSerializer(users, many=True).data)
+
+    def test_rejects_method_fields(self):
+        class MethodSerializer(serializers.ModelSerializer):
+            detail = serializers.SerializerMethodField()
+
+            class Meta:
+                model = Snippet
+                fields = ('id', 'detail',)
+
+        with self.assertRaises(ImproperlyConfigured):
+            CompiledReadSerializer(MethodSerializer)
+
+    def test_list_and_retrieve_use_compiled_rows(self):
+        client = APIClient()
+        res = client.get(SNIPPETS_URL + "?type=all&page_size=100")
+        self.assertEqual(res.data["results"], SnippetSerializer(self.queryset, many=True).data)
+        snippet = self.queryset.filter(status=True).first()
+        res = client.get(reverse('django_everything:snippet-detail', args=[snippet.id]))
+        self.assertEqual(res.json(), [SnippetSerializer(snippet).data])
+
+
+@override_settings(QUERY_BUDGET_ENFORCE=True)
+class SnippetQueryBudgetTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("budget", "budget")
+        self.client.force_authenticate(self.user)
+        self.snippets = [Snippet.objects.create(title='Budget', owner_id=self.user.id) for _ in range(20)]
+
+    def test_reads_stay_within_budget(self):
+        self.assertEqual(self.client.get(SNIPPETS_URL + "?page_size=20").status_code, status.HTTP_200_OK)
+        detail = reverse('django_everything:snippet-detail', args=[self.snippets[0].id])
+        self.assertEqual(self.client.get(detail).status_code, status.HTTP_200_OK)
+
+    def test_partial_update_joins_owner(self):
+        detail = reverse('django_everything:snippet-detail', args=[self.snippets[0].id])
+        # a single UPDATE .. RETURNING with the owner username
+        with self.assertNumQueries(1):
+            res = self.client.patch(detail, {"title": "Joined"}, format='json')
+        self.assertEqual(res.data["owner"], {"id": self.user.id, "username": "budget"})
+
+    def test_regression_fails_loudly(self):
+        with mock.patch.object(SnippetView, 'query_budget', {"list": 0}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(SNIPPETS_URL)
+
+
+class SnippetResponseCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        snippet_response_cache.reset_stats()
+        self.client = APIClient()
+        self.user = User.objects.create_user("cached", "cached")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Cached', owner_id=self.user.id)
+        self.url = reverse('django_everything:snippet-detail', args=[self.snippet.id])
+
+    def test_second_retrieve_is_served_from_cache(self):
+        first = self.client.get(self.url)
+        # only the conditional GET validator query, the body comes from the cache
+        with self.assertNumQueries(1):
+            second = self.client.get(self.url)
+        self.assertEqual((first["X-Cache"], second["X-Cache"]), ("MISS", "HIT"))
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(snippet_response_cache.stats()["hits"], 1)
+        self.assertEqual(snippet_response_cache.stats()["misses"], 1)
+
+    def test_snippet_save_invalidates(self):
+        self.client.get(self.url)
+        self.snippet.status = False
+        self.snippet.save()
+        res = self.client.get(self.url)
+        self.assertEqual((res["X-Cache"], res.json()), ("MISS", []))
+
+    def test_owner_rename_invalidates(self):
+        self.client.get(self.url)
+        self.user.last_login = self.snippet.created
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(self.client.get(self.url)["X-Cache"], "HIT")
+        self.user.username = "renamed"
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).json()[0]["owner"]["username"], "renamed")
+
+    def test_bulk_update_invalidates(self):
+        self.client.get(self.url)
+        self.client.patch(reverse('django_everything:snippet-bulk-create'), [{"id": self.snippet.id, "title": "Bulk"}],
+                          format='json')
+        self.assertEqual(self.client.get(self.url).json()[0]["title"], "Bulk")
+
+    def test_cache_stats_is_admin_only(self):
+        stats_url = reverse('django_everything:snippet-cache-stats')
+        self.assertEqual(self.client.get(stats_url).status_code, status.HTTP_403_FORBIDDEN)
+        self.user.is_admin = True
+        self.user.save()
+        self.assertEqual(self.client.get(stats_url).data["misses"], 0)
+
+
+class SnippetConditionalGetTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user("etag", "etag")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Tagged', owner_id=self.user.id)
+        self.url = reverse('django_everything:snippet-detail', args=[self.snippet.id])
+
+    def test_retrieve_not_modified(self):
+        first = self.client.get(self.url)
+        # a rename does not touch snippet.modified, If-Modified-Since cannot be answered
+        self.assertNotIn("Last-Modified", first)
+        with self.assertNumQueries(1):
+            res = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_retrieve_etag_changes_with_owner(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.user.username = "retagged"
+        self.user.save()
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res["ETag"], etag)
+
+    def test_list_not_modified_until_page_changes(self):
+        etag = self.client.get(SNIPPETS_URL)["ETag"]
+        self.assertEqual(self.client.get(SNIPPETS_URL, HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(SNIPPETS_URL + "?type=all", HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_200_OK)
+        self.snippet.title = "Retitled"
+        self.snippet.save()
+        self.assertEqual(self.client.get(SNIPPETS_URL, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_list_etag_changes_with_owner(self):
+        first = self.client.get(SNIPPETS_URL)
+        self.assertNotIn("Last-Modified", first)
+        self.user.username = "relisted"
+        self.user.save()
+        res = self.client.get(SNIPPETS_URL, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["results"][0]["owner"]["username"], "relisted")
+
+    def test_missing_snippet_has_no_validators(self):
+        res = self.client.get(reverse('django_everything:snippet-detail', args=[0]))
+        self.assertNotIn("ETag", res)
+
+
+@override_settings(TEXT_COMPRESSION_ENABLED=True, TEXT_COMPRESSION_MIN_LENGTH=64)
+class SnippetCodeCompressionTestCase(TestCase):
+    CODE = "def quicksort(items):\n    return sorted(items)\n" * 20
+
+    def setUp(self):
+        self.user = User.objects.create_user("packer", "packer")
+
+    def stored_code(self, snippet):
+        return Snippet.objects.filter(id=snippet.id).values_list('code', flat=True).get()
+
+    def matches(self, snippet, word):
+        return Snippet.objects.filter(id=snippet.id, search_vector=SearchQuery(word, config='simple')).exists()
+
+    def test_code_is_deferred(self):
+        snippet = Snippet.objects.create(title='Deferred', code=self.CODE, owner_id=self.user.id)
+        loaded = Snippet.objects.get(id=snippet.id)
+        self.assertEqual(loaded.get_deferred_fields(), {'code'})
+        with self.assertNumQueries(1):
+            self.assertEqual(loaded.code, self.CODE)
+
+    def test_compressed_round_trip_is_lazy(self):
+        snippet = Snippet.objects.create(title='Packed', code=self.CODE, owner_id=self.user.id)
+        self.assertTrue(is_compressed(self.stored_code(snippet)))
+        self.assertLess(len(self.stored_code(snippet)), len(self.CODE))
+        loaded = Snippet.objects.defer(None).get(id=snippet.id)
+        self.assertTrue(is_compressed(loaded.__dict__["code"]))
+        self.assertEqual(loaded.code, self.CODE)
+        short = Snippet.objects.create(title='Short', code="print(1)", owner_id=self.user.id)
+        self.assertEqual(self.stored_code(short), "print(1)")
+
+    def test_search_covers_compressed_code(self):
+        snippet = Snippet.objects.create(title='Packed', code=self.CODE, owner_id=self.user.id)
+        self.assertTrue(self.matches(snippet, "quicksort"))
+        # title only update, the trigger keeps the code lexemes
+        snippet.title = "Renamed"
+        snippet.save()
+        self.assertTrue(self.matches(snippet, "quicksort"))
+        self.assertTrue(self.matches(snippet, "renamed"))
+        snippet.code = self.CODE.replace("quicksort", "mergesort")
+        snippet.save()
+        self.assertFalse(self.matches(snippet, "quicksort"))
+        self.assertTrue(self.matches(snippet, "mergesort"))
+
+    def test_compress_command_keeps_legacy_rows_readable(self):
+        with self.settings(TEXT_COMPRESSION_ENABLED=False):
+            snippet = Snippet.objects.create(title='Legacy', code=self.CODE, owner_id=self.user.id)
+        self.assertEqual(self.stored_code(snippet), self.CODE)
+        call_command('compress_snippet_code', batch_size=1, min_length=64, stdout=open('/dev/null', 'w'))
+        self.assertTrue(is_compressed(self.stored_code(snippet)))
+        self.assertEqual(Snippet.objects.get(id=snippet.id).code, self.CODE)
+        self.assertTrue(self.matches(snippet, "quicksort"))
+        call_command('compress_snippet_code', decompress=True, stdout=open('/dev/null', 'w'))
+        self.assertEqual(self.stored_code(snippet), self.CODE)
+
+
+class SnippetHighlightTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user("painter", "painter")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Painted', code="def paint():\n    return 1\n",
+                                              linenos=True, owner_id=self.user.id)
+        self.url = reverse('django_everything:snippet-highlight', args=[self.snippet.id])
+
+    def test_render_html(self):
+        self.assertIn('<span class="k">def</span>', render_html("def f(): pass", "python", False))
+        self.assertIn("linenos", render_html("x", "python", True))
+        self.assertIn("x = 1", render_html("x = 1", "no-such-language", False))
+
+    def test_highlight_is_rendered_once(self):
+        res = self.client.get(self.url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["Content-Type"], "text/html; charset=utf-8")
+        self.assertIn(b'<span class="k">def</span>', res.content)
+        # cache hit: the code column is not even fetched
+        with self.assertNumQueries(1), mock.patch.object(highlight_pool, 'render') as render:
+            self.assertEqual(self.client.get(self.url).content, res.content)
+        render.assert_not_called()
+
+    def test_save_changes_the_cache_key(self):
+        self.client.get(self.url)
+        self.snippet.code = "class Painted: pass"
+        self.snippet.save()
+        self.assertIn(b"Painted", self.client.get(self.url).content)
+
+    def test_prerender_on_save(self):
+        prerender_snippet(self.snippet).result(timeout=60)
+        with mock.patch.object(highlight_pool, 'render') as render:
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        render.assert_not_called()
+
+    def test_prerender_loads_a_deferred_snippet_at_once(self):
+        snippet = Snippet.objects.get(id=self.snippet.id)
+        with self.assertNumQueries(1):
+            future = prerender_snippet(snippet)
+        self.assertIn("paint", future.result(timeout=60))
+
+    def test_timed_out_render_is_cached_as_plain_text(self):
+        with mock.patch.object(highlight_pool, 'render', side_effect=HighlightTimeout) as render:
+            res = self.client.get(self.url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertIn(b"def paint():", res.content)
+            self.assertEqual(self.client.get(self.url).content, res.content)
+        self.assertEqual(render.call_count, 1)
+
+    def test_busy_pool_and_missing_snippet(self):
+        with mock.patch.object(highlight_pool, 'render', side_effect=HighlightPoolBusy):
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        missing = reverse('django_everything:snippet-highlight', args=[self.snippet.id + 1000])
+        self.assertEqual(self.client.get(missing).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SnippetTitleConcurrencyTestCase(TransactionTestCase):
+    databases = '__all__'
+    THREADS = 16
+    CREATES_PER_THREAD = 5
+
+    def test_concurrent_creates_of_the_same_title(self):
+        user = User.objects.create_user("racer", "racer")
+        now = timezone.now()
+        # a title left over from the random suffixes, right in the way of the sequence
+        Snippet.objects.bulk_create([Snippet(title="Race3", owner_id=user.id, created=now, modified=now)])
+        barrier = Barrier(self.THREADS)
+        ids, errors = [], []
+
+        def create():
+            try:
+                barrier.wait()
+                for _ in range(self.CREATES_PER_THREAD):
+                    with transaction.atomic():
+                        ids.append(Snippet.objects.create(title="Race", owner_id=user.id).id)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=create) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        titles = list(Snippet.objects.filter(id__in=ids).values_list('title', flat=True))
+        self.assertEqual(len(set(titles)), self.THREADS * self.CREATES_PER_THREAD)
+        self.assertTrue(all(title.startswith("Race") for title in titles))
+        self.assertNotIn("Race3", titles)
+
+
+class ApproximateCountTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user("counter", "counter")
+        self.client.force_authenticate(self.user)
+        for index in range(5):
+            Snippet.objects.create(title='Counted', code="counted(%d)" % index, owner_id=self.user.id)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE snippets")
+
+    def test_count_rows(self):
+        self.assertEqual(count_rows(Snippet.objects.all(), threshold=10), (5, True))
+        count, exact = count_rows(Snippet.objects.all(), threshold=2)
+        self.assertFalse(exact)
+        self.assertGreaterEqual(count, 3)
+        count, exact = count_rows(Snippet.objects.filter(status=True), threshold=2)
+        self.assertFalse(exact)
+        self.assertGreaterEqual(count, 3)
+
+    def test_search_flags_the_count(self):
+        url = reverse('django_everything:snippet-search')
+        res = self.client.get(url, {"q": "counted", "page_size": 2})
+        self.assertEqual((res.data["count"], res.data["count_is_exact"]), (5, True))
+        with override_settings(API_EXACT_COUNT_THRESHOLD=3):
+            res = self.client.get(url, {"q": "counted", "page_size": 2, "page": 3})
+        self.assertFalse(res.data["count_is_exact"])
+        self.assertEqual(len(res.data["results"]), 1)
+        self.assertIsNone(res.data["next"])
+
+    def test_pages_past_a_low_estimate_are_served(self):
+        Snippet.objects.create(title='Counted', owner_id=self.user.id)
+        paginator = ApproximateCountPaginator(Snippet.objects.order_by('id'), 2)
+        with mock.patch('applibs.pagination.count_rows', return_value=(3, False)):
+            page = paginator.page(3)
+        self.assertFalse(paginator.count_is_exact)
+        self.assertEqual(len(page.object_list), 2)
+        self.assertFalse(page.has_next())
+        self.assertEqual(len(paginator.page(4).object_list), 0)
+
+    def test_admin_changelists(self):
+        admin = User.objects.create_superuser("root", "root")
+        self.client.force_login(admin)
+        for url in (reverse('admin:snippets_snippet_changelist'), reverse('admin:users_user_changelist')):
+            with override_settings(API_EXACT_COUNT_THRESHOLD=1):
+                res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertFalse(res.context["cl"].paginator.count_is_exact)
+
+
+class SnippetStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("statistician", "statistician")
+        self.other = User.objects.create_user("analyst", "analyst")
+        self.client.force_authenticate(self.user)
+
+    def stat(self, dimension, value):
+        return tuple(SnippetStat.objects.filter(dimension=dimension, value=str(value)).values_list('total', 'active')
+                     .first() or (0, 0))
+
+    def test_stats_follow_every_write(self):
+        first = Snippet.objects.create(title='Counted', owner_id=self.user.id)
+        second = Snippet.objects.create(title='Counted', owner_id=self.user.id, language='java')
+        self.assertEqual(self.stat('language', 'python'), (1, 1))
+        self.assertEqual(self.stat('owner', self.user.id), (2, 2))
+
+        first.status = False
+        first.save()
+        self.assertEqual(self.stat('language', 'python'), (1, 0))
+        self.client.patch(reverse('django_everything:snippet-bulk-create'),
+                          [{"id": second.id, "language": "python"}], format='json')
+        self.assertEqual(self.stat('language', 'java'), (0, 0))
+        self.assertEqual(self.stat('language', 'python'), (2, 1))
+        self.client.post(reverse('django_everything:snippet-bulk-create'),
+                         [{"title": "Bulk", "owner_id": self.other.id}] * 3, format='json')
+        self.assertEqual(self.stat('owner', self.other.id), (3, 3))
+        first.delete()
+        self.assertEqual(self.stat('owner', self.user.id), (1, 1))
+
+    def test_stats_endpoint(self):
+        Snippet.objects.create(title='Counted', owner_id=self.user.id, language='java')
+        Snippet.objects.create(title='Counted', owner_id=self.other.id, status=False)
+        Snippet.objects.create(title='Counted', owner_id=self.other.id)
+        with self.assertNumQueries(2):
+            res = self.client.get(reverse('django_everything:snippet-stats'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["languages"], [
+            {"language": "python", "total": 2, "active": 1},
+            {"language": "java", "total": 1, "active": 1},
+        ])
+        self.assertEqual(res.data["owners"][0], {
+            "owner": {"id": self.other.id, "username": "analyst"}, "total": 2, "active": 1
+        })
+
+
+class ReconcileSnippetStatsTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def test_reconcile_repairs_drift(self):
+        user = User.objects.create_user("auditor", "auditor")
+        for _ in range(5):
+            Snippet.objects.create(title='Audited', owner_id=user.id)
+        SnippetStat.objects.filter(dimension='language').update(total=42)
+        SnippetStat.objects.filter(dimension='owner').delete()
+        SnippetStat.objects.create(dimension='language', value='cobol', total=3, active=3)
+
+        call_command('reconcile_snippet_stats', stdout=open('/dev/null', 'w'))
+        stats = set(SnippetStat.objects.filter(total__gt=0).values_list('dimension', 'value', 'total', 'active'))
+        self.assertEqual(stats, {('language', 'python', 5, 5), ('owner', str(user.id), 5, 5)})
+
+
+class SnippetLiveIndexTestCase(TestCase):
+    """
+    EXPLAIN based checks that the live() read paths are served by the partial indexes
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        owners = User.objects.bulk_create([User(username="seed%d" % index) for index in range(20)])
+        now = timezone.now()
+        Snippet.objects.bulk_create([
+            Snippet(title="Seed%d" % index, owner_id=owners[index % 20].id, status=index % 10 != 0,
+                    created=now + timezone.timedelta(seconds=index), modified=now)
+            for index in range(5000)
+        ])
+        cls.owner = owners[3]
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE snippets")
+
+    def index_names(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plans = [cursor.fetchone()[0][0]["Plan"]]
+        names = set()
+        while plans:
+            plan = plans.pop()
+            if "Index Name" in plan:
+                names.add(plan["Index Name"])
+            plans.extend(plan.get("Plans", []))
+        return names
+
+    def test_live_list_page(self):
+        queryset = get_list_queryset("active").order_by('created', 'id')[:51]
+        self.assertIn("snippets_live_created_idx", self.index_names(queryset))
+        middle = Snippet.objects.order_by('created', 'id')[2500]
+        after = queryset.model.objects.live().filter(
+            keyset_filter(('created', 'id'), (middle.created, middle.id))
+        ).order_by('created', 'id')[:51]
+        self.assertIn("snippets_live_created_idx", self.index_names(after))
+
+    def test_live_owner_lookup(self):
+        queryset = Snippet.objects.live().filter(owner_id=self.owner.id).values_list('id', flat=True)
+        self.assertIn("snippets_live_owner_idx", self.index_names(queryset))
+
+    def test_live_id_range(self):
+        first = Snippet.objects.order_by('id').values_list('id', flat=True)[4000]
+        queryset = Snippet.objects.live().filter(id__gte=first).order_by('id').values_list('id', flat=True)[:100]
+        self.assertIn("snippets_live_id_idx", self.index_names(queryset))
+
+    def test_manager_uses_snippet_queryset(self):
+        self.assertEqual(Snippet.objects.live().count(), 4500)
+        self.assertEqual(Snippet.objects.filter(owner_id=self.owner.id).live().count(), 250)
+        # the manager keeps deferring code
+        self.assertEqual(Snippet.objects.live().query.deferred_loading, (frozenset({'code'}), True))
+
+
+class SnippetArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("archivist", "archivist")
+        self.client.force_authenticate(self.user)
+        long_ago = timezone.now() - timezone.timedelta(days=90)
+        self.snippets = []
+        for index in range(6):
+            snippet = Snippet.objects.create(title='Old', code="old(%d)" % index, owner_id=self.user.id)
+            self.snippets.append(snippet)
+        # every other snippet soft deleted long ago, one soft deleted just now
+        Snippet.objects.filter(id__in=[s.id for s in self.snippets[::2]]).update(status=False, modified=long_ago)
+        Snippet.objects.filter(id=self.snippets[1].id).update(status=False)
+        self.archivable = [s.id for s in self.snippets[::2]]
+
+    def archive(self, **options):
+        call_command('archive_snippets', days=30, stdout=open('/dev/null', 'w'), **options)
+
+    def test_moves_old_inactive_rows_in_resumable_batches(self):
+        self.archive(batch_size=1, max_batches=2)
+        self.assertEqual(sorted(ArchivedSnippet.objects.values_list('id', flat=True)), self.archivable[:2])
+        self.assertEqual(SnippetArchiveCheckpoint.objects.get(name='default').last_id, self.archivable[1])
+
+        self.archive(batch_size=1)
+        archived = ArchivedSnippet.objects.order_by('id')
+        self.assertEqual([snippet.id for snippet in archived], self.archivable)
+        self.assertEqual(archived[0].code, "old(0)")
+        self.assertFalse(Snippet.objects.filter(id__in=self.archivable).exists())
+        self.assertTrue(Snippet.objects.filter(id=self.snippets[1].id).exists())
+        checkpoint = SnippetArchiveCheckpoint.objects.get(name='default')
+        self.assertEqual((checkpoint.last_id, checkpoint.moved), (0, 3))
+
+    def test_list_includes_archived_only_when_asked(self):
+        self.archive()
+        ids = [snippet.id for snippet in self.snippets]
+        res = self.client.get(SNIPPETS_URL, {"type": "all"})
+        self.assertEqual([row["id"] for row in res.data["results"]], [i for i in ids if i not in self.archivable])
+        res = self.client.get(SNIPPETS_URL, {"type": "active", "include_archived": "true"})
+        self.assertNotIn(self.archivable[0], [row["id"] for row in res.data["results"]])
+
+        seen, url = [], SNIPPETS_URL + "?type=all&include_archived=true&page_size=4"
+        while url:
+            res = self.client.get(url)
+            self.assertNotIn("ETag", res)
+            seen.extend(row["id"] for row in res.data["results"])
+            url = res.data["next"]
+        self.assertEqual(seen, ids)
+        res = self.client.get(res.data["previous"])
+        self.assertEqual([row["id"] for row in res.data["results"]], ids[:4])
+
+
+class SnippetSparseFieldsetTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user("sparse", "sparse")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Sparse', owner_id=self.user.id)
+        self.url = reverse('django_everything:snippet-detail', args=[self.snippet.id])
+
+    def test_subset_selects_only_its_columns(self):
+        serializer = FAST_SNIPPET_SERIALIZER.subset(["title", "id"])
+        self.assertIs(serializer, FAST_SNIPPET_SERIALIZER.subset(["id", "title"]))
+        self.assertIs(FAST_SNIPPET_SERIALIZER.subset(["id", "title", "owner", "status", "version"]), FAST_SNIPPET_SERIALIZER)
+        self.assertEqual(serializer.columns, ('id', 'title'))
+        sql = str(serializer.values_list(Snippet.objects.all()).query)
+        self.assertNotIn('"users"', sql)
+        self.assertNotIn('"status"', sql)
+        self.assertIn('"users"', str(FAST_SNIPPET_SERIALIZER.subset(["owner"]).values_list(Snippet.objects.all()).query))
+        with self.assertRaises(ValueError):
+            FAST_SNIPPET_SERIALIZER.subset(["owner_id"])
+
+    def test_list_fields(self):
+        res = self.client.get(SNIPPETS_URL, {"fields": "id,title"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["results"], [{"id": self.snippet.id, "title": self.snippet.title}])
+        res = self.client.get(SNIPPETS_URL, {"fields": "owner"})
+        self.assertEqual(res.data["results"], [{"owner": {"id": self.user.id, "username": "sparse"}}])
+        self.assertEqual(self.client.get(SNIPPETS_URL, {"fields": "id,code"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_fields_keyset_pages(self):
+        Snippet.objects.create(title='Second', owner_id=self.user.id)
+        first = self.client.get(SNIPPETS_URL, {"fields": "title", "page_size": 1})
+        self.assertEqual(list(first.data["results"][0]), ["title"])
+        second = self.client.get(first.data["next"])
+        self.assertTrue(second.data["results"][0]["title"].startswith("Second"))
+
+    def test_retrieve_fields(self):
+        full = self.client.get(self.url)
+        res = self.client.get(self.url, {"fields": "title"})
+        self.assertEqual(json.loads(res.content), [{"title": self.snippet.title}])
+        self.assertEqual(res["X-Cache"], "BYPASS")
+        self.assertNotEqual(res["ETag"], full["ETag"])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=full["ETag"]).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+
+class SnippetExportTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("exporter", "exporter")
+        self.active = Snippet.objects.create(title='Exported', owner=self.user, code="print(1)")
+        self.inactive = Snippet.objects.create(title='Hidden', owner=self.user, status=False)
+
+    def export(self, *args):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('export_snippets', '--output', path, *args, stderr=io.StringIO())
+        with (gzip.open if '--gzip' in args else open)(path, 'rb') as exported:
+            return list(csv.DictReader(io.StringIO(exported.read().decode())))
+
+    def test_export_filters_and_columns(self):
+        rows = self.export('--status', 'active', '--with-owner', '--include-code')
+        self.assertEqual([row["id"] for row in rows], [str(self.active.id)])
+        self.assertEqual(rows[0]["owner_username"], "exporter")
+        self.assertEqual(rows[0]["code"], "print(1)")
+        self.assertEqual(rows[0]["status"], "t")
+
+        rows = self.export('--gzip', '--created-to', '2000-01-01')
+        self.assertEqual(rows, [])
+        rows = self.export('--created-from', '2000-01-01')
+        self.assertEqual(len(rows), 2)
+        self.assertNotIn("code", rows[0])
+
+    @override_settings(TEXT_COMPRESSION_ENABLED=True, TEXT_COMPRESSION_MIN_LENGTH=64)
+    def test_export_decompresses_code(self):
+        code = 'print("a, b")\n' * 20
+        packed = Snippet.objects.create(title='Packed, "quoted"', owner=self.user, code=code)
+        self.assertTrue(is_compressed(Snippet.objects.filter(id=packed.id).values_list('code', flat=True).get()))
+        for args in (('--include-code', '--with-owner'), ('--include-code', '--gzip')):
+            rows = {row["id"]: row for row in self.export(*args)}
+            self.assertEqual(rows[str(packed.id)]["code"], code)
+            self.assertEqual(rows[str(packed.id)]["title"], packed.title)
+            self.assertEqual(rows[str(self.active.id)]["code"], "print(1)")
+        self.assertEqual(rows[str(self.inactive.id)]["status"], "f")
+
+    def test_export_endpoint_is_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(reverse('django_everything:snippet-export')).status_code,
+                         status.HTTP_403_FORBIDDEN)
+        res = client.get(reverse('django_everything:snippet-export'), {"created_from": "someday"})
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_abandoned_stream_stops_copy(self):
+        stream = copy_stream(snippet_export_sql(), chunk_size=1)
+        self.assertTrue(next(stream).startswith(b"id,title"))
+        stream.close()
+
+
+class SnippetExportStreamTestCase(TransactionTestCase):
+    """
+    The COPY of the streamed export runs on its own connection, the rows must be committed
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.admin = User.objects.create_user("admin", "admin")
+        self.admin.is_admin = True
+        self.admin.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        for index in range(3):
+            Snippet.objects.create(title='Streamed %d' % index, owner=self.admin, status=index != 1)
+
+    def test_stream_csv(self):
+        res = self.client.get(reverse('django_everything:snippet-export'), {"status": "true", "owner": "1"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.streaming)
+        self.assertEqual(res["Content-Disposition"], 'attachment; filename="snippets.csv"')
+        rows = list(csv.DictReader(io.StringIO(b"".join(res.streaming_content).decode())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row["owner_username"] for row in rows}, {"admin"})
+
+    def test_stream_gzip(self):
+        res = self.client.get(reverse('django_everything:snippet-export'), {"gzip": "true"})
+        self.assertEqual(res["Content-Type"], "application/gzip")
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(b"".join(res.streaming_content)).decode())))
+        self.assertEqual(len(rows), 3)
+
+    def test_invalid_filters(self):
+        url = reverse('django_everything:snippet-export')
+        self.assertEqual(self.client.get(url, {"status": "maybe"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {"created_to": "someday"}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SnippetImportTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("importer", "importer")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('django_everything:snippet-import-snippets')
+
+    def test_import_csv_with_rejects(self):
+        # a legacy title with the number the sequence hands out next
+        Snippet.objects.bulk_create([Snippet(title="Copied1", owner=self.user, created=timezone.now(),
+                                             modified=timezone.now())])
+        source = io.BytesIO((
+            "title,owner_id,code,status\n"
+            "Copied,%(owner)d,\"print(1)\nprint(2)\",true\n"
+            "Copied,%(owner)d,,false\n"
+            ",%(owner)d,,\n"
+            "Orphan,0,,\n"
+            "Unsure,%(owner)d,,maybe\n" % {"owner": self.user.id}
+        ).encode())
+        rejects = io.BytesIO()
+        self.assertEqual(import_snippets(source, "csv", rejects), (2, 3))
+
+        # the taken Copied1 got a new number
+        imported = set(Snippet.objects.exclude(title="Copied1").values_list('title', 'code', 'status', 'language'))
+        self.assertEqual(imported, {("Copied3", "print(1)\nprint(2)", True, "python"), ("Copied2", None, False, "python")})
+        self.assertEqual(SnippetStat.objects.get(dimension=SnippetStat.OWNER, value=str(self.user.id)).total, 3)
+        rows = list(csv.DictReader(io.StringIO(rejects.getvalue().decode())))
+        self.assertEqual([(row["line"], row["error"]) for row in rows],
+                         [("3", "invalid title"), ("4", "unknown owner_id"), ("5", "invalid status")])
+
+    def test_import_command(self):
+        handle, path = tempfile.mkstemp(suffix=".ndjson")
+        with os.fdopen(handle, "w") as source:
+            source.write('{"title": "Lined", "owner_id": %d, "linenos": true, "language": "java"}\n\nnot json\n'
+                         % self.user.id)
+        self.addCleanup(os.remove, path)
+        out = io.StringIO()
+        call_command('import_snippets', path, stdout=out)
+        self.assertIn("1 snippets imported, 1 rows rejected", out.getvalue())
+        self.assertTrue(Snippet.objects.filter(title="Lined1", linenos=True, language="java").exists())
+
+    def test_import_endpoint(self):
+        body = '{"title": "Uploaded", "owner_id": %d}\n{"title": "Uploaded", "owner_id": "x"}\n' % self.user.id
+        res = self.client.post(self.url, body, content_type="application/x-ndjson")
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_admin = True
+        self.user.save()
+        res = self.client.post(self.url, body, content_type="application/x-ndjson")
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data, {"imported": 1, "rejected": [{"line": 2, "error": "invalid owner_id"}]})
+
+        res = self.client.post(self.url, 'title,owner_id\n"Broken,1\n', content_type="text/csv")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.post(self.url, 'name,owner_id\nNamed,1\n', content_type="text/csv")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncSnippetViewTestCase(TransactionTestCase):
+    """
+    The async endpoints query from the database executor threads, the rows must be committed
+    """
+    databases = '__all__'
+    application = AsyncAPIRouter(async_endpoints, StreamingASGIHandler())
+
+    def setUp(self):
+        self.user = User.objects.create_user("async", "async")
+        self.token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(self.user))
+        self.snippet = Snippet.objects.create(title='Motu', owner=self.user)
+
+    def asgi_request(self, method, path, data=None, token=None, query_string=b'', extra_headers=()):
+        headers = [(b'host', b'testserver'), (b'content-type', b'application/json')] + list(extra_headers)
+        if token:
+            headers.append((b'authorization', b'JWT ' + token.encode()))
+        body = json.dumps(data).encode() if data else b''
+        headers.append((b'content-length', str(len(body)).encode()))
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers,
+            'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'root_path': '',
+        }
+
+        async def communicate():
+            communicator = ApplicationCommunicator(self.application, scope)
+            await communicator.send_input({'type': 'http.request', 'body': body})
+            start = await communicator.receive_output(10)
+            content = b''
+            while True:
+                message = await communicator.receive_output(10)
+                content += message.get('body', b'')
+                if not message.get('more_body'):
+                    return start, content
+
+        start, content = async_to_sync(communicate)()
+        return start['status'], dict((key.lower(), value) for key, value in start['headers']), content
+
+    def test_list_matches_sync_view(self):
+        code, headers, body = self.asgi_request('GET', '/api/v1/snippets/')
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertIn(b'etag', headers)
+        self.assertEqual(json.loads(body), APIClient().get(SNIPPETS_URL).json())
+
+    def test_streamed_list_is_complete(self):
+        for index in range(30):
+            Snippet.objects.create(title='Stream %d' % index, owner=self.user)
+        code, headers, body = self.asgi_request('GET', '/api/v1/snippets/', query_string=b'stream=ndjson&type=all')
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row["id"] for row in rows], list(Snippet.objects.order_by('created', 'id').values_list('id', flat=True)))
+
+    @override_settings(TEXT_COMPRESSION_ENABLED=True, TEXT_COMPRESSION_MIN_LENGTH=64)
+    def test_export_streams_under_asgi(self):
+        self.user.is_admin = True
+        self.user.save()
+        packed = Snippet.objects.create(title='Packed', owner=self.user, code="x = 1\n" * 30)
+        code, headers, body = self.asgi_request('GET', '/api/v1/snippets/export/', token=self.token,
+                                                query_string=b'code=true&gzip=true')
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(headers[b'content-type'], b'application/gzip')
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(body).decode())))
+        self.assertEqual([(row["id"], row["code"]) for row in rows],
+                         [(str(self.snippet.id), ""), (str(packed.id), packed.code)])
+
+    def test_retrieve_and_conditional_get(self):
+        path = '/api/v1/snippets/%d/' % self.snippet.id
+        code, headers, body = self.asgi_request('GET', path)
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(body)[0]["title"], self.snippet.title)
+        self.assertEqual(headers[b'x-cache'], b'MISS')
+        code, _, _ = self.asgi_request('GET', path, extra_headers=[(b'if-none-match', headers[b'etag'])])
+        self.assertEqual(code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_create_requires_authentication(self):
+        data = {"title": "Patlu", "owner_id": self.user.id}
+        code, headers, _ = self.asgi_request('POST', '/api/v1/snippets/', data)
+        self.assertEqual(code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(headers[b'www-authenticate'], b'JWT realm="api"')
+        self.assertEqual(self.asgi_request('POST', '/api/v1/snippets/', data, token="bad")[0],
+                         status.HTTP_401_UNAUTHORIZED)
+
+        code, _, body = self.asgi_request('POST', '/api/v1/snippets/', data, token=self.token)
+        self.assertEqual(code, status.HTTP_201_CREATED)
+        self.assertTrue(Snippet.objects.filter(id=json.loads(body)["id"], title__startswith="Patlu").exists())
+
+    def test_partial_update(self):
+        path = '/api/v1/snippets/%d/' % self.snippet.id
+        code, _, body = self.asgi_request('PATCH', path, {"status": False}, token=self.token)
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertFalse(json.loads(body)["status"])
+        self.assertFalse(Snippet.objects.get(id=self.snippet.id).status)
+
+    def test_roles_permission_checked_in_executor(self):
+        self.assertEqual(self.asgi_request('GET', '/api/v1/users/get_role/', token=self.token)[0],
+                         status.HTTP_403_FORBIDDEN)
+        self.user.is_superuser = True
+        self.user.save()
+        code, _, body = self.asgi_request('GET', '/api/v1/users/get_role/', token=self.token)
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertIn("data", json.loads(body))
+
+    @override_settings(QUERY_BUDGET_ENFORCE=True)
+    def test_query_budget_enforced(self):
+        with mock.patch.object(SnippetView, 'query_budget', {"retrieve": 0}):
+            code, _, _ = self.asgi_request('GET', '/api/v1/snippets/%d/' % self.snippet.id)
+        self.assertEqual(code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def test_busy_executor_returns_503(self):
+        slots = BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(database_executor, '_slots', slots):
+            code, _, _ = self.asgi_request('GET', '/api/v1/snippets/%d/' % self.snippet.id)
+        self.assertEqual(code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_busy_stream_executor_returns_503(self):
+        slots = BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(stream_executor, '_slots', slots):
+            code, _, body = self.asgi_request('GET', '/api/v1/snippets/', query_string=b'stream=ndjson')
+        self.assertEqual(code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(json.loads(body)["error_code"], "SU503")
+
+    def test_other_routes_fall_back_to_django(self):
+        code, _, body = self.asgi_request('GET', '/api/v1/snippets/stats/')
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertIn("languages", json.loads(body))
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Routing decisions only, nothing is queried on the replica alias
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def test_reads_go_to_replica_writes_to_primary(self):
+        self.assertEqual(router.db_for_read(Snippet), 'replica_1')
+        self.assertEqual(router.db_for_write(Snippet), 'default')
+        with use_primary():
+            self.assertEqual(router.db_for_read(Snippet), 'default')
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Snippet), 'default')
+
+    def call(self, method, status_code=200, token='JWT one'):
+        routed = []
+
+        def get_response(request):
+            routed.append(router.db_for_read(Snippet))
+            return HttpResponse(status=status_code)
+
+        request = getattr(self.factory, method)('/api/v1/snippets/', HTTP_AUTHORIZATION=token)
+        ReplicaStickinessMiddleware(get_response)(request)
+        return routed[0]
+
+    def test_client_reads_its_writes_from_primary(self):
+        self.assertEqual(self.call('get'), 'replica_1')
+        self.assertEqual(self.call('post'), 'default')
+        self.assertEqual(self.call('get'), 'default')
+        # other clients keep reading from the replica
+        self.assertEqual(self.call('get', token='JWT two'), 'replica_1')
+        self.assertEqual(router.db_for_read(Snippet), 'replica_1')
+
+    def test_failed_write_does_not_stick(self):
+        self.assertEqual(self.call('patch', status_code=400), 'default')
+        self.assertEqual(self.call('get'), 'replica_1')
+
+    def test_stickiness_expires(self):
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            self.call('post')
+        self.assertEqual(self.call('get'), 'replica_1')
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "DATABASE_REPLICA_URLS not configured")
+class ReplicaReadYourWritesTestCase(TransactionTestCase):
+    """
+    Against a real replica connection, in tests a mirror of the test database
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("replica", "replica")
+        self.token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(self.user))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.token)
+        self.replica = connections[settings.DATABASE_REPLICAS[0]]
+
+    def test_safe_requests_read_from_replica(self):
+        Snippet.objects.create(title='Motu', owner=self.user)
+        with CaptureQueriesContext(self.replica) as replica_queries:
+            res = self.client.get(SNIPPETS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data["results"]), 1)
+        self.assertTrue(replica_queries.captured_queries)
+
+    def test_reads_after_write_stay_on_primary(self):
+        res = self.client.post(SNIPPETS_URL, {"title": "Patlu", "owner_id": self.user.id}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        with CaptureQueriesContext(self.replica) as replica_queries:
+            res = self.client.get(reverse('django_everything:snippet-detail', args=[res.data["id"]]))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(replica_queries.captured_queries, [])
+
+
+class ConnectionPoolTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def make_pool(self, **kwargs):
+        params = connection.get_connection_params()
+        pool = ConnectionPool(lambda: psycopg2.connect(**params), **dict({"min_size": 0}, **kwargs))
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connections_are_reused(self):
+        pool = self.make_pool(max_size=2)
+        raw = pool.getconn()
+        pool.putconn(raw)
+        self.assertIs(pool.getconn(), raw)
+        stats = pool.stats()
+        self.assertEqual((stats["created"], stats["checkouts"], stats["in_use"]), (1, 2, 1))
+
+    def test_fill_opens_min_size(self):
+        pool = self.make_pool(min_size=2)
+        pool.fill()
+        self.assertEqual(pool.stats()["idle"], 2)
+
+    def test_exhausted_pool_times_out(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+        raw = pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.stats()["timeouts"], 1)
+        pool.putconn(raw)
+        self.assertIs(pool.getconn(), raw)
+
+    def test_waiter_gets_returned_connection(self):
+        pool = self.make_pool(max_size=1, timeout=5)
+        raw = pool.getconn()
+        Timer(0.05, pool.putconn, (raw,)).start()
+        self.assertIs(pool.getconn(), raw)
+        self.assertGreater(pool.stats()["wait_time_max"], 0)
+
+    def test_open_transaction_rolled_back_on_return(self):
+        pool = self.make_pool()
+        raw = pool.getconn()
+        with raw.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        pool.putconn(raw)
+        self.assertEqual(raw.info.transaction_status, psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_broken_connection_replaced_on_checkout(self):
+        pool = self.make_pool(check_interval=0)
+        raw = pool.getconn()
+        pool.putconn(raw)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [raw.get_backend_pid()])
+        replacement = pool.getconn()
+        self.assertIsNot(replacement, raw)
+        self.assertEqual(pool.stats()["failed_checks"], 1)
+
+    def test_expired_connection_closed(self):
+        pool = self.make_pool(max_lifetime=0)
+        raw = pool.getconn()
+        pool.putconn(raw)
+        self.assertTrue(raw.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+
+    @skipUnless(settings.DATABASE_POOL_ENABLED, "DATABASE_POOL_ENABLED is off")
+    def test_backend_returns_connections_to_pool(self):
+        connection.ensure_connection()
+        raw = connection.connection
+        connection.close()
+        self.assertFalse(raw.closed)
+        connection.ensure_connection()
+        self.assertIs(connection.connection, raw)
+
+    @skipUnless(settings.DATABASE_POOL_ENABLED, "DATABASE_POOL_ENABLED is off")
+    def test_stats_endpoint(self):
+        url = reverse('django_everything:db-pool-stats')
+        client = APIClient()
+        self.assertEqual(client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        admin = User.objects.create_user("pooladmin", "pooladmin")
+        client.force_authenticate(admin)
+        self.assertEqual(client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        admin.is_admin = True
+        admin.save()
+
+        res = client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data["success_code"], "RS200")
+        stats = {item["alias"]: item for item in res.data["data"]}
+        self.assertEqual(set(stats["default"]), {
+            "alias", "database", "size", "idle", "in_use", "waiting", "max_size", "created", "closed", "checkouts",
+            "timeouts", "failed_checks", "wait_time_total", "wait_time_avg", "wait_time_max",
+        })
+        self.assertEqual(stats["default"]["database"], connection.settings_dict["NAME"])
+        self.assertGreaterEqual(stats["default"]["created"], 1)
+
+
+@override_settings(SNIPPET_CHANGES_SETTLE_SECONDS=0)
+class SnippetChangesFeedTestCase(TestCase):
+    CHANGES_URL = reverse('django_everything:snippet-changes')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("feed", "feed")
+        self.snippets = [Snippet.objects.create(title='Feed', owner=self.user) for _ in range(3)]
+
+    def poll(self, url=None, **params):
+        res = self.client.get(url or self.CHANGES_URL, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data
+
+    def test_changes_in_modified_order_and_resumable(self):
+        first = self.poll(page_size=2)
+        self.assertEqual([change["id"] for change in first["results"]], [s.id for s in self.snippets[:2]])
+        self.assertTrue(first["has_more"])
+        second = self.poll(first["next"])
+        self.assertEqual([change["id"] for change in second["results"]], [self.snippets[2].id])
+        self.assertEqual(second["results"][0]["snippet"]["title"], self.snippets[2].title)
+        # nothing new: the same position is handed back
+        idle = self.poll(second["next"])
+        self.assertEqual((idle["results"], idle["has_more"]), ([], False))
+
+        self.snippets[0].title = "FeedEdited"
+        self.snippets[0].save()
+        changed = self.poll(idle["next"])
+        self.assertEqual([change["id"] for change in changed["results"]], [self.snippets[0].id])
+
+    def test_deactivated_and_deleted_snippets_are_tombstones(self):
+        cursor = self.poll()["next"]
+        self.snippets[0].status = False
+        self.snippets[0].save()
+        deleted_id = self.snippets[1].id
+        Snippet.objects.filter(id=deleted_id).delete()
+        self.assertTrue(SnippetTombstone.objects.filter(id=deleted_id).exists())
+
+        changes = self.poll(cursor)["results"]
+        self.assertEqual(
+            [(change["id"], change["deleted"], change["snippet"]) for change in changes],
+            [(self.snippets[0].id, True, None), (deleted_id, True, None)],
+        )
+
+    def test_imported_snippets_follow_the_cursor(self):
+        cursor = self.poll()["next"]
+        # the test's transaction started before the cursor's rows were written
+        imported, rejected = import_snippets(io.BytesIO(b"title,owner_id\nImported,%d\n" % self.user.id), "csv")
+        self.assertEqual((imported, rejected), (1, 0))
+        changes = self.poll(cursor)["results"]
+        self.assertEqual([change["snippet"]["title"] for change in changes], ["Imported1"])
+
+    def test_sparse_fields_and_settle_window(self):
+        changes = self.poll(fields="title")["results"]
+        self.assertEqual(changes[0]["snippet"], {"title": self.snippets[0].title})
+        with override_settings(SNIPPET_CHANGES_SETTLE_SECONDS=60):
+            self.assertEqual(self.poll()["results"], [])
+
+    @override_settings(SNIPPET_TOMBSTONE_RETENTION_DAYS=30)
+    def test_expired_tombstones_are_pruned(self):
+        now = timezone.now()
+        SnippetTombstone.objects.bulk_create([
+            SnippetTombstone(id=index, modified=now - timezone.timedelta(days=days))
+            for index, days in enumerate((40, 31, 29, 1), start=100000)
+        ])
+        call_command('prune_snippet_tombstones', batch_size=1, stdout=open('/dev/null', 'w'))
+        self.assertEqual(list(SnippetTombstone.objects.values_list('id', flat=True)), [100002, 100003])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.CHANGES_URL, {"cursor": "bogus"}).status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(SNIPPET_CHANGES_SETTLE_SECONDS=0)
+class SnippetChangesHorizonTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def changed_ids(self):
+        res = APIClient().get(reverse('django_everything:snippet-changes'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [change["id"] for change in res.data["results"]]
+
+    def test_open_transaction_holds_back_later_rows(self):
+        user = User.objects.create_user("horizon", "horizon")
+        # another owner and language: the stats rows of the slow writer stay locked until it commits
+        other = User.objects.create_user("horizon2", "horizon2")
+        written, commit = Barrier(2), Barrier(2)
+        slow = []
+
+        def slow_writer():
+            try:
+                with transaction.atomic():
+                    slow.append(Snippet.objects.create(title='Slow', owner=user))
+                    written.wait()
+                    commit.wait()
+            finally:
+                connection.close()
+
+        thread = Thread(target=slow_writer)
+        thread.start()
+        written.wait()
+        fast = Snippet.objects.create(title='Fast', owner=other, language='java')
+        # committed, but stamped after the slow transaction started
+        self.assertEqual(self.changed_ids(), [])
+        commit.wait()
+        thread.join()
+        self.assertEqual(self.changed_ids(), [slow[0].id, fast.id])
+
+
+class SnippetOptimisticUpdateTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("editor", "editor")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Motu', owner=self.user)
+        self.detail = reverse('django_everything:snippet-detail', args=[self.snippet.id])
+
+    def test_update_bumps_version_and_returns_etag(self):
+        etag = self.client.get(self.detail)["ETag"]
+        self.assertTrue(etag.startswith('"v1-'))
+        res = self.client.patch(self.detail, {"title": "Patlu"}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual((res.data["title"], res.data["version"]), ("Patlu", 2))
+        # the returned ETag is the one a GET now sends
+        self.assertEqual(res["ETag"], self.client.get(self.detail)["ETag"])
+
+    def test_lost_race_is_412(self):
+        etag = self.client.get(self.detail)["ETag"]
+        self.assertEqual(self.client.patch(self.detail, {"status": False}, format='json',
+                                           HTTP_IF_MATCH=etag).status_code, status.HTTP_200_OK)
+        res = self.client.patch(self.detail, {"title": "Overwrite"}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Snippet.objects.get(id=self.snippet.id).title, self.snippet.title)
+
+    def test_bare_version_and_wildcard(self):
+        res = self.client.patch(self.detail, {"title": "Bare"}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(res.data["version"], 2)
+        res = self.client.patch(self.detail, {"title": "Any"}, format='json', HTTP_IF_MATCH='*')
+        self.assertEqual(res.data["version"], 3)
+        self.assertEqual(self.client.patch(self.detail, {"title": "Weak"}, format='json',
+                                           HTTP_IF_MATCH='W/"v3-abc"').status_code,
+                         status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_save_and_bulk_update_bump_version(self):
+        self.snippet.title = "Saved"
+        self.snippet.save()
+        self.assertEqual(self.snippet.version, 2)
+        bulk_update_snippets([{"id": self.snippet.id, "status": False}], self.user)
+        self.assertEqual(Snippet.objects.get(id=self.snippet.id).version, 3)
+
+    def test_missing_snippet_is_404(self):
+        missing = reverse('django_everything:snippet-detail', args=[999999])
+        self.assertEqual(self.client.patch(missing, {"title": "x"}, format='json',
+                                           HTTP_IF_MATCH='"1"').status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(QUERY_BUDGET_ENFORCE=True)
+    def test_failed_updates_stay_within_budget(self):
+        client = APIClient()
+        token = api_settings.JWT_ENCODE_HANDLER(api_settings.JWT_PAYLOAD_HANDLER(self.user))
+        client.credentials(HTTP_AUTHORIZATION='JWT ' + token)
+        missing = reverse('django_everything:snippet-detail', args=[999999])
+        # the user lookup of the token and the UPDATE, a failed update needs no third query
+        with self.assertNumQueries(2):
+            res = client.patch(self.detail, {"title": "Stale"}, format='json', HTTP_IF_MATCH='"7"')
+        self.assertEqual(res.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        with self.assertNumQueries(2):
+            res = client.patch(missing, {"title": "Gone"}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        res = client.patch(missing, {"title": "Gone"}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SnippetUpdateConstraintTestCase(TransactionTestCase):
+    """
+    The owner foreign key is checked at commit, the update has to run in autocommit
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user("constraint", "constraint")
+        self.client.force_authenticate(self.user)
+        self.snippet = Snippet.objects.create(title='Motu', owner=self.user)
+        self.detail = reverse('django_everything:snippet-detail', args=[self.snippet.id])
+
+    def test_constraint_violations_are_400(self):
+        other = Snippet.objects.create(title='Taken', owner=self.user)
+        res = self.client.patch(self.detail, {"title": other.title}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("title", res.data)
+        res = self.client.patch(self.detail, {"owner_id": 999999}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("owner_id", res.data)
+        self.assertEqual(Snippet.objects.get(id=self.snippet.id).version, 1)
@@ -0,0 +1,708 @@
+import csv
+from collections import Counter
+from datetime import datetime, time
+from threading import Lock
+
+from cachetools import TTLCache
+from psycopg2 import errorcodes
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, connections, models, router, transaction
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from applibs import exceptions
+from applibs.error_codes import ERROR_CODE
+from applibs.fields import COMPRESSED_TEXT_HEADER, decompress_text
+from applibs.streaming import NDJSONCopyReader
+from apps.snippets.models import (
+    NUMBERED_TITLE_TOO_LONG, TITLE_ALLOCATION_ATTEMPTS, TITLE_MAX_LENGTH, Snippet, SnippetArchiveCheckpoint,
+    SnippetStat, SnippetTitleSequence, SnippetTombstone, User,
+    code_search_vector, is_title_conflict,
+)
+from apps.snippets.signals import snippets_bulk_changed
+from apps.snippets.serializers import FAST_SNIPPET_SERIALIZER, SnippetBulkCreateSerializer, SnippetBulkUpdateSerializer
+
+# One archive batch in one statement: lock the next inactive rows (skipping rows being
+# edited), delete them and insert what the DELETE returned into the archive.
+ARCHIVE_BATCH = """
+WITH batch AS (
+    SELECT id FROM snippets
+    WHERE status = false AND modified < %s AND id > %s
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+), moved AS (
+    DELETE FROM snippets WHERE id IN (SELECT id FROM batch)
+    RETURNING id, title, owner_id, code, linenos, language, created, modified, status, version
+), archived AS (
+    INSERT INTO snippets_archive (
+        id, title, owner_id, code, linenos, language, created, modified, status, version, archived
+    )
+    SELECT id, title, owner_id, code, linenos, language, created, modified, status, version, now() FROM moved
+    RETURNING id
+)
+SELECT (SELECT max(id) FROM batch), (SELECT array_agg(id) FROM archived)
+"""
+
+# cursor of the changes feed
+CHANGES_ORDERING = ('modified', 'id')
+
+# Columns of the bulk export, code is opt-in and decompressed by ExportCodeDecompressor
+EXPORT_COLUMNS = ('id', 'title', 'owner_id', 'language', 'linenos', 'status', 'created', 'modified')
+
+# Bulk import: COPY into a staging table of text columns, so that bad values are reported
+# instead of failing the COPY, then validate, number the titles and merge set-based.
+IMPORT_COLUMNS = ('title', 'owner_id', 'code', 'linenos', 'language', 'status')
+IMPORT_BOOLEANS = ('t', 'f', 'true', 'false', 'y', 'n', 'yes', 'no', 'on', 'off', '1', '0')
+
+IMPORT_STAGING = """
+CREATE TEMPORARY TABLE snippet_import_staging (
+    line bigserial, error text, title text, owner_id text, code text, linenos text, language text, status text,
+    new_title text
+) ON COMMIT DROP
+"""
+
+IMPORT_VALIDATE = r"""
+UPDATE snippet_import_staging s SET error = CASE
+    WHEN coalesce(btrim(s.title), '') = '' OR char_length(btrim(s.title)) > %(title_length)s THEN 'invalid title'
+    WHEN s.owner_id IS NULL OR s.owner_id !~ '^\s*[0-9]{1,9}\s*$' THEN 'invalid owner_id'
+    WHEN NOT EXISTS (SELECT 1 FROM users u WHERE u.id = btrim(s.owner_id)::integer) THEN 'unknown owner_id'
+    WHEN s.language IS NOT NULL AND btrim(s.language) NOT IN %(languages)s THEN 'invalid language'
+    WHEN s.linenos IS NOT NULL AND lower(btrim(s.linenos)) NOT IN %(booleans)s THEN 'invalid linenos'
+    WHEN s.status IS NOT NULL AND lower(btrim(s.status)) NOT IN %(booleans)s THEN 'invalid status'
+END
+WHERE s.error IS NULL
+"""
+
+# Same numbering as allocate_unique_titles(): one upsert of the title sequences for all
+# pending base titles, rows of a base title take its new numbers in line order.
+IMPORT_NUMBER_TITLES = """
+WITH pending AS (
+    SELECT line, btrim(title) AS title FROM snippet_import_staging WHERE error IS NULL AND new_title IS NULL
+), counts AS (
+    SELECT title, count(*) AS n FROM pending GROUP BY title
+), sequences AS (
+    INSERT INTO snippet_title_sequences (base_title, last_value)
+    SELECT title, n FROM counts ORDER BY title
+    ON CONFLICT (base_title) DO UPDATE SET last_value = snippet_title_sequences.last_value + EXCLUDED.last_value
+    RETURNING base_title, last_value
+), numbered AS (
+    SELECT p.line, p.title || (q.last_value - c.n + row_number() OVER (PARTITION BY p.title ORDER BY p.line)) AS title
+    FROM pending p JOIN counts c ON c.title = p.title JOIN sequences q ON q.base_title = p.title
+)
+UPDATE snippet_import_staging s SET new_title = numbered.title FROM numbered WHERE s.line = numbered.line
+"""
+
+# numbered titles already taken, or given twice ("A1" + 1 and "A" + 11), get new numbers
+IMPORT_RELEASE_TITLES = """
+UPDATE snippet_import_staging s SET new_title = NULL
+FROM (
+    SELECT line, new_title, row_number() OVER (PARTITION BY new_title ORDER BY line) AS position
+    FROM snippet_import_staging WHERE new_title IS NOT NULL
+) numbered
+WHERE s.line = numbered.line
+    AND (numbered.position > 1 OR EXISTS (SELECT 1 FROM snippets t WHERE t.title = numbered.new_title))
+"""
+
+# a concurrent insert may still take a title, those rows are rejected and can be retried
+# `now` is taken by the application right before the merge, like Snippet.save() stamps rows,
+# not the database's now(): that is the start of the transaction and the upload, the rows
+# would land far behind the changes feed's cursors.
+IMPORT_MERGE = """
+WITH inserted AS (
+    INSERT INTO snippets (title, owner_id, code, linenos, language, status, created, modified)
+    SELECT new_title, btrim(owner_id)::integer, code, coalesce(btrim(linenos)::boolean, %(linenos)s),
+           coalesce(btrim(language), %(language)s), coalesce(btrim(status)::boolean, %(status)s),
+           %(now)s, %(now)s
+    FROM snippet_import_staging WHERE error IS NULL ORDER BY line
+    ON CONFLICT (title) DO NOTHING
+    RETURNING id, title
+), taken AS (
+    UPDATE snippet_import_staging s SET error = 'title taken'
+    WHERE s.error IS NULL AND NOT EXISTS (SELECT 1 FROM inserted i WHERE i.title = s.new_title)
+)
+SELECT count(*), min(id), max(id) FROM inserted
+"""
+
+IMPORT_REJECTS = """
+COPY (
+    SELECT line, error, title, owner_id, code, linenos, language, status
+    FROM snippet_import_staging WHERE error IS NOT NULL ORDER BY line
+) TO STDOUT WITH (FORMAT csv, HEADER true)
+"""
+
+# Writing transactions get an xid with their first write, their rows are stamped once they
+# started and become visible at commit. Only the role's own sessions are shown in full.
+CHANGES_HORIZON = """
+SELECT least(clock_timestamp(), min(xact_start)) - make_interval(secs => %s)
+FROM pg_stat_activity
+WHERE datname = current_database() AND backend_xid IS NOT NULL AND pid <> pg_backend_pid()
+"""
+
+# Same expression as the snippets_title_prefix_idx partial index, so that both the
+# LIKE 'ABC%' filter and the ordering are served by one index range scan.
+TITLE_PREFIX_KEY = RawSQL('UPPER("snippets"."title"::text) COLLATE "C"', (), output_field=models.CharField())
+
+_autocomplete_cache = TTLCache(
+    maxsize=getattr(settings, 'SNIPPET_AUTOCOMPLETE_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'SNIPPET_AUTOCOMPLETE_CACHE_TTL', 30),
+)
+_autocomplete_lock = Lock()
+
+
+def archive_snippet_batch(checkpoint_name, cutoff, batch_size):
+    """
+    Move the next batch of inactive snippets last modified before `cutoff` to the archive
+    table, in its own transaction together with the checkpoint.
+    :param checkpoint_name: SnippetArchiveCheckpoint to resume from and advance
+    :param cutoff: datetime
+    :param batch_size: rows per batch
+    :return: list of archived ids, None when the run reached the end of the table
+    """
+    with transaction.atomic():
+        checkpoint, _ = SnippetArchiveCheckpoint.objects.select_for_update().get_or_create(name=checkpoint_name)
+        with connection.cursor() as cursor:
+            cursor.execute(ARCHIVE_BATCH, [cutoff, checkpoint.last_id, batch_size])
+            last_id, archived = cursor.fetchone()
+        archived = archived or []
+        # the end of a run: the next one starts from the first id again
+        checkpoint.last_id = last_id or 0
+        checkpoint.moved += len(archived)
+        checkpoint.save()
+    if archived:
+        snippets_bulk_changed.send(sender=Snippet, ids=archived)
+    return archived if last_id is not None else None
+
+
+def snippet_export_sql(status=None, created_from=None, created_to=None, with_owner=False, include_code=False):
+    """
+    COPY statement exporting snippets as CSV with a header line, ordered by id
+    :param status: True/False to export active/inactive snippets only
+    :param created_from: datetime, inclusive
+    :param created_to: datetime, exclusive
+    :param with_owner: add the owner_username column
+    :param include_code: add the code column, stored compressed values need ExportCodeDecompressor
+    :return: COPY ... TO STDOUT statement, parameters bound
+    """
+    queryset = Snippet.objects.order_by('id')
+    if status is not None:
+        queryset = queryset.filter(status=status)
+    if created_from is not None:
+        queryset = queryset.filter(created__gte=created_from)
+    if created_to is not None:
+        queryset = queryset.filter(created__lt=created_to)
+    columns = EXPORT_COLUMNS + (('code',) if include_code else ())
+    expressions = {"owner_username": F('owner__username')} if with_owner else {}
+    sql, params = queryset.values(*columns, **expressions).query.sql_with_params()
+    with connection.cursor() as cursor:
+        select = cursor.mogrify(sql, params).decode()
+    return "COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)" % select
+
+
+def _csv_field_end(row, start):
+    """
+    :return: offset of the delimiter or line end after the postgres CSV field at `start`
+    """
+    if row[start:start + 1] != b'"':
+        end = row.find(b',', start)
+        return end if end != -1 else len(row.rstrip(b"\r\n"))
+    position = start + 1
+    while True:
+        position = row.index(b'"', position)
+        if row[position + 1:position + 2] != b'"':
+            return position + 1
+        position += 2
+
+
+class ExportCodeDecompressor(object):
+    """
+    Row filter of the export COPY (applibs.streaming.copy_to) writing compressed code values
+    as plain text, everything else stays as postgres formatted it. The code column is found
+    in the header line. A compressed value never needs quoting, rows without one pass as is.
+    """
+    marker = COMPRESSED_TEXT_HEADER.encode('ascii')
+
+    def __init__(self):
+        self.index = None
+
+    def __call__(self, row):
+        if self.index is None:
+            self.index = next(csv.reader([row.decode()])).index("code")
+            return row
+        if self.marker not in row:
+            return row
+        start = 0
+        for _ in range(self.index):
+            start = _csv_field_end(row, start) + 1
+        end = _csv_field_end(row, start)
+        value = row[start:end].decode('ascii')
+        if not value.startswith(COMPRESSED_TEXT_HEADER):
+            return row
+        code = decompress_text(value).replace('"', '""')
+        return row[:start] + ('"%s"' % code).encode() + row[end:]
+
+
+def parse_export_moment(value):
+    """
+    :param value: ISO date or datetime, naive values are in the current time zone
+    :return: aware datetime, None for an empty value
+    :raises:
+        - ValidationError: not a date
+    """
+    if not value:
+        return None
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            moment = day and datetime.combine(day, time.min)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+def _import_copy_sql(source, source_format):
+    """
+    :return: (COPY ... FROM STDIN statement, binary file object to copy from)
+    :raises:
+        - ValidationError: unknown format, or a CSV header without title and owner_id
+    """
+    if source_format == "ndjson":
+        columns = ("line", "error") + IMPORT_COLUMNS
+        source = NDJSONCopyReader(source, IMPORT_COLUMNS)
+    elif source_format == "csv":
+        header = source.readline()
+        header = header.decode('utf-8-sig') if isinstance(header, bytes) else header
+        columns = tuple(column.strip().lower() for column in next(csv.reader([header]), []))
+        if (not {'title', 'owner_id'}.issubset(columns) or len(set(columns)) != len(columns)
+                or not set(columns).issubset(IMPORT_COLUMNS)):
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.INVALID_REQUEST)
+    else:
+        raise exceptions.ValidationError(ERROR_CODE.global_codes.INVALID_REQUEST)
+    return "COPY snippet_import_staging (%s) FROM STDIN WITH (FORMAT csv)" % ", ".join(columns), source
+
+
+def import_snippets(source, source_format, rejects=None):
+    """
+    Load snippets with COPY FROM STDIN into a temporary staging table and merge the valid
+    rows into snippets with one INSERT ... SELECT, all in one transaction. Owners must
+    exist, titles are numbered from their title sequences like every new snippet, and
+    created/modified are the import time. Rejected rows are never inserted.
+    :param source: binary file object, CSV with a header line or NDJSON
+    :param source_format: csv/ndjson
+    :param rejects: binary file object receiving the rejected rows as CSV with their line and error
+    :return: (number of imported snippets, number of rejected rows)
+    :raises:
+        - ValidationError: unknown format, bad CSV header or unreadable CSV
+    """
+    copy_sql, source = _import_copy_sql(source, source_format)
+    defaults = {name: Snippet._meta.get_field(name).default for name in ('linenos', 'language', 'status')}
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(IMPORT_STAGING)
+            # copy_expert() is not wrapped like execute(), postgres errors stay psycopg2 errors
+            with connection.wrap_database_errors:
+                cursor.copy_expert(copy_sql, source)
+            # temporary tables are never analyzed by autovacuum
+            cursor.execute("ANALYZE snippet_import_staging")
+            cursor.execute(IMPORT_VALIDATE, {
+                "title_length": SnippetBulkCreateSerializer().fields["title"].max_length,
+                "languages": tuple(language for language, _ in Snippet.LANGUAGE_CHOICES),
+                "booleans": IMPORT_BOOLEANS,
+            })
+            for _ in range(TITLE_ALLOCATION_ATTEMPTS):
+                cursor.execute(IMPORT_NUMBER_TITLES)
+                cursor.execute(IMPORT_RELEASE_TITLES)
+                if not cursor.rowcount:
+                    break
+            cursor.execute(
+                "UPDATE snippet_import_staging SET error = CASE WHEN new_title IS NULL THEN 'title unavailable' "
+                "ELSE 'title too long' END WHERE error IS NULL AND (new_title IS NULL OR char_length(new_title) > %s)",
+                [TITLE_MAX_LENGTH]
+            )
+            cursor.execute(IMPORT_MERGE, dict(defaults, now=timezone.now()))
+            imported, first_id, last_id = cursor.fetchone()
+            cursor.execute("SELECT count(*) FROM snippet_import_staging WHERE error IS NOT NULL")
+            rejected = cursor.fetchone()[0]
+            if rejects is not None:
+                cursor.copy_expert(IMPORT_REJECTS, rejects)
+            # ON COMMIT DROP does not fire when the import runs inside an outer transaction
+            cursor.execute("DROP TABLE snippet_import_staging")
+    except DataError:
+        # malformed CSV, e.g. an unterminated quote or too many columns
+        raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+    if imported:
+        # ids handed out during the import, cached responses of a missing id included
+        snippets_bulk_changed.send(sender=Snippet, ids=range(first_id, last_id + 1))
+    return imported, rejected
+
+
+def get_list_queryset(list_type):
+    """
+    :param list_type: all/active
+    :return: unordered snippet queryset, the paginator applies the keyset ordering
+    """
+    snippets = {
+        "all": Snippet.objects.all(),
+        "active": Snippet.objects.live(),
+    }
+    if list_type not in snippets:
+        raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+    return snippets[list_type]
+
+
+def snippet_stats():
+    """
+    Snippet counts per language and per owner, read from the snippet_stats summary table
+    :return: {"languages": [{"language": .., "total": .., "active": ..}, ..],
+              "owners": [{"owner": {"id": .., "username": ..}, "total": .., "active": ..}, ..]}
+    """
+    stats = list(
+        SnippetStat.objects.filter(total__gt=0).order_by('dimension', '-total', 'value')
+        .values_list('dimension', 'value', 'total', 'active')
+    )
+    owner_ids = [int(value) for dimension, value, _, _ in stats if dimension == SnippetStat.OWNER]
+    usernames = dict(User.objects.filter(id__in=owner_ids).values_list('id', 'username'))
+    result = {"languages": [], "owners": []}
+    for dimension, value, total, active in stats:
+        if dimension == SnippetStat.LANGUAGE:
+            result["languages"].append({"language": value, "total": total, "active": active})
+        else:
+            owner = {"id": int(value), "username": usernames.get(int(value))}
+            result["owners"].append({"owner": owner, "total": total, "active": active})
+    return result
+
+
+def include_archived(query_params):
+    """
+    Archived snippets are only listed with ?type=all&include_archived=true
+    """
+    return (query_params.get("type") == "all"
+            and query_params.get("include_archived", "").lower() in ("1", "true"))
+
+
+def sparse_serializer(query_params):
+    """
+    Compiled read serializer of the ?fields=id,title sparse fieldset, it only selects the
+    columns of those fields and skips the owner join unless owner is asked for
+    :param query_params:
+    :return: CompiledReadSerializer, FAST_SNIPPET_SERIALIZER without ?fields=
+    :raises:
+        - ValidationError: a field is not a readable SnippetSerializer field
+    """
+    fields = [field.strip() for field in query_params.get("fields", "").split(",") if field.strip()]
+    if not fields:
+        return FAST_SNIPPET_SERIALIZER
+    try:
+        return FAST_SNIPPET_SERIALIZER.subset(fields)
+    except ValueError:
+        raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+
+
+def snippet_changes(serializer):
+    """
+    The two sources of the changes feed, both read in (modified, id) order from their
+    (modified, id) index: snippets, inactive ones included, and the tombstones of deleted
+    snippets. Rows stamped after the start of the oldest open writing transaction could still
+    be joined by its rows and are left for a later poll, as are those of the last
+    SNIPPET_CHANGES_SETTLE_SECONDS.
+    :param serializer: compiled read serializer of the snippet payload
+    :return: (snippet rows, tombstone rows), unordered named values_list() querysets
+    """
+    # the open transactions are those of the primary
+    with connections[router.db_for_write(Snippet)].cursor() as cursor:
+        cursor.execute(CHANGES_HORIZON, [getattr(settings, 'SNIPPET_CHANGES_SETTLE_SECONDS', 5)])
+        horizon = cursor.fetchone()[0]
+    snippets = serializer.values_list(
+        Snippet.objects.filter(modified__lt=horizon), *CHANGES_ORDERING, 'status', named=True
+    )
+    tombstones = SnippetTombstone.objects.filter(modified__lt=horizon).values_list(*CHANGES_ORDERING, named=True)
+    return snippets, tombstones
+
+
+def serialize_changes(serializer, rows):
+    """
+    :param rows: snippet and tombstone rows of snippet_changes()
+    :return: [{"id": .., "modified": .., "deleted": false, "snippet": {..}}, ..], deactivated
+             and deleted snippets are tombstones: "deleted": true, "snippet": null
+    """
+    changes = []
+    for row in rows:
+        live = getattr(row, 'status', False)
+        changes.append({
+            "id": row.id,
+            "modified": row.modified,
+            "deleted": not live,
+            "snippet": serializer.to_representation(row) if live else None,
+        })
+    return changes
+
+
+def autocomplete_titles(prefix, limit):
+    """
+    Case insensitive title prefix lookup over active snippets.
+    Results of hot prefixes are kept in a small in-process TTL cache.
+    :param prefix: typed text
+    :param limit: maximum number of titles
+    :return: list of titles ordered by their upper case form
+    """
+    key = (prefix.upper(), limit)
+    with _autocomplete_lock:
+        titles = _autocomplete_cache.get(key)
+    if titles is not None:
+        return titles
+
+    titles = list(
+        Snippet.objects.live()
+        .annotate(title_key=TITLE_PREFIX_KEY)
+        .filter(title_key__startswith=key[0])
+        .order_by('title_key')
+        .values_list('title', flat=True)[:limit]
+    )
+    with _autocomplete_lock:
+        _autocomplete_cache[key] = titles
+    return titles
+
+
+def clear_autocomplete_cache():
+    with _autocomplete_lock:
+        _autocomplete_cache.clear()
+
+
+def allocate_unique_titles(titles, max_rounds=10):
+    """
+    Number every title of the batch from its base title sequence, one upsert for all base
+    titles. Numbered titles already taken (legacy random suffixes, or another base title
+    ending in digits) get the next numbers, every round costs two queries.
+    :param titles: list of base titles
+    :param max_rounds: give up after this many rounds
+    :return: list of numbered titles, same order as `titles`
+    """
+    allocated = [None] * len(titles)
+    pending = list(range(len(titles)))
+    taken = set()
+    for _ in range(max_rounds):
+        suffixes = SnippetTitleSequence.objects.allocate(Counter(titles[index] for index in pending))
+        suffixes = {base_title: iter(numbers) for base_title, numbers in suffixes.items()}
+        candidates = {}
+        for index in pending:
+            title = titles[index] + next(suffixes[titles[index]])
+            if title not in taken:
+                taken.add(title)
+                candidates[index] = title
+        existing = set(
+            Snippet.objects.filter(title__in=candidates.values()).order_by().values_list('title', flat=True)
+        )
+        pending = [index for index in pending if candidates.get(index) is None or candidates[index] in existing]
+        for index, title in candidates.items():
+            if title not in existing:
+                allocated[index] = title
+        if not pending:
+            return allocated
+    raise ValueError("Could not allocate unique snippet titles")
+
+
+def bulk_create_snippets(rows, batch_size=None):
+    """
+    Validate and insert many snippets with a constant number of queries per batch.
+    Invalid rows are skipped and reported, valid rows are inserted.
+    :param rows: list of snippet dicts
+    :param batch_size: rows per INSERT, defaults to settings.SNIPPET_BULK_BATCH_SIZE
+    :return: (list of created ids, list of {"index": .., "errors": {..}})
+    :raises:
+        - AlreadyExist: if a concurrent insert took one of the allocated titles
+    """
+    batch_size = batch_size or settings.SNIPPET_BULK_BATCH_SIZE
+    child = SnippetBulkCreateSerializer()
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            valid.append((index, child.run_validation(row)))
+        except ValidationError as exc:
+            errors.append({"index": index, "errors": exc.detail})
+
+    owner_ids = {data["owner_id"] for _, data in valid}
+    existing_owners = set(User.objects.filter(id__in=owner_ids).values_list('id', flat=True))
+    missing = [(index, data) for index, data in valid if data["owner_id"] not in existing_owners]
+    for index, data in missing:
+        errors.append({
+            "index": index,
+            "errors": {"owner_id": ['Invalid pk "%s" - object does not exist.' % data["owner_id"]]}
+        })
+    valid = [(index, data) for index, data in valid if data["owner_id"] in existing_owners]
+
+    titles = allocate_unique_titles([data["title"] for _, data in valid])
+    numbered = []
+    for (index, data), title in zip(valid, titles):
+        if len(title) > TITLE_MAX_LENGTH:
+            errors.append({"index": index, "errors": {"title": [NUMBERED_TITLE_TOO_LONG]}})
+        else:
+            numbered.append((data, title))
+    errors.sort(key=lambda error: error["index"])
+
+    now = timezone.now()
+    snippets = [
+        Snippet(
+            created=now, modified=now, search_vector=code_search_vector(data.get("code")), **dict(data, title=title)
+        )
+        for data, title in numbered
+    ]
+    # bulk_create wraps all batches in a single transaction
+    try:
+        Snippet.objects.bulk_create(snippets, batch_size=batch_size)
+    except IntegrityError as exc:
+        # a concurrent insert took one of the checked titles, the client may retry
+        if is_title_conflict(exc):
+            raise exceptions.AlreadyExist()
+        raise
+    created = [snippet.id for snippet in snippets]
+    snippets_bulk_changed.send(sender=Snippet, ids=created)
+    return created, errors
+
+
+def _returning_sql(serializer, table, quote_name):
+    """
+    RETURNING list of the compiled serializer's columns, in its order. Relations are read
+    from the new row: the foreign key itself for the related id, a scalar subquery otherwise.
+    """
+    expressions = []
+    for column in serializer.columns:
+        path = column.split('__')
+        field = Snippet._meta.get_field(path[0])
+        if len(path) == 1:
+            expressions.append('%s.%s' % (table, quote_name(field.column)))
+        elif len(path) == 2 and path[1] == field.target_field.name:
+            expressions.append('%s.%s' % (table, quote_name(field.column)))
+        elif len(path) == 2:
+            related = field.related_model._meta
+            expressions.append('(SELECT r.%s FROM %s r WHERE r.%s = %s.%s)' % (
+                quote_name(related.get_field(path[1]).column), quote_name(related.db_table),
+                quote_name(field.target_field.column), table, quote_name(field.column),
+            ))
+        else:
+            raise ValueError("%s: only one level of relations can be returned" % column)
+    return ", ".join(expressions)
+
+
+def update_snippet(snippet_id, changes, versions=None, serializer=FAST_SNIPPET_SERIALIZER):
+    """
+    Partial update as a single conditional UPDATE .. RETURNING, nothing is read or locked
+    beforehand. `modified` and `version` are bumped like Snippet.save(). A concurrent writer
+    either commits first, then the version no longer matches, or waits for this one.
+    The same statement tells a missing snippet from a version mismatch, so a failed update
+    costs no extra query.
+    Inside a transaction a constraint violation aborts it like any failed statement, and
+    the owner foreign key is only checked at commit.
+    :param snippet_id:
+    :param changes: validated SnippetUpdateSerializer data
+    :param versions: versions the changes are based on (If-Match), None for any version
+    :param serializer: compiled read serializer of the returned row
+    :return: row of `serializer` columns plus the new `modified`
+    :raises:
+        - DataNotFound: no such snippet
+        - PreconditionFailed: the snippet was changed since, its version is not in `versions`
+        - ValidationError: the title is taken or the owner does not exist
+    """
+    alias = router.db_for_write(Snippet)
+    quote_name = connections[alias].ops.quote_name
+    table = quote_name(Snippet._meta.db_table)
+    assignments = ['%s = %%s' % quote_name(Snippet._meta.get_field(name).column) for name in changes]
+    params = list(changes.values()) + [timezone.now(), snippet_id]
+    update = "UPDATE {table} SET {assignments} WHERE id = %s".format(
+        table=table, assignments=", ".join(assignments + ["modified = %s", "version = version + 1"])
+    )
+    if versions is not None:
+        update += " AND version = ANY(%s)"
+        params.append(list(versions))
+    update += " RETURNING %s, %s.modified" % (_returning_sql(serializer, table, quote_name), table)
+    # the EXISTS reads the statement's snapshot, i.e. the row as it was before the update,
+    # the left join keeps one result row when nothing was updated
+    sql = (
+        "WITH updated AS ({update}) "
+        "SELECT EXISTS (SELECT 1 FROM {table} WHERE id = %s), updated.* "
+        "FROM (VALUES (1)) AS one LEFT JOIN updated ON true"
+    ).format(update=update, table=table)
+    params.append(snippet_id)
+
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(sql, params)
+            found, *row = cursor.fetchone()
+    except IntegrityError as exc:
+        if is_title_conflict(exc):
+            raise ValidationError({"title": ["snippet with this title already exists."]})
+        if getattr(exc.__cause__, 'pgcode', None) == errorcodes.FOREIGN_KEY_VIOLATION:
+            raise ValidationError({"owner_id": ['Invalid pk "%s" - object does not exist.' % changes["owner_id"]]})
+        raise
+
+    # `modified` is never NULL on an updated row
+    if row[-1] is None:
+        if found and versions is not None:
+            raise exceptions.PreconditionFailed()
+        raise exceptions.DataNotFound()
+    snippets_bulk_changed.send(sender=Snippet, ids=[snippet_id])
+    return tuple(row)
+
+
+def bulk_update_snippets(rows, user, batch_size=None):
+    """
+    Apply many partial updates with one ownership query and one UPDATE statement per
+    batch of rows changing the same set of fields. `modified` and `version` are bumped like
+    Snippet.save().
+    :param rows: list of {"id": .., <field>: <value>, ..}
+    :param user: request user, must own every snippet of the batch
+    :param batch_size: rows per UPDATE, defaults to settings.SNIPPET_BULK_BATCH_SIZE
+    :return: (list of updated ids, list of {"index": .., "errors": {..}})
+    :raises:
+        - PermissionDenied: if any snippet of the batch belongs to another user
+        - AlreadyExist: if a new title is already taken
+    """
+    batch_size = batch_size or settings.SNIPPET_BULK_BATCH_SIZE
+    child = SnippetBulkUpdateSerializer()
+    valid, errors, seen = [], [], set()
+    for index, row in enumerate(rows):
+        try:
+            data = child.run_validation(row)
+        except ValidationError as exc:
+            errors.append({"index": index, "errors": exc.detail})
+            continue
+        if data["id"] in seen:
+            errors.append({"index": index, "errors": {"id": ["Duplicate id in batch."]}})
+            continue
+        seen.add(data["id"])
+        valid.append((index, data))
+
+    owners = dict(Snippet.objects.filter(id__in=seen).order_by().values_list('id', 'owner_id'))
+    if any(owner_id != user.id for owner_id in owners.values()):
+        raise exceptions.PermissionDenied()
+    for index, data in valid:
+        if data["id"] not in owners:
+            errors.append({"index": index, "errors": {"id": ["Not found."]}})
+    valid = [(index, data) for index, data in valid if data["id"] in owners]
+    errors.sort(key=lambda error: error["index"])
+
+    now = timezone.now()
+    groups = {}
+    for _, data in valid:
+        fields = tuple(sorted(field for field in data if field != "id"))
+        snippet = Snippet(modified=now, version=F('version') + 1, **data)
+        if "code" in fields:
+            # NULL lets the trigger tokenize plain code, compressed code brings its own vector
+            snippet.search_vector = code_search_vector(data["code"])
+            fields += ("search_vector",)
+        groups.setdefault(fields, []).append(snippet)
+
+    try:
+        with transaction.atomic():
+            for fields, snippets in groups.items():
+                Snippet.objects.bulk_update(snippets, fields + ('modified', 'version'), batch_size=batch_size)
+    except IntegrityError:
+        raise exceptions.AlreadyExist()
+    updated = [data["id"] for _, data in valid]
+    snippets_bulk_changed.send(sender=Snippet, ids=updated)
+    return updated, errors
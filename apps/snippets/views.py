@@ -1,16 +1,47 @@
+import csv
+import io
+from collections import OrderedDict
+
 from rest_framework import permissions, status
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import router
+from django.db.models import F
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
 
 from applibs import exceptions
+from applibs.error_codes import ERROR_CODE
+from applibs.highlighting import HighlightPoolBusy
+from applibs.parsers import NDJSONParser
+from applibs.replicas import use_primary
+from applibs.pagination import KeysetPagination, PageNumberPagination
+from applibs.streaming import STREAM_FORMATS, copy_stream, streaming_json_response
+from apps.snippets.cache import snippet_response_cache
 from apps.snippets.permissions import IsOwnerOrReadOnly
-from .models import Snippet
-from .serializers import SnippetSerializer
+from cores.query_budget import QueryBudgetMixin
+from apps.snippets.highlight import highlighted_snippet
+from apps.snippets.conditions import (
+    if_match_versions, list_etag, snippet_etag, snippet_etag_value,
+)
+from apps.snippets.utils import (
+    CHANGES_ORDERING, ExportCodeDecompressor, autocomplete_titles, bulk_create_snippets, bulk_update_snippets,
+    get_list_queryset, import_snippets, include_archived, parse_export_moment, serialize_changes, snippet_changes,
+    snippet_export_sql, snippet_stats, sparse_serializer, update_snippet,
+)
+from .models import ArchivedSnippet, Snippet
+from .serializers import FAST_SNIPPET_SERIALIZER, SnippetSerializer, SnippetUpdateSerializer
 
 
-class SnippetView(ModelViewSet):
+class SnippetView(QueryBudgetMixin, ModelViewSet):
     """
     Snippet related API endpoints
     """
@@ -19,39 +50,303 @@ class SnippetView(ModelViewSet):
     # model_name = Snippet
 
     serializer_class = SnippetSerializer
-    queryset = Snippet.objects.filter(status=True)
+    queryset = Snippet.objects.live()
     http_method_names = ['get', 'post', 'patch']
+    pagination_class = KeysetPagination
+    ordering = ('created', 'id')
+    # queries per request including the authentication lookup, enforced in DEBUG
+    query_budget = {
+        "list": 3,
+        "retrieve": 3,
+        "cache_stats": 1,
+        "export": 1,
+        "highlight": 3,
+        "stats": 3,
+        "changes": 4,
+        "search": 4,
+        "autocomplete": 2,
+        "create": 5,
+        "partial_update": 2,
+        "bulk_create": 5,
+    }
+
+    def get_queryset(self):
+        return FAST_SNIPPET_SERIALIZER.prepare_queryset(super().get_queryset())
+
+    def stream_list(self, queryset, stream_format, serializer):
+        """
+        Dump every snippet of the queryset through a server-side cursor
+        :param queryset:
+        :param stream_format: ndjson/json
+        :param serializer: compiled read serializer of the requested fields
+        :return: StreamingHttpResponse
+        """
+        if stream_format not in STREAM_FORMATS:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+        chunk_size = settings.API_STREAM_CHUNK_SIZE
+        to_representation = serializer.to_representation
+        rows = serializer.values_list(queryset.order_by(*self.ordering))
+        return streaming_json_response(
+            (to_representation(row) for row in rows.iterator(chunk_size=chunk_size)), stream_format, chunk_size
+        )
 
+    @method_decorator(condition(etag_func=list_etag))
     def list(self, request, *args, **kwargs):
         """
             Get Snippet request:
             METHOD: GET
-            URL: URI/api/v1/snippets/?type=all/active
+            URL: URI/api/v1/snippets/?type=all/active&page_size=50&cursor=<next/previous cursor>
+            URL: URI/api/v1/snippets/?type=all&include_archived=true&cursor=<next/previous cursor>
+            URL: URI/api/v1/snippets/?type=all/active&stream=ndjson/json
+            URL: URI/api/v1/snippets/?fields=id,title (any of the above, only these fields are selected)
             :param request:
             :param args:
             :param kwargs:
-            :return:
+            :return: {"next": <url>, "previous": <url>, "results": [...]} or a streamed dump
+        """
+        queryset = get_list_queryset(request.query_params.get("type", "active"))
+        serializer = sparse_serializer(request.query_params)
+        stream_format = request.query_params.get("stream")
+        if stream_format:
+            return self.stream_list(queryset, stream_format, serializer)
+        # the ordering columns ride along for the keyset cursor
+        rows = serializer.values_list(queryset, *self.ordering, named=True)
+        if include_archived(request.query_params):
+            archived_rows = serializer.values_list(ArchivedSnippet.objects.all(), *self.ordering, named=True)
+            page = self.paginator.paginate_querysets([rows, archived_rows], request, view=self)
+        else:
+            page = self.paginate_queryset(rows)
+        return self.get_paginated_response(serializer.serialize(page))
+
+    @action(detail=False, methods=['get'])
+    def search(self, request, *args, **kwargs):
+        """
+            Full text search over active snippet title, code and language:
+            METHOD: GET
+            URL: URI/api/v1/snippets/search/?q=<words>&page=1&page_size=50&fields=id,title
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: {"count": .., "next": <url>, "previous": <url>, "results": [... "rank": ..]}
+        """
+        words = request.query_params.get("q", "").strip()
+        if not words:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.ALL_FIELDS_REQUIRED)
+        serializer = sparse_serializer(request.query_params)
+
+        query = SearchQuery(words, config='simple')
+        queryset = Snippet.objects.live().filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query)
+        ).order_by('-rank', 'id')
+
+        paginator = PageNumberPagination()
+        page = paginator.paginate_queryset(
+            serializer.values_list(queryset, 'rank', named=True), request, view=self
+        )
+        results = serializer.serialize(page)
+        for result, row in zip(results, page):
+            result["rank"] = row.rank
+        return paginator.get_paginated_response(results)
+
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request, *args, **kwargs):
+        """
+            Title autocomplete over active snippets:
+            METHOD: GET
+            URL: URI/api/v1/snippets/autocomplete/?q=<prefix>&limit=10
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: {"results": ["title", ...]}
         """
-        snippets  = {
-            "all": Snippet.objects.all().values(),
-            "active": Snippet.objects.filter(status=True).values()
-        }
-        params = request.query_params.dict()
-        return Response(snippets.get(params.get("type")), status=status.HTTP_200_OK)
+        prefix = request.query_params.get("q", "").strip()
+        max_results = settings.SNIPPET_AUTOCOMPLETE_MAX_RESULTS
+        try:
+            limit = min(int(request.query_params.get("limit", max_results)), max_results)
+        except ValueError:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+        if not prefix or limit < 1:
+            return Response({"results": []}, status=status.HTTP_200_OK)
+        return Response({"results": autocomplete_titles(prefix, limit)}, status=status.HTTP_200_OK)
 
+    @method_decorator(condition(etag_func=snippet_etag))
     def retrieve(self, request, *args, **kwargs):
         """
             Get Specific Snippet request:
             METHOD: GET
-            URL: URI/api/v1/snippets/<id>/
+            URL: URI/api/v1/snippets/<id>/?fields=id,title
             :param request:
             :param args:
             :param kwargs:
-            :return:
+            :return: rendered body served from the snippet response cache when possible,
+                     sparse fieldsets bypass the cache
+        """
+        snippet_id = kwargs["pk"]
+        if not snippet_id.isdigit():
+            raise exceptions.DataNotFound()
+
+        serializer = sparse_serializer(request.query_params)
+        if serializer is not FAST_SNIPPET_SERIALIZER:
+            queryset = Snippet.objects.live().filter(id=snippet_id)
+            content = JSONRenderer().render(serializer.serialize(serializer.values_list(queryset)))
+            response = HttpResponse(content, content_type="application/json", status=status.HTTP_200_OK)
+            response["X-Cache"] = "BYPASS"
+            return response
+
+        content = snippet_response_cache.get(snippet_id)
+        cache_status = "HIT"
+        if content is None:
+            cache_status = "MISS"
+            # a lagging replica would cache the row as it was before the last write
+            with use_primary():
+                queryset = Snippet.objects.live().filter(id=snippet_id)
+                rows = list(FAST_SNIPPET_SERIALIZER.values_list(queryset))
+            content = JSONRenderer().render(FAST_SNIPPET_SERIALIZER.serialize(rows))
+            snippet_response_cache.set(snippet_id, content)
+
+        response = HttpResponse(content, content_type="application/json", status=status.HTTP_200_OK)
+        response["X-Cache"] = cache_status
+        return response
+
+    @action(detail=True, methods=['get'])
+    def highlight(self, request, *args, **kwargs):
+        """
+            Syntax highlighted HTML of a snippet, rendered by pygments in a process pool and cached:
+            METHOD: GET
+            URL: URI/api/v1/snippets/<id>/highlight/
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: text/html fragment
         """
-        queryset = Snippet.objects.filter(status=True, id=kwargs["pk"])
-        snippet_serializer = SnippetSerializer(queryset, many=True)
-        return Response(snippet_serializer.data, status=status.HTTP_200_OK)
+        snippet_id = kwargs["pk"]
+        if not snippet_id.isdigit():
+            raise exceptions.DataNotFound()
+        try:
+            html = highlighted_snippet(int(snippet_id))
+        except HighlightPoolBusy:
+            raise exceptions.ServiceUnavailable()
+        if html is None:
+            raise exceptions.DataNotFound()
+        return HttpResponse(html, content_type="text/html; charset=utf-8", status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request, *args, **kwargs):
+        """
+            Snippet counts per language and per owner, from the incrementally maintained summary table:
+            METHOD: GET
+            URL: URI/api/v1/snippets/stats/
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: {"languages": [{"language": .., "total": .., "active": ..}], "owners": [...]}
+        """
+        return Response(snippet_stats(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request, *args, **kwargs):
+        """
+            Snippets created, modified, deactivated or deleted after a cursor, oldest change first:
+            METHOD: GET
+            URL: URI/api/v1/snippets/changes/?page_size=500&fields=id,title
+            URL: URI/api/v1/snippets/changes/?cursor=<next cursor>
+            Start without cursor, then always poll "next": it resumes after the last change
+            seen. A snippet changed several times appears once, at its latest change.
+            Deletions are kept SNIPPET_TOMBSTONE_RETENTION_DAYS, a consumer polling less
+            often has to start over without cursor.
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: {"next": <url>, "has_more": true/false,
+                      "results": [{"id": .., "modified": .., "deleted": false, "snippet": {..}}]}
+        """
+        serializer = sparse_serializer(request.query_params)
+        paginator = KeysetPagination()
+        paginator.ordering = CHANGES_ORDERING
+        # a lagging replica would let the cursor move past changes it has not received yet
+        with use_primary():
+            page = paginator.paginate_querysets(snippet_changes(serializer), request)
+        return Response(OrderedDict([
+            ('next', paginator.get_resume_link()),
+            ('has_more', paginator.has_next and bool(page)),
+            ('results', serialize_changes(serializer, page)),
+        ]), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=(permissions.IsAdminUser,))
+    def cache_stats(self, request, *args, **kwargs):
+        """
+            Snippet response cache counters of this worker process:
+            METHOD: GET
+            URL: URI/api/v1/snippets/cache-stats/
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: {"hits": .., "misses": .., "hit_ratio": ..}
+        """
+        return Response(snippet_response_cache.stats(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], permission_classes=(permissions.IsAdminUser,))
+    def export(self, request, *args, **kwargs):
+        """
+            CSV dump of the snippets table formatted by postgres COPY and streamed as it comes:
+            METHOD: GET
+            URL: URI/api/v1/snippets/export/?status=true/false&created_from=2020-01-01&created_to=2020-02-01
+            URL: URI/api/v1/snippets/export/?owner=true&code=true&gzip=true
+            :param request:
+            :param args:
+            :param kwargs:
+            :return: text/csv or application/gzip attachment, ordered by id
+        """
+        params = request.query_params
+        flags = {name: params.get(name, "").lower() in ("1", "true") for name in ("owner", "code", "gzip")}
+        status_filter = params.get("status", "").lower()
+        if status_filter not in ("", "true", "false"):
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+        copy_sql = snippet_export_sql(
+            status={"": None, "true": True, "false": False}[status_filter],
+            created_from=parse_export_moment(params.get("created_from")),
+            created_to=parse_export_moment(params.get("created_to")),
+            with_owner=flags["owner"],
+            include_code=flags["code"],
+        )
+        filename = "snippets.csv.gz" if flags["gzip"] else "snippets.csv"
+        response = StreamingHttpResponse(
+            copy_stream(copy_sql, compress=flags["gzip"], using=router.db_for_read(Snippet),
+                        row_filter=ExportCodeDecompressor() if flags["code"] else None),
+            content_type="application/gzip" if flags["gzip"] else "text/csv; charset=utf-8"
+        )
+        response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import', permission_classes=(permissions.IsAdminUser,))
+    def import_snippets(self, request, *args, **kwargs):
+        """
+            Bulk import of a CSV or NDJSON upload, loaded with postgres COPY and merged set-based:
+            METHOD: POST
+            URL: URI/api/v1/snippets/import/
+            Content-Type: text/csv (header line required) or application/x-ndjson
+            :param request:
+            title,owner_id,code,linenos,language,status
+            Motu,1,print(1),false,python,true
+            ...
+            :param args:
+            :param kwargs:
+            :return: {"imported": <count>, "rejected": [{"line": .., "error": ..}]}
+        """
+        formats = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+        source_format = formats.get(request.content_type.split(";")[0].strip())
+        if source_format is None or request.stream is None:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.INVALID_REQUEST)
+
+        rejects = io.BytesIO()
+        imported, rejected = import_snippets(request.stream, source_format, rejects)
+        rejected = [
+            {"line": int(row["line"]), "error": row["error"]}
+            for row in csv.DictReader(io.StringIO(rejects.getvalue().decode()))
+        ]
+        response_status = status.HTTP_201_CREATED if imported else status.HTTP_400_BAD_REQUEST
+        return Response(data={"imported": imported, "rejected": rejected}, status=response_status)
 
     def create(self, request, *args, **kwargs):
         """
@@ -80,24 +375,88 @@ class SnippetView(ModelViewSet):
         #     print("Something went wrong: ", error)
         #     raise exceptions.CustomAPIException
 
-    def partial_update(self, request, *args, **kwargs):
+    @action(detail=False, methods=['post'], url_path='bulk', parser_classes=(JSONParser, NDJSONParser))
+    def bulk_create(self, request, *args, **kwargs):
         """
-            Update Snippet request:
+            Bulk Create Snippet request:
             METHOD: POST
+            URL: URI/api/v1/snippets/bulk/
+            Content-Type: application/json or application/x-ndjson
+            :param request:
+            [
+                {"title": "Motu", "owner_id": 1, "code": "print(1)", "language": "python", "status": true},
+                ...
+            ]
+            :param args:
+            :param kwargs:
+            :return: {"created": [ids], "errors": [{"index": <row index>, "errors": {...}}]}
+        """
+        rows = request.data
+        if not isinstance(rows, list) or not rows:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.INVALID_REQUEST)
+        if len(rows) > settings.SNIPPET_BULK_MAX_ROWS:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+
+        created, errors = bulk_create_snippets(rows)
+        response_status = status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST
+        return Response(data={"created": created, "errors": errors}, status=response_status)
+
+    @bulk_create.mapping.patch
+    def bulk_partial_update(self, request, *args, **kwargs):
+        """
+            Bulk Update Snippet request:
+            METHOD: PATCH
+            URL: URI/api/v1/snippets/bulk/
+            :param request:
+            [
+                {"id": 1, "status": false},
+                {"id": 2, "title": "Motu Patlu 123"},
+                ...
+            ]
+            :param args:
+            :param kwargs:
+            :return: {"updated": [ids], "errors": [{"index": <row index>, "errors": {...}}]}
+            :raises
+                - PermissionDenied: if any snippet is not owned by the request user
+        """
+        rows = request.data
+        if not isinstance(rows, list) or not rows:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.INVALID_REQUEST)
+        if len(rows) > settings.SNIPPET_BULK_MAX_ROWS:
+            raise exceptions.ValidationError(ERROR_CODE.global_codes.VALUE_ERROR)
+
+        updated, errors = bulk_update_snippets(rows, request.user)
+        response_status = status.HTTP_200_OK if updated else status.HTTP_400_BAD_REQUEST
+        return Response(data={"updated": updated, "errors": errors}, status=response_status)
+
+    def partial_update(self, request, *args, **kwargs):
+        """
+            Update Snippet request, a single conditional UPDATE:
+            METHOD: PATCH
             URL: URI/api/v1/snippets/id/
+            If-Match: <ETag of the snippet, or "<version>"> (optional, the update only applies
+                      to that version)
             :param request:
             {
                 "title": "Motu Patlu 123"
             }
             :param args:
             :param kwargs:
-            :return:
-        """   
-        instance = get_object_or_404(Snippet, id=kwargs["pk"])
-        snippet_serializer = SnippetSerializer(instance, data=request.data, partial=True)
+            :return: updated snippet with its new ETag, 412 when it was changed since the If-Match version
+        """
+        snippet_id = kwargs["pk"]
+        if not snippet_id.isdigit():
+            raise exceptions.DataNotFound()
+        versions = if_match_versions(request)
+        snippet_serializer = SnippetUpdateSerializer(data=request.data)
         snippet_serializer.is_valid(raise_exception=True)
-        snippet_serializer.save()
-        return Response(data=SnippetSerializer(snippet_serializer.instance).data, status=status.HTTP_200_OK)
+        row = update_snippet(int(snippet_id), snippet_serializer.validated_data, versions)
+        data = FAST_SNIPPET_SERIALIZER.to_representation(row)
+        response = Response(data=data, status=status.HTTP_200_OK)
+        response["ETag"] = quote_etag(
+            snippet_etag_value(data["id"], data["version"], row[-1], data["owner"]["username"])
+        )
+        return response
         # try:  
         #     print(request.data)
         #     request.data.update({'name': '3223'})
@@ -4,6 +4,7 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.utils.translation import gettext_lazy as _
 
+from applibs.pagination import ApproximateCountPaginator
 from apps.users.models import User
 
 
@@ -82,6 +83,9 @@ class UserAdmin(BaseUserAdmin):
     search_fields = ('username',)
     ordering = ('username',)
     filter_horizontal = ('groups', 'user_permissions',)
+    # estimated counts on large tables, and no second unfiltered COUNT(*)
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
 
 
 # Now register the new UserAdmin...
@@ -0,0 +1,293 @@
+"""
+Native ASGI endpoints for the hot API paths.
+Under Django 3.0 get_asgi_application() runs every request synchronously in a thread
+without any bound. The endpoints here parse the request and send the response on the
+event loop and run the DRF dispatch in a bounded thread pool, the ORM is not async yet.
+Requests beyond the pool's pending limit are turned away with 503 instead of piling up.
+Every other request goes to Django.
+Streaming responses, of the async endpoints and of Django, are iterated in a thread by
+StreamingASGIHandler.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Event, Lock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.exception import response_for_exception
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve, set_script_prefix
+from django.utils.module_loading import import_string
+
+from applibs import exceptions
+
+
+class DatabaseExecutor(object):
+    """
+    Thread pool for the blocking ORM calls of the async endpoints and of streamed responses,
+    started on first use.
+    At most `max_pending` calls are queued or running. Every call starts and ends like a
+    request does for the connection of its thread, honouring CONN_MAX_AGE. Calls run in
+    the caller's context, context variables like the replica pin follow them.
+    """
+
+    def __init__(self, max_workers, max_pending, thread_name_prefix='async-db'):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._slots = BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix
+                )
+            return self._executor
+
+    @staticmethod
+    def call(func, args):
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    async def run(self, func, *args):
+        """
+        :param func: blocking callable, may use the ORM
+        :return: result of func(*args)
+        :raises ServiceUnavailable: max_pending calls are already queued or running
+        """
+        if not self._slots.acquire(blocking=False):
+            raise exceptions.ServiceUnavailable()
+        try:
+            future = self.executor.submit(contextvars.copy_context().run, self.call, func, args)
+        except Exception:
+            self._slots.release()
+            raise
+        # released when the call finishes, even if the awaiting request went away
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+database_executor = DatabaseExecutor(
+    max_workers=getattr(settings, 'ASYNC_DB_WORKERS', 10),
+    max_pending=getattr(settings, 'ASYNC_DB_MAX_PENDING', 100),
+)
+
+
+stream_executor = DatabaseExecutor(
+    max_workers=getattr(settings, 'ASYNC_STREAM_WORKERS', 10),
+    max_pending=getattr(settings, 'ASYNC_STREAM_MAX_PENDING', 100),
+    thread_name_prefix='asgi-stream',
+)
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 3.0's ASGIHandler iterates streaming responses on the event loop: a generator
+    reading the database raises SynchronousOnlyOperation after the headers went out, and
+    one waiting on I/O stalls every other request of the worker. Here the whole response
+    is sent, and closed, by one job of the shared stream executor. It is the same thread
+    for the whole response since a server side cursor belongs to the connection of its
+    thread. Beyond the executor's pending limit streams are answered with 503.
+    """
+
+    def stream_response(self, response, start, send, loop, cancelled):
+        """
+        Runs in a stream executor thread, every message waits for the event loop to send it
+        :param cancelled: threading.Event set once the request went away
+        """
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        try:
+            if cancelled.is_set():
+                return
+            send_message(start)
+            # `__iter__` and not `streaming_content` in case a subclass overrides it
+            for part in response:
+                if cancelled.is_set():
+                    return
+                for chunk, _ in self.chunk_bytes(part):
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_message({'type': 'http.response.body'})
+        finally:
+            response.close()
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip())
+            )
+        start = {
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        }
+        cancelled = Event()
+        try:
+            # shielded, the job has to run to close the response when the client went away
+            await asyncio.shield(stream_executor.run(
+                self.stream_response, response, start, send, asyncio.get_running_loop(), cancelled
+            ))
+        except exceptions.ServiceUnavailable as exc:
+            await sync_to_async(response.close)()
+            await super().send_response(JsonResponse(exc.default_message, status=exc.status_code), send)
+        finally:
+            cancelled.set()
+
+
+class AsyncViewEndpoint(object):
+    """
+    Serve actions of a DRF view from the database executor: the view runs its own
+    dispatch() there, initial() with authentication, permissions, throttles and versioning
+    included, as do mixins like QueryBudgetMixin. Responses are the same as through Django,
+    a full executor is answered with 503 right away instead of queueing on Django's threads.
+        AsyncViewEndpoint(SnippetView, ["list", "create"])
+    :param view_class: APIView or ViewSet
+    :param actions: viewset actions, http method handlers ("get", ..) for an APIView
+    """
+
+    def __init__(self, view_class, actions):
+        self.view_class = view_class
+        self.actions = actions
+
+    @staticmethod
+    def dispatch(view_func, request, kwargs):
+        """
+        Runs in the database executor
+        :return: rendered response
+        """
+        response = view_func(request, **kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response
+
+    def unavailable(self, request, view_func, kwargs, exc):
+        """
+        :return: rendered response of `exc` as the view would have answered it
+        """
+        view = self.view_class(**view_func.initkwargs)
+        if getattr(view_func, 'actions', None) is not None:
+            view.action_map = view_func.actions
+        view.args, view.kwargs = (), kwargs
+        view.headers = view.default_response_headers
+        view.format_kwarg = view.get_format_suffix(**kwargs)
+        view.request = view.initialize_request(request, **kwargs)
+        return view.finalize_response(view.request, view.handle_exception(exc), **kwargs).render()
+
+    async def __call__(self, request, view_func, kwargs):
+        """
+        :param request: django ASGIRequest
+        :param view_func: resolved view function of the view class
+        :param kwargs: url keyword arguments
+        :return: HttpResponse
+        """
+        try:
+            return await database_executor.run(self.dispatch, view_func, request, kwargs)
+        except exceptions.ServiceUnavailable as exc:
+            return self.unavailable(request, view_func, kwargs, exc)
+
+
+class AsyncAPIRouter(object):
+    """
+    ASGI application serving the actions of `endpoints` natively and handing every other
+    request, lifespan and websocket events included, to the django ASGI application.
+    Paths are resolved with the django urlconf, request parsing and response sending reuse
+    the django handler. Django middleware does not run for the async endpoints, only the
+    process_request() and process_response() hooks of settings.ASYNC_MIDDLEWARE, in the
+    same order as django would.
+    :param endpoints: list of AsyncViewEndpoint
+    :param application: StreamingASGIHandler
+    """
+
+    def __init__(self, endpoints, application):
+        self.endpoints = {
+            (endpoint.view_class, action): endpoint for endpoint in endpoints for action in endpoint.actions
+        }
+        self.application = application
+        self.middleware = [import_string(path)() for path in getattr(settings, 'ASYNC_MIDDLEWARE', [])]
+
+    def resolve(self, scope):
+        """
+        :return: (endpoint, resolver match) or None when django serves the request
+        """
+        if scope['type'] != 'http':
+            return None
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return None
+        # DRF views keep their class and, for viewsets, the method to action map
+        view_class = getattr(match.func, 'cls', None)
+        method = scope['method'].lower()
+        actions = getattr(match.func, 'actions', None)
+        action = actions.get(method) if actions is not None else method
+        endpoint = self.endpoints.get((view_class, action))
+        return (endpoint, match) if endpoint is not None else None
+
+    async def __call__(self, scope, receive, send):
+        resolved = self.resolve(scope)
+        if resolved is None:
+            return await self.application(scope, receive, send)
+        endpoint, match = resolved
+        try:
+            body_file = await self.application.read_body(receive)
+        except RequestAborted:
+            return
+        set_script_prefix(self.application.get_script_prefix(scope))
+        request, response = self.application.create_request(scope, body_file)
+        if request is not None:
+            request.resolver_match = match
+            response = await self.get_response(endpoint, request, match)
+        await self.application.send_response(response, send)
+
+    async def get_response(self, endpoint, request, match):
+        """
+        Runs the middleware hooks around the endpoint like MiddlewareMixin does: a
+        process_request() returning a response skips the endpoint and the later middleware.
+        """
+        response, called = None, []
+        try:
+            for middleware in self.middleware:
+                called.append(middleware)
+                if hasattr(middleware, 'process_request'):
+                    response = middleware.process_request(request)
+                    if response is not None:
+                        break
+            else:
+                response = await endpoint(request, match.func, match.kwargs)
+        except Exception as exc:
+            # logged and rendered like an unhandled exception of a django view
+            response = response_for_exception(request, exc)
+        for middleware in reversed(called):
+            if hasattr(middleware, 'process_response'):
+                response = middleware.process_response(request, response)
+        return response
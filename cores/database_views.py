@@ -0,0 +1,25 @@
+from rest_framework import permissions, status
+from rest_framework.response import Response
+
+from applibs.pooled_postgresql.pool import pool_stats
+from applibs.success_codes import SUCCESS_CODE
+from cores.internal_base_views import CoreJWTView
+
+
+class DatabasePoolStatsAPI(CoreJWTView):
+    """
+        URL: /api/v1/db_pool_stats/
+        Method: GET
+    """
+    model_name = None
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        """
+        :param request:
+        :return: connection pool sizes and counters of the worker process serving the request,
+                 wait times in milliseconds, one entry per database alias
+        """
+        data = {"data": pool_stats()}
+        data.update(SUCCESS_CODE.global_codes.REQUEST_SUCCESS)
+        return Response(data, status=status.HTTP_200_OK)
@@ -0,0 +1,53 @@
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when a view runs more queries than its declared budget, usually an N+1 regression
+    """
+
+
+class QueryCounter(object):
+    """
+    connection.execute_wrapper() hook recording every executed statement
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMixin(object):
+    """
+    Enforce a maximum number of queries per viewset action while settings.QUERY_BUDGET_ENFORCE
+    is on (defaults to DEBUG). The budget covers the whole dispatch, authentication included,
+    on every database: queries routed to a replica count too.
+        query_budget = {"list": 2, "retrieve": 2}
+    Actions without a budget are not checked.
+    """
+    query_budget = {}
+
+    def dispatch(self, request, *args, **kwargs):
+        if not getattr(settings, 'QUERY_BUDGET_ENFORCE', False):
+            return super().dispatch(request, *args, **kwargs)
+
+        counter = QueryCounter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(counter))
+            response = super().dispatch(request, *args, **kwargs)
+
+        budget = self.query_budget.get(getattr(self, 'action', None))
+        if budget is not None and len(counter.queries) > budget:
+            raise QueryBudgetExceeded(
+                "%s.%s ran %d queries, budget is %d:\n%s" % (
+                    self.__class__.__name__, self.action, len(counter.queries), budget, "\n".join(counter.queries)
+                )
+            )
+        return response
@@ -2,6 +2,9 @@
 ASGI config for django_everything project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Streaming responses are iterated off the event loop by cores.async_views.StreamingASGIHandler.
+With ASYNC_VIEWS_ENABLED the endpoints of api.async_urls are served natively, see
+cores.async_views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -9,8 +12,20 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_everything.settings')
 
-application = get_asgi_application()
+# what django.core.asgi.get_asgi_application() does, with the streaming handler
+django.setup(set_prefix=False)
+
+from cores.async_views import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
+
+if settings.ASYNC_VIEWS_ENABLED:
+    from api.async_urls import async_endpoints
+    from cores.async_views import AsyncAPIRouter
+
+    application = AsyncAPIRouter(async_endpoints, application)